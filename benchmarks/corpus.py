@@ -0,0 +1,183 @@
+"""
+Generates synthetic Alma API responses with the structure of the real Retrieve
+Bibs, Retrieve Holdings and Retrieve Items responses (see tests/resources),
+in any size. The content is derived from a seeded random number generator, so
+the same arguments always produce the same XML.
+
+The corpus can also be written to files, e.g. for profiling:
+
+    python -m benchmarks.corpus --bibs 1 --bibs 100 --bibs 1000 --items 1000 corpus/
+"""
+import os
+import random
+from xml.sax.saxutils import escape
+
+import click
+
+LOCATIONS = [('CPMCK', 'McKeldin Library'), ('CPART', 'Architecture Library'), ('CPEPL', 'STEM Library')]
+COLLECTIONS = [('TPTXB', 'Top Textbook'), ('STACK', 'Stacks'), ('RESRV', 'Reserves')]
+
+
+def mms_id(n):
+    """
+    Returns the nth synthetic MMS ID
+    """
+    return f'99{n:012d}08238'
+
+
+def holdings_id(bib_mms_id):
+    return f'22{bib_mms_id[2:14]}0008238'
+
+
+def _rng(*seed):
+    return random.Random('-'.join(str(part) for part in seed))
+
+
+def bib(bib_mms_id, base_url, avas=2, unavailable=0.3, marc_fields=20, seed=0):
+    """
+    Returns a <bib> element with the given number of AVA (availability)
+    datafields, each unavailable with the given probability, and marc_fields
+    other datafields of the kind found in a full view record
+    """
+    rng = _rng(seed, bib_mms_id)
+    title = escape(f'Synthetic title {bib_mms_id} /')
+    datafields = ''.join(
+        f"""
+      <datafield ind1=" " ind2=" " tag="{rng.choice(['020', '035', '245', '500', '650'])}">
+        <subfield code="a">{rng.getrandbits(64):x}</subfield>
+      </datafield>""" for _ in range(marc_fields))
+
+    for _ in range(avas):
+        library, library_name = rng.choice(LOCATIONS)
+        collection, collection_name = rng.choice(COLLECTIONS)
+        total = rng.randint(1, 5)
+        if rng.random() < unavailable:
+            availability, checked_out = 'unavailable', total
+        else:
+            availability, checked_out = 'available', rng.randint(0, total - 1)
+        datafields += f"""
+      <datafield ind1=" " ind2=" " tag="AVA">
+        <subfield code="0">{bib_mms_id}</subfield>
+        <subfield code="8">{holdings_id(bib_mms_id)}</subfield>
+        <subfield code="a">01USMAI_CP</subfield>
+        <subfield code="b">{library}</subfield>
+        <subfield code="c">{collection_name}</subfield>
+        <subfield code="d">CLAS{rng.randint(100, 499)}/{bib_mms_id}</subfield>
+        <subfield code="e">{availability}</subfield>
+        <subfield code="f">{total}</subfield>
+        <subfield code="g">{checked_out}</subfield>
+        <subfield code="j">{collection}</subfield>
+        <subfield code="q">{library_name}</subfield>
+      </datafield>"""
+
+    return f"""
+  <bib>
+    <mms_id>{bib_mms_id}</mms_id>
+    <record_format>marc21</record_format>
+    <title>{title}</title>
+    <author>Author {rng.randint(1, 10000)}.</author>
+    <holdings link="{base_url}/almaws/v1/bibs/{bib_mms_id}/holdings"/>
+    <created_by>import</created_by>
+    <record>
+      <leader>     nam a2200361Ii 45 0</leader>
+      <controlfield tag="001">{bib_mms_id}</controlfield>{datafields}
+    </record>
+  </bib>"""
+
+
+def bibs_response(mms_ids, base_url, **kwargs):
+    """
+    Returns a Retrieve Bibs response for the given MMS IDs. The keyword
+    arguments are passed to :func:`bib`.
+    """
+    bibs = ''.join(bib(bib_mms_id, base_url, **kwargs) for bib_mms_id in mms_ids)
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<bibs total_record_count="{len(mms_ids)}">{bibs}\n</bibs>\n')
+
+
+def holdings_response(bib_mms_id, base_url):
+    """
+    Returns a Retrieve Holdings response with the single holding of the bib
+    """
+    holding_id = holdings_id(bib_mms_id)
+    return f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<holdings total_record_count="1">
+  <holding link="{base_url}/almaws/v1/bibs/{bib_mms_id}/holdings/{holding_id}">
+    <holding_id>{holding_id}</holding_id>
+    <library desc="UMCP McKeldin Library">CPMCK</library>
+    <location desc="Top Textbook">TPTXB</location>
+  </holding>
+  <bib_data link="{base_url}/almaws/v1/bibs/{bib_mms_id}">
+    <mms_id>{bib_mms_id}</mms_id>
+  </bib_data>
+</holdings>
+"""
+
+
+def item(bib_mms_id, holding_id, n, base_url, rng):
+    in_place = rng.random() < 0.5
+    temp_location = rng.random() < 0.5
+    location, location_name = rng.choice(COLLECTIONS[:2])
+    holding_data = f"""
+      <holding_id>{holding_id}</holding_id>
+      <in_temp_location>{str(temp_location).lower()}</in_temp_location>"""
+    if temp_location:
+        holding_data += """
+      <temp_library desc="UMCP McKeldin Library">CPMCK</temp_library>
+      <temp_location desc="Top Textbook">TPTXB</temp_location>"""
+
+    return f"""
+  <item link="{base_url}/almaws/v1/bibs/{bib_mms_id}/holdings/{holding_id}/items/23{n:014d}">
+    <bib_data link="{base_url}/almaws/v1/bibs/{bib_mms_id}">
+      <mms_id>{bib_mms_id}</mms_id>
+    </bib_data>
+    <holding_data link="{base_url}/almaws/v1/bibs/{bib_mms_id}/holdings/{holding_id}">{holding_data}
+    </holding_data>
+    <item_data>
+      <pid>23{n:014d}</pid>
+      <barcode>3143{n:010d}</barcode>
+      <base_status desc="{'Item in place' if in_place else 'Item not in place'}">{int(in_place)}</base_status>
+      <awaiting_reshelving>false</awaiting_reshelving>
+      <library desc="UMCP McKeldin Library">CPMCK</library>
+      <location desc="{location_name}">{location}</location>
+      <due_date>2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T04:59:00Z</due_date>
+    </item_data>
+  </item>"""
+
+
+def items_response(bib_mms_id, holding_id, base_url, items=5, offset=0, total=None, seed=0):
+    """
+    Returns a Retrieve Items response with the given number of items, starting
+    at offset, out of total items (by default, items)
+    """
+    rng = _rng(seed, bib_mms_id, holding_id, offset)
+    total = items if total is None else total
+    body = ''.join(item(bib_mms_id, holding_id, int(bib_mms_id[2:10]) * 1000 + offset + n, base_url, rng)
+                   for n in range(items))
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<items total_record_count="{total}">{body}\n</items>\n')
+
+
+@click.command()
+@click.option('--bibs', 'bibs_sizes', multiple=True, type=int, default=[1, 10, 100, 1000], show_default=True,
+              help='Number of bibs in a Retrieve Bibs response, may be repeated.')
+@click.option('--items', 'items_sizes', multiple=True, type=int, default=[5, 100, 1000], show_default=True,
+              help='Number of items in a Retrieve Items response, may be repeated.')
+@click.option('--avas', default=3, show_default=True, help='AVA fields in each bib.')
+@click.option('--base-url', default='https://api-na.hosted.exlibrisgroup.com', show_default=True,
+              help='Base URL of the links in the responses.')
+@click.argument('directory', type=click.Path(file_okay=False))
+def main(bibs_sizes, items_sizes, avas, base_url, directory):
+    os.makedirs(directory, exist_ok=True)
+    for size in bibs_sizes:
+        with open(os.path.join(directory, f'bibs_{size}.xml'), 'w') as fh:
+            fh.write(bibs_response([mms_id(n) for n in range(size)], base_url, avas=avas))
+    for size in items_sizes:
+        bib_mms_id = mms_id(0)
+        with open(os.path.join(directory, f'items_{size}.xml'), 'w') as fh:
+            fh.write(items_response(bib_mms_id, holdings_id(bib_mms_id), base_url, items=size))
+    click.echo(f'Corpus written to {directory}')
+
+
+if __name__ == '__main__':
+    main()
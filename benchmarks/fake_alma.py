@@ -0,0 +1,108 @@
+"""
+A local stand-in for the Alma API, serving synthetic responses generated by
+:mod:`benchmarks.corpus` with a configurable latency and error rate.
+"""
+import random
+import re
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks import corpus
+
+HOLDINGS_PATH = re.compile(r'/almaws/v1/bibs/(\d+)/holdings/?$')
+ITEMS_PATH = re.compile(r'/almaws/v1/bibs/(\d+)/holdings/(\d+)/items/?$')
+BIBS_PATH = re.compile(r'/almaws/v1/bibs/?$')
+
+
+class FakeAlma:
+    """
+    Serves Retrieve Bibs, Retrieve Holdings and Retrieve Items requests on
+    127.0.0.1, counting the calls of each kind. Every response is delayed by
+    latency seconds plus up to jitter seconds, and fails with error_status
+    with probability error_rate.
+    """
+    def __init__(self, latency=0.02, jitter=0.01, error_rate=0.0, error_status=503, items=5, avas=2,
+                 unavailable=0.3, marc_fields=20, seed=0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.items = items
+        self.bib_options = {'avas': avas, 'unavailable': unavailable, 'marc_fields': marc_fields, 'seed': seed}
+        self.calls = {'bibs': 0, 'holdings': 0, 'items': 0, 'errors': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-alma', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls = dict.fromkeys(self.calls, 0)
+
+    def respond(self, path, query):
+        """
+        Returns the status and body of the response to a GET request
+        """
+        if match := ITEMS_PATH.match(path):
+            kind = 'items'
+            # Paged with limit and offset, as the Alma API does
+            offset = int(query.get('offset', ['0'])[0])
+            limit = min(int(query.get('limit', ['10'])[0]), 100)
+            body = partial(corpus.items_response, match[1], match[2], self.base_url,
+                           items=max(0, min(limit, self.items - offset)), offset=offset, total=self.items,
+                           seed=self.bib_options['seed'])
+        elif match := HOLDINGS_PATH.match(path):
+            kind = 'holdings'
+            body = partial(corpus.holdings_response, match[1], self.base_url)
+        elif BIBS_PATH.match(path):
+            kind = 'bibs'
+            mms_ids = [mms_id for mms_id in query.get('mms_id', [''])[0].split(',') if mms_id]
+            body = partial(corpus.bibs_response, mms_ids, self.base_url, **self.bib_options)
+        else:
+            return 404, '<web_service_result><errorsExist>true</errorsExist></web_service_result>'
+
+        with self._lock:
+            self.calls[kind] += 1
+            delay = self.latency + self._random.random() * self.jitter
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.calls['errors'] += 1
+
+        time.sleep(delay)
+        if failed:
+            return self.error_status, ''
+        return 200, body()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                status, body = fake.respond(parts.path, parse_qs(parts.query))
+                content = body.encode('UTF-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/xml;charset=UTF-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
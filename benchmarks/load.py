@@ -0,0 +1,275 @@
+"""
+Load test of the alma-service Flask application against a local stand-in for
+the Alma API (:class:`benchmarks.fake_alma.FakeAlma`).
+
+The application is served by waitress in this process, as alma-service
+does, and each endpoint is sent a fixed number of requests by a pool of
+concurrent clients. The results are printed and written to a JSON file so
+that runs can be compared, e.g.
+
+    python -m benchmarks.load --requests 1000 --concurrency 32 --output before.json
+"""
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import perf_counter
+
+import click
+import requests
+from waitress import wasyncore
+from waitress.server import create_server
+
+from alma.processor import AlmaServerGateway
+from alma.web import _create_app, get_config
+from benchmarks import corpus
+from benchmarks.fake_alma import FakeAlma
+
+ENDPOINTS = ['textbooks', 'equipment', 'holdings']
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the nearest-rank percentile of the sorted values
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, round(percent / 100 * len(sorted_values) + 0.5))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident set size of this process since it started, which
+    includes the application, the stand-in Alma API and the load generator
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """
+    Returns the current resident set size of this process, or None where it
+    cannot be read (it is read from /proc, on Linux)
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process every interval seconds
+    while in use, keeping the highest, so that the memory used while loading
+    one endpoint is not hidden by the high-water mark of an earlier one
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+
+    def _sample(self):
+        while True:
+            rss = current_rss_bytes()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.start = self.peak = current_rss_bytes()
+        if self.start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def stats(self):
+        return {'start': self.start, 'peak': self.peak}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def payloads(endpoint, count, mms_ids, per_request, rng):
+    """
+    Returns count request bodies for the endpoint, each for per_request MMS IDs
+    picked at random
+    """
+    for _ in range(count):
+        sample = rng.sample(mms_ids, per_request)
+        if endpoint == 'holdings':
+            yield {mms_id: corpus.holdings_id(mms_id) for mms_id in sample}
+        else:
+            yield sample
+
+
+def run_endpoint(base_url, endpoint, bodies, concurrency):
+    """
+    Posts every body to the endpoint from concurrency client threads, and
+    returns the latencies and status codes of the responses
+    """
+    url = f'{base_url}/alma-service/{endpoint}'
+    local = threading.local()
+
+    def post(body):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = perf_counter()
+        try:
+            status = session.post(url, json=body, timeout=120).status_code
+        except requests.RequestException:
+            status = None
+        return perf_counter() - start, status
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post, bodies))
+    return perf_counter() - start, results
+
+
+def summarize(elapsed, results, upstream_calls, rss):
+    latencies = sorted(latency for latency, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    return {
+        'requests': len(results),
+        'errors': sum(count for status, count in statuses.items() if status != '200'),
+        'statuses': statuses,
+        'elapsed_secs': round(elapsed, 3),
+        'requests_per_sec': round(len(results) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            'p50': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p95': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            'p99': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            'max': round(latencies[-1] * 1000, 2) if latencies else None,
+        },
+        'upstream_calls': upstream_calls,
+        # Of the whole process while this endpoint was loaded, or None if it
+        # cannot be sampled on this platform
+        'rss_bytes': rss.stats(),
+    }
+
+
+def stop_server(server, server_thread):
+    """
+    Stops the waitress server running in server_thread. Its sockets are closed
+    from its own loop, through its trigger, as closing them from another
+    thread while the loop is waiting on them fails with EBADF.
+    """
+    server.trigger.pull_trigger(lambda: wasyncore.close_all(server._map))
+    server_thread.join()
+    server.task_dispatcher.shutdown()
+
+
+def set_log_level(level):
+    for name, logger in logging.root.manager.loggerDict.items():
+        if isinstance(logger, logging.Logger) and name.split('.')[0] in ('alma', 'core'):
+            logger.setLevel(level)
+
+
+@click.command()
+@click.option('--endpoint', 'endpoints', multiple=True, type=click.Choice(ENDPOINTS), default=ENDPOINTS,
+              help='Endpoint to load, may be repeated. Default is all of them.')
+@click.option('--requests', 'request_count', default=200, show_default=True, help='Requests sent to each endpoint.')
+@click.option('--warmup', default=20, show_default=True, help='Requests sent before measuring each endpoint.')
+@click.option('--concurrency', default=16, show_default=True, help='Concurrent clients.')
+@click.option('--threads', default=16, show_default=True, help='waitress worker threads.')
+@click.option('--mms-ids', 'mms_id_count', default=1000, show_default=True, help='Number of distinct MMS IDs.')
+@click.option('--per-request', default=10, show_default=True, help='MMS IDs in each request.')
+@click.option('--avas', default=2, show_default=True, help='AVA fields in each bib.')
+@click.option('--marc-fields', default=20, show_default=True, help='Other MARC datafields in each bib.')
+@click.option('--items', default=5, show_default=True, help='Items in each Retrieve Items response.')
+@click.option('--unavailable', default=0.3, show_default=True, help='Share of unavailable AVA fields.')
+@click.option('--latency', default=0.02, show_default=True, help='Alma API latency, in seconds.')
+@click.option('--jitter', default=0.01, show_default=True, help='Random extra Alma API latency, in seconds.')
+@click.option('--error-rate', default=0.0, show_default=True, help='Share of Alma API calls that fail.')
+@click.option('--error-status', default=503, show_default=True, help='Status of the failed Alma API calls.')
+@click.option('--alma-config', 'alma_config_file', type=click.File(),
+              help='alma-service configuration to use; host and endpoint are replaced. '
+                   'Default is no caching and no retries.')
+@click.option('--seed', default=0, show_default=True, help='Seed for the generated data and requests.')
+@click.option('--log-level', default='WARNING', show_default=True, help='Log level of the application.')
+@click.option('--output', type=click.Path(dir_okay=False), default='benchmark_results.json', show_default=True,
+              help='File the results are written to.')
+def main(endpoints, request_count, warmup, concurrency, threads, mms_id_count, per_request, avas, marc_fields,
+         items, unavailable, latency, jitter, error_rate, error_status, alma_config_file, seed, log_level, output):
+    fake_alma = FakeAlma(latency=latency, jitter=jitter, error_rate=error_rate, error_status=error_status,
+                         items=items, avas=avas, unavailable=unavailable, marc_fields=marc_fields, seed=seed).start()
+
+    config = get_config(alma_config_file) if alma_config_file else {'http': {'retries': 0}}
+    config.pop('prefetch', None)
+    config |= {'host': fake_alma.base_url, 'endpoint': '/almaws/v1/bibs/'}
+    app = _create_app(AlmaServerGateway(config))
+    set_log_level(log_level.upper())
+
+    server = create_server(app, host='127.0.0.1', port=0, threads=threads)
+    base_url = f'http://127.0.0.1:{server.effective_port}'
+    server_thread = threading.Thread(target=server.run, name='waitress', daemon=True)
+    server_thread.start()
+
+    rng = random.Random(seed)
+    mms_ids = [corpus.mms_id(n) for n in range(mms_id_count)]
+    results = {}
+    try:
+        for endpoint in endpoints:
+            run_endpoint(base_url, endpoint, payloads(endpoint, warmup, mms_ids, per_request, rng), concurrency)
+            fake_alma.reset()
+            with RssSampler() as rss:
+                elapsed, responses = run_endpoint(base_url, endpoint,
+                                                  payloads(endpoint, request_count, mms_ids, per_request, rng),
+                                                  concurrency)
+            results[endpoint] = summarize(elapsed, responses, dict(fake_alma.calls), rss)
+
+            latencies = results[endpoint]['latency_ms']
+            click.echo(f"{endpoint}: {results[endpoint]['requests_per_sec']} req/s, p50 {latencies['p50']} ms, "
+                       f"p95 {latencies['p95']} ms, p99 {latencies['p99']} ms, "
+                       f"{results[endpoint]['errors']} errors, upstream calls {results[endpoint]['upstream_calls']}")
+    finally:
+        stop_server(server, server_thread)
+        fake_alma.stop()
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'options': {
+            'requests': request_count, 'warmup': warmup, 'concurrency': concurrency, 'threads': threads,
+            'mms_ids': mms_id_count, 'per_request': per_request, 'avas': avas, 'marc_fields': marc_fields,
+            'items': items, 'unavailable': unavailable, 'latency': latency, 'jitter': jitter,
+            'error_rate': error_rate, 'error_status': error_status, 'seed': seed,
+            'alma_config': alma_config_file.name if alma_config_file else None,
+        },
+        'results': results,
+        # High-water mark of the whole run, every endpoint included
+        'process_peak_rss_bytes': peak_rss_bytes(),
+    }
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    click.echo(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
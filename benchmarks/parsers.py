@@ -0,0 +1,169 @@
+"""
+Micro-benchmark of AlmaProcessor.parse_bibs and parse_holdings on responses
+generated by :mod:`benchmarks.corpus`, with the Alma API replaced by a stub,
+so that only the parsing is measured.
+
+Each case is timed for its operations per second, and run once more under
+tracemalloc for the peak memory allocated by a single operation. With
+--baseline, the results are compared against those saved by an earlier run
+with --save-baseline, and the run fails if any case is slower than the
+baseline by more than --threshold, e.g.
+
+    python -m benchmarks.parsers --save-baseline parser_baseline.json
+    python -m benchmarks.parsers --baseline parser_baseline.json --threshold 0.2
+
+The gate is run by hand, not in CI: the rates depend on the machine, so the
+baseline (parser_baseline.json, ignored by git) is saved from the unchanged
+code on the machine that then runs the comparison.
+"""
+import json
+import platform
+import statistics
+import tracemalloc
+from time import perf_counter
+
+import click
+
+from alma.processor import AlmaProcessor
+from benchmarks import corpus
+
+BASE_URL = 'https://api-na.hosted.exlibrisgroup.com'
+BIBS_SIZES = [1, 10, 100, 1000]
+ITEMS_SIZES = [5, 100, 1000]
+
+
+class StubServer:
+    """
+    Stands in for AlmaServerGateway, answering every holdings and items lookup
+    with pre-generated responses
+    """
+    def __init__(self, parser, items) -> None:
+        self.config = {'parser': parser}
+        self.items = items
+        self.responses = {}
+
+    def retrieveAdditional(self, url):
+        if url not in self.responses:
+            path = url[len(BASE_URL):].rstrip('/').split('/')
+            if path[-1] == 'items':
+                content = corpus.items_response(path[-4], path[-2], BASE_URL, items=self.items)
+            else:
+                content = corpus.holdings_response(path[-2], BASE_URL)
+            self.responses[url] = content.encode('UTF-8')
+        return self.responses[url]
+
+
+def cases(parser, avas, items):
+    """
+    Yields the name and operation of each case for the parser
+    """
+    for size in BIBS_SIZES:
+        mms_ids = [corpus.mms_id(n) for n in range(size)]
+        content = corpus.bibs_response(mms_ids, BASE_URL, avas=avas).encode('UTF-8')
+        processor = AlmaProcessor(StubServer(parser, items))
+        yield (f'{parser}/parse_bibs/{size}',
+               lambda processor=processor, content=content: processor.parse_bibs(content, 'TPTXB', False, False))
+        # Includes the due dates of the unavailable rows, from stubbed items lookups
+        yield (f'{parser}/parse_bibs_with_holdings/{size}',
+               lambda processor=processor, content=content: processor.parse_bibs(content, None, False, True))
+
+    for size in ITEMS_SIZES:
+        bib_mms_id = corpus.mms_id(0)
+        content = corpus.items_response(bib_mms_id, corpus.holdings_id(bib_mms_id), BASE_URL,
+                                        items=size).encode('UTF-8')
+        processor = AlmaProcessor(StubServer(parser, items))
+        yield (f'{parser}/parse_holdings/{size}',
+               lambda processor=processor, content=content: processor.parse_holdings(content))
+
+
+def measure(operation, min_time, repeat):
+    """
+    Returns the median operations per second over repeat runs of at least
+    min_time seconds each, and the peak bytes allocated by one operation
+    """
+    # Calibrate the number of operations in a run
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 10 else max(2, int(min_time / elapsed) + 1)
+
+    rates = [number / elapsed]
+    for _ in range(repeat - 1):
+        start = perf_counter()
+        for _ in range(number):
+            operation()
+        rates.append(number / (perf_counter() - start))
+
+    tracemalloc.start()
+    try:
+        operation()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return statistics.median(rates), peak_bytes
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns a description of each case that is slower than in the baseline by
+    more than threshold
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]['ops_per_sec']
+        change = result['ops_per_sec'] / expected - 1
+        result['change'] = round(change, 4)
+        if change < -threshold:
+            regressions.append(f'{name}: {result["ops_per_sec"]:.1f} ops/s, {change:+.1%} against {expected:.1f}')
+    return regressions
+
+
+@click.command()
+@click.option('--parser', 'parsers', multiple=True, type=click.Choice(['soup', 'lxml']), default=['soup', 'lxml'],
+              help='Parser to measure, may be repeated. Default is both.')
+@click.option('--avas', default=3, show_default=True, help='AVA fields in each bib.')
+@click.option('--items', default=20, show_default=True,
+              help='Items in each stubbed Retrieve Items response of the parse_bibs_with_holdings cases.')
+@click.option('--min-time', default=0.2, show_default=True, help='Minimum duration of each run, in seconds.')
+@click.option('--repeat', default=5, show_default=True, help='Runs of each case; the median rate is reported.')
+@click.option('--filter', 'name_filter', default='', help='Only run the cases whose name contains this.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Results to compare against.')
+@click.option('--threshold', default=0.2, show_default=True,
+              help='Largest slowdown against the baseline that is not a failure, as a fraction.')
+@click.option('--save-baseline', type=click.Path(dir_okay=False), help='File to save the results to.')
+def main(parsers, avas, items, min_time, repeat, name_filter, baseline, threshold, save_baseline):
+    results = {}
+    for parser in parsers:
+        for name, operation in cases(parser, avas, items):
+            if name_filter not in name:
+                continue
+            ops_per_sec, peak_bytes = measure(operation, min_time, repeat)
+            results[name] = {'ops_per_sec': round(ops_per_sec, 2), 'peak_bytes': peak_bytes}
+            click.echo(f'{name}: {ops_per_sec:,.1f} ops/s, {peak_bytes:,} bytes peak')
+
+    if save_baseline:
+        with open(save_baseline, 'w') as fh:
+            json.dump({'python': platform.python_version(), 'results': results}, fh, indent=2)
+        click.echo(f'Baseline saved to {save_baseline}')
+
+    if baseline:
+        with open(baseline) as fh:
+            regressions = compare(results, json.load(fh)['results'], threshold)
+        if regressions:
+            click.echo(f'Slower than the baseline by more than {threshold:.0%}:', err=True)
+            for regression in regressions:
+                click.echo(f'  {regression}', err=True)
+            raise SystemExit(1)
+        click.echo(f'No case is slower than the baseline by more than {threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
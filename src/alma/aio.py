@@ -0,0 +1,352 @@
+import asyncio
+
+from core.gateway import AsyncHttpGateway
+from core.logging import create_logger
+from core.singleflight import AsyncSingleFlight
+from core.tracing import current_span, span, traced
+from werkzeug.exceptions import HTTPException
+
+from alma.batching import AsyncBibsBatcher, AsyncSharedRecords
+from alma.metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS
+from alma.parsers import BibsPullParser, merge_records, returned_mms_ids
+from alma.processor import AlmaProcessor, AlmaServerGateway, BibsStream
+
+logger = create_logger(__name__)
+
+
+async def _gather_in_order(tasks):
+    """
+    Waits for all the tasks, then raises the exception of the first failed
+    task in list order, as the equivalent serial loop would have.
+    """
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+class AsyncAlmaProcessor(AlmaProcessor):
+    """
+    asyncio version of :class:`AlmaProcessor` for use with an
+    :class:`AsyncAlmaServerGateway`. Validation, caching, parsing and the
+    assembly of the response are shared with the synchronous processor; only
+    the Alma lookups are awaited instead of being run in a thread pool.
+    """
+    def __init__(self, server) -> None:
+        super().__init__(server)
+        self.revalidating_tasks = set()
+
+    @traced('processBatch')
+    async def processBatch(self, data):
+        queries = self.validate_batch(data)
+        current_span().set(queries=len(queries))
+
+        shared = AsyncSharedRecords(self.fetch_records)
+        names = list(queries)
+        results = await asyncio.gather(*(self.process_query(queries[name]['query'], queries[name]['data'], shared)
+                                         for name in names), return_exceptions=True)
+
+        response_data = {}
+        for name, result in zip(names, results):
+            if isinstance(result, HTTPException):
+                response_data[name] = self.query_error(name, result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                response_data[name] = self.query_result(result)
+        return response_data
+
+    async def process_query(self, query, data, shared):
+        if query == 'holdings':
+            return await self.processHoldings(data)
+        return await self.processBibs(data, shared=shared, **self.BIBS_QUERIES[query])
+
+    @traced('processBibs')
+    async def processBibs(self, data, limit_collection=None, include_course=False, check_holdings=False,
+                          shared=None):
+        mms_ids = self.validate_bibs(data)
+        current_span().set(mms_ids=len(mms_ids))
+
+        options = (limit_collection, include_course, check_holdings)
+        bibs_data, misses, not_found = self.known_bibs(mms_ids, options)
+
+        unavailable = set()
+        if misses or not mms_ids:
+            try:
+                fresh_data, missing = await self.retrieve_bibs(misses, options, shared)
+                not_found |= missing
+            except HTTPException as e:
+                fresh_data = self.fallback_bibs(misses, options, e)
+                unavailable = misses - fresh_data.keys()
+            bibs_data |= fresh_data
+
+        return self.combine_bibs(bibs_data, not_found, unavailable)
+
+    def create_batcher(self, batching_config):
+        if not batching_config:
+            return None
+        return AsyncBibsBatcher(self.retrieve_records, **batching_config)
+
+    async def retrieve_bibs(self, mms_ids, options, shared=None):
+        if shared is not None and mms_ids:
+            records = await shared.submit(mms_ids)
+        else:
+            records = await self.fetch_records(mms_ids)
+        bibs_data = await self.bibs_from_records(records, *options)
+        self.cache_bibs(bibs_data, options)
+        missing = set(mms_ids) - returned_mms_ids(records)
+        self.cache_not_found(missing)
+        return bibs_data, missing
+
+    def revalidate(self, mms_ids, options):
+        keys = {(mms_id,) + options for mms_id in mms_ids} - self.revalidating
+        if keys:
+            self.revalidating |= keys
+            # Referenced from revalidating_tasks until done so that it is not garbage collected
+            task = asyncio.ensure_future(self._revalidate(keys, options))
+            self.revalidating_tasks.add(task)
+            task.add_done_callback(self.revalidating_tasks.discard)
+
+    async def _revalidate(self, keys, options):
+        try:
+            await self.retrieve_bibs([key[0] for key in keys], options)
+        except HTTPException as e:
+            logger.warning(f'Failed to revalidate {len(keys)} MMS IDs: {e.description}')
+        except Exception:
+            logger.exception(f'Failed to revalidate {len(keys)} MMS IDs')
+        finally:
+            self.revalidating -= keys
+
+    async def parse_bibs(self, content, limit_collection, include_course, check_holdings):
+        response_data = {}
+        bibs_data = await self.parse_bibs_by_id(content, limit_collection, include_course, check_holdings)
+        for entries in bibs_data.values():
+            response_data.update(entries)
+
+        return response_data
+
+    async def fetch_records(self, mms_ids):
+        if self.batcher is not None and mms_ids:
+            return await self.batcher.submit(mms_ids)
+        return await self.retrieve_records(mms_ids)
+
+    async def retrieve_records(self, mms_ids):
+        if self.stream_parsing:
+            return await self.queryRecords(mms_ids)
+        return self.parse_records(await self.queryServer(mms_ids))
+
+    async def parse_bibs_by_id(self, content, limit_collection, include_course, check_holdings):
+        return await self.bibs_from_records(self.parse_records(content), limit_collection, include_course,
+                                            check_holdings)
+
+    async def bibs_from_records(self, records, limit_collection, include_course, check_holdings):
+        items_tasks = {}
+        if check_holdings:
+            items_tasks = {holdings_url: asyncio.ensure_future(self.getItems(holdings_url))
+                           for holdings_url in self.items_needed(records, limit_collection)}
+            try:
+                await _gather_in_order(items_tasks.values())
+            except BaseException:
+                for task in items_tasks.values():
+                    task.cancel()
+                raise
+
+        # The tasks are done, so assemble_bibs can read them like futures
+        with span('assemble_bibs'):
+            return self.assemble_bibs(records, items_tasks, limit_collection, include_course, check_holdings)
+
+    async def iter_bibs(self, records, limit_collection, include_course, check_holdings):
+        items_tasks = {}
+        if check_holdings:
+            items_tasks = {holdings_url: asyncio.ensure_future(self.getItems(holdings_url))
+                           for holdings_url in self.items_needed(records, limit_collection)}
+
+        try:
+            waiting = {}
+            for record in records:
+                if record.holdings_url in items_tasks:
+                    waiting.setdefault(items_tasks[record.holdings_url], []).append(record)
+            ready = [record for record in records if record.holdings_url not in items_tasks]
+
+            with span('assemble_bibs'):
+                bibs_data = self.assemble_bibs(ready, items_tasks, limit_collection, include_course, check_holdings)
+            for mms_id, entries in bibs_data.items():
+                yield mms_id, entries
+
+            pending = set(waiting)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    with span('assemble_bibs'):
+                        bibs_data = self.assemble_bibs(waiting[task], items_tasks, limit_collection, include_course,
+                                                       check_holdings)
+                    for mms_id, entries in bibs_data.items():
+                        yield mms_id, entries
+        finally:
+            for task in items_tasks.values():
+                task.cancel()
+
+    @traced('streamBibs')
+    async def streamBibs(self, data, limit_collection=None, include_course=False, check_holdings=False):
+        mms_ids = self.validate_bibs(data)
+        current_span().set(mms_ids=len(mms_ids))
+
+        options = (limit_collection, include_course, check_holdings)
+        bibs_data, misses, not_found = self.known_bibs(mms_ids, options)
+
+        records = []
+        unavailable = set()
+        if misses or not mms_ids:
+            try:
+                records = await self.fetch_records(misses)
+            except HTTPException as e:
+                fallback = self.fallback_bibs(misses, options, e)
+                bibs_data |= fallback
+                unavailable = misses - fallback.keys()
+            else:
+                missing = misses - returned_mms_ids(records)
+                self.cache_not_found(missing)
+                not_found |= missing
+
+        self.log_missing(not_found, unavailable)
+
+        return BibsStream(self.stream_entries(bibs_data, records, options), not_found, unavailable)
+
+    async def stream_entries(self, bibs_data, records, options):
+        for mms_id in sorted(bibs_data):
+            for key, entry in bibs_data[mms_id].items():
+                yield key, entry
+
+        async for mms_id, entries in self.iter_bibs(records, *options):
+            self.cache_bibs({mms_id: entries}, options)
+            for key, entry in entries.items():
+                yield key, entry
+
+    @traced('processHoldings')
+    async def processHoldings(self, data):
+        holdings = self.validate_holdings(data)
+        current_span().set(pairs=len(holdings))
+
+        async def retrieve(mms_id, holdings_id):
+            holdings_raw = await self.getHoldings(mms_id, holdings_id)
+            return self.parse_holdings(holdings_raw)
+
+        pairs = list(holdings.items())
+        results = await asyncio.gather(*(retrieve(*pair) for pair in pairs), return_exceptions=True)
+
+        if self.parallel_holdings:
+            for result in results:
+                if isinstance(result, BaseException) and not isinstance(result, HTTPException):
+                    raise result
+            return self.combine_holdings(holdings, dict(zip(pairs, results)))
+
+        response_data = {}
+        for (mms_id, holdings_id), result in zip(pairs, results):
+            if isinstance(result, BaseException):
+                raise result
+            self.add_holdings(response_data, mms_id, holdings_id, result)
+
+        return response_data
+
+    @traced('queryServer')
+    async def queryServer(self, mms_ids):
+        current_span().set(mms_ids=len(mms_ids))
+        return await self.server.retrieveBibs(mms_ids)
+
+    @traced('queryRecords')
+    async def queryRecords(self, mms_ids):
+        current_span().set(mms_ids=len(mms_ids))
+        return await self.server.retrieveBibRecords(mms_ids)
+
+    async def getHoldings(self, mms_id, holdings_id):
+        return await self.server.retrieveHoldings(mms_id, holdings_id)
+
+    @traced('getItems')
+    async def getItems(self, holdings_url):
+        logger.debug(holdings_url)
+        holdings_info = await self.getAdditional(holdings_url)
+        return await self.getAdditional(self.items_url(holdings_info))
+
+    async def getAdditional(self, url):
+        return await self.server.retrieveAdditional(url)
+
+
+class AsyncAlmaServerGateway(AlmaServerGateway):
+    """
+    asyncio version of :class:`AlmaServerGateway`, making its requests through
+    an :class:`AsyncHttpGateway`. Configuration and the response cache are
+    shared with the synchronous gateway.
+    """
+    def __init__(self, config, transport=None) -> None:
+        super().__init__(config)
+        self.http = AsyncHttpGateway(rate_limiter=self.rate_limiter, transport=transport,
+                                     **config.get('http', {}))
+        self.single_flight = AsyncSingleFlight()
+
+    async def aclose(self):
+        self.executor.shutdown()
+        await self.http.aclose()
+
+    async def get(self, kind, url, params, new_parser=None):
+        key = self.cache_key(url, params, new_parser)
+        ttl = self.cache_ttl(kind)
+        if ttl:
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        async def fetch():
+            try:
+                with UPSTREAM_SECONDS.time(kind):
+                    if new_parser is None:
+                        content = await self.http.get(url, params)
+                        size = len(content)
+                    else:
+                        content, size = await self.http.get_parsed(url, params, new_parser())
+            except HTTPException as e:
+                UPSTREAM_ERRORS.inc(kind, e.code)
+                raise
+            if ttl:
+                self.cache.set(key, content, ttl, size)
+            return content
+
+        return await self.single_flight.do(key, fetch)
+
+    async def retrieveBibs(self, mms_ids):
+        chunks = self.bibs_chunks(mms_ids)
+        contents = await _gather_in_order([self.retrieveBibsChunk(chunk) for chunk in chunks])
+
+        if len(contents) == 1:
+            return contents[0]
+        return self.merge_bibs(contents)
+
+    async def retrieveBibsChunk(self, mms_ids):
+        return await self.get('bibs', *self.bibs_request(mms_ids))
+
+    async def retrieveBibRecords(self, mms_ids):
+        chunks = self.bibs_chunks(mms_ids)
+        results = await _gather_in_order([self.retrieveBibRecordsChunk(chunk) for chunk in chunks])
+        return merge_records(results)
+
+    async def retrieveBibRecordsChunk(self, mms_ids):
+        return await self.get('bibs', *self.bibs_request(mms_ids), new_parser=BibsPullParser)
+
+    async def retrieveItems(self, url, params):
+        first_page = await self.get('items', url, params | self.page_params(0))
+        offsets = self.page_offsets(first_page)
+        if not offsets:
+            return first_page
+
+        pages = await _gather_in_order([self.get('items', url, params | self.page_params(offset))
+                                        for offset in offsets])
+        return self.merge_items([first_page] + pages)
+
+    async def retrieveHoldings(self, mms_id, holdings_id):
+        return await self.retrieveItems(*self.holdings_request(mms_id, holdings_id))
+
+    async def retrieveAdditional(self, url):
+        kind, url, params = self.additional_request(url)
+        if kind == 'items':
+            return await self.retrieveItems(url, params)
+        return await self.get(kind, url, params)
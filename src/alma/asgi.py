@@ -0,0 +1,203 @@
+import inspect
+import json
+from os import environ
+from typing import NamedTuple, Optional, TextIO
+
+from core.logging import create_logger
+from core.web_errors import ERROR_NAMES, error_body
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError, MethodNotAllowed, NotFound
+
+from alma import __version__
+from alma.aio import AsyncAlmaProcessor, AsyncAlmaServerGateway
+from alma.processor import BibsStream
+from alma.routes import (NDJSON, ROUTES, RequestMonitor, TextResponse, authorize, request_data, result_headers,
+                         stream_error, wants_ndjson)
+from alma.web import get_config
+
+logger = create_logger(__name__)
+
+
+def app(config: Optional[str | TextIO] = None):
+    server = AsyncAlmaServerGateway(config=get_config(config))
+    return _create_app(server)
+
+
+def _dumps(data):
+    # Serialised the way Flask's default JSON provider does in production
+    return json.dumps(data, default=DefaultJSONProvider.default, ensure_ascii=True, sort_keys=True,
+                      separators=(',', ':')) + '\n'
+
+
+def _is_json(headers):
+    content_type = headers.get(b'content-type', b'').decode('latin-1')
+    mimetype = content_type.split(';')[0].strip().lower()
+    return mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+
+def _header(headers, name):
+    value = headers.get(name)
+    return value.decode('latin-1') if value is not None else None
+
+
+def _error_response(e: HTTPException):
+    """
+    Returns the status, headers and body of the response to an error, as the
+    Flask application answers it: the errors in core.web_errors with a JSON
+    body, and any other with the default werkzeug response
+    """
+    if e.code in ERROR_NAMES:
+        return e.code, [('Content-Type', 'application/json')], _dumps(error_body(e)).encode('UTF-8')
+    return e.code, e.get_headers(), e.get_body().encode('UTF-8')
+
+
+class _Options(NamedTuple):
+    """
+    The response to an OPTIONS request
+    """
+    methods: list[str]
+
+
+def _create_app(server: Optional[AsyncAlmaServerGateway] = None):
+    """
+    Returns an ASGI application serving the routes of :mod:`alma.routes`, as
+    :func:`alma.web._create_app` does, with the Alma lookups made
+    asynchronously so that waiting on Alma does not hold a thread.
+    """
+    logger.info(f'Starting alma-service/{__version__} (ASGI)')
+
+    processor = AsyncAlmaProcessor(server)
+
+    tracing_config = processor.config.get('tracing') or {}
+    tracing_enabled = bool(tracing_config.get('enabled', False))
+    server_timing = bool(tracing_config.get('server_timing', False))
+
+    invalidate_token = environ.get('INVALIDATE_TOKEN')
+
+    routes = {route.path: route for route in ROUTES}
+
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+
+    async def handle(scope, receive, headers):
+        route = routes.get(scope['path'])
+        if route is None:
+            raise NotFound()
+
+        # As in Flask, HEAD is answered like GET, and OPTIONS with the allowed methods
+        methods = set(route.methods) | ({'HEAD'} if 'GET' in route.methods else set()) | {'OPTIONS'}
+        if scope['method'] not in methods:
+            raise MethodNotAllowed(valid_methods=sorted(methods))
+        if scope['method'] == 'OPTIONS':
+            return _Options(sorted(methods))
+
+        authorize(route, _header(headers, b'authorization'), invalidate_token)
+
+        body = await read_body(receive)
+
+        def get_json(silent):
+            if not _is_json(headers):
+                return None
+            try:
+                return json.loads(body)
+            except ValueError:
+                if silent:
+                    return None
+                # Flask only includes the decoding error in debug mode
+                raise BadRequest()
+
+        requestData = request_data(route, _is_json(headers), get_json)
+
+        handler = route.handler
+        if route.stream_handler is not None and wants_ndjson(_header(headers, b'accept')):
+            handler = route.stream_handler
+        responseData = handler(processor, requestData)
+        if inspect.isawaitable(responseData):
+            responseData = await responseData
+        return responseData
+
+    async def send_stream(send, stream):
+        """
+        Sends each keyed entry of the stream as a line of JSON as soon as it is
+        generated. An error once the response has started is sent as a last
+        line with an "error" key.
+        """
+        try:
+            async for key, entry in stream.entries:
+                await send({'type': 'http.response.body', 'body': _dumps({key: entry}).encode('UTF-8'),
+                            'more_body': True})
+        except HTTPException as e:
+            await send({'type': 'http.response.body', 'body': _dumps(stream_error(e)).encode('UTF-8'),
+                        'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if server is not None:
+                    await server.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def asgi_app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+
+        if scope['type'] != 'http':
+            return
+
+        headers = dict(scope['headers'])
+        route = scope['path'] if scope['path'] in routes else 'unmatched'
+        monitor = RequestMonitor(route, scope['method'], _header(headers, b'x-request-id'), tracing_enabled)
+        try:
+            body = None
+            try:
+                responseData = await handle(scope, receive, headers)
+            except HTTPException as e:
+                status, response_headers, body = _error_response(e)
+            except Exception:
+                logger.exception('Unhandled error processing request')
+                status, response_headers, body = _error_response(InternalServerError())
+            else:
+                status = 200
+                response_headers = list(result_headers(responseData).items())
+                if isinstance(responseData, _Options):
+                    response_headers += [('Allow', ', '.join(responseData.methods)),
+                                         ('Content-Type', 'text/html; charset=utf-8')]
+                    body = b''
+                elif isinstance(responseData, BibsStream):
+                    response_headers.append(('Content-Type', NDJSON))
+                elif isinstance(responseData, TextResponse):
+                    response_headers.append(('Content-Type', responseData.content_type))
+                    body = responseData.text.encode('UTF-8')
+                else:
+                    response_headers.append(('Content-Type', 'application/json'))
+                    body = _dumps(responseData).encode('UTF-8')
+
+            if body is not None:
+                response_headers.append(('Content-Length', str(len(body))))
+            monitor.record(status)
+            response_headers += monitor.headers(status, server_timing).items()
+
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response_headers],
+            })
+            if body is None:
+                await send_stream(send, responseData)
+            else:
+                await send({'type': 'http.response.body', 'body': body if scope['method'] != 'HEAD' else b''})
+        finally:
+            monitor.end()
+
+    return asgi_app
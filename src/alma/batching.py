@@ -0,0 +1,174 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from core.logging import create_logger
+
+from alma.metrics import BATCH_CALLERS, BATCH_SIZE
+from alma.parsers import merge_records, select_records
+
+logger = create_logger(__name__)
+
+
+class Batch:
+    """
+    The MMS IDs of the callers that joined a batch before it was sent
+    """
+    def __init__(self, result) -> None:
+        self.mms_ids = set()
+        self.callers = 0
+        self.result = result
+
+
+class BibsBatcher:
+    """
+    Combines the bib lookups of concurrent callers into one call. The first
+    caller waits up to window seconds for others to join, then calls fetch
+    with the union of their MMS IDs. A batch is sent as soon as it reaches
+    max_batch_size MMS IDs, and callers that would take it over that size
+    start a new batch. Each caller receives the records of its own MMS IDs.
+    """
+    def __init__(self, fetch, window=0.005, max_batch_size=100) -> None:
+        self.fetch = fetch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.callers = 0
+        self._pending = None
+        self._full = None
+        self._lock = threading.Lock()
+
+    def submit(self, mms_ids):
+        mms_ids = set(mms_ids)
+        if len(mms_ids) >= self.max_batch_size:
+            return self.fetch(mms_ids)
+
+        with self._lock:
+            self.callers += 1
+            batch = self._pending
+            leader = batch is None or len(batch.mms_ids | mms_ids) > self.max_batch_size
+            if leader:
+                batch = self._pending = Batch(Future())
+                full = self._full = threading.Event()
+            batch.mms_ids |= mms_ids
+            batch.callers += 1
+            if len(batch.mms_ids) >= self.max_batch_size:
+                self._full.set()
+
+        if leader:
+            full.wait(self.window)
+            self._close(batch)
+            try:
+                batch.result.set_result(self.fetch(batch.mms_ids))
+            except BaseException as e:
+                batch.result.set_exception(e)
+
+        return select_records(batch.result.result(), mms_ids)
+
+    def _close(self, batch):
+        with self._lock:
+            if self._pending is batch:
+                self._pending = None
+            self.batches += 1
+        BATCH_SIZE.observe(len(batch.mms_ids))
+        BATCH_CALLERS.observe(batch.callers)
+        logger.debug(f'Sending a batch of {len(batch.mms_ids)} MMS IDs for {batch.callers} requests')
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'callers': self.callers,
+            'window': self.window,
+            'max_batch_size': self.max_batch_size,
+        }
+
+
+class AsyncBibsBatcher(BibsBatcher):
+    """
+    asyncio counterpart of :class:`BibsBatcher`, for callers on one event
+    loop, where fetch is a coroutine function
+    """
+    async def submit(self, mms_ids):
+        mms_ids = set(mms_ids)
+        if len(mms_ids) >= self.max_batch_size:
+            return await self.fetch(mms_ids)
+
+        self.callers += 1
+        batch = self._pending
+        leader = batch is None or len(batch.mms_ids | mms_ids) > self.max_batch_size
+        if leader:
+            batch = self._pending = Batch(asyncio.get_running_loop().create_future())
+            full = self._full = asyncio.Event()
+        batch.mms_ids |= mms_ids
+        batch.callers += 1
+        if len(batch.mms_ids) >= self.max_batch_size:
+            self._full.set()
+
+        if leader:
+            try:
+                await asyncio.wait_for(full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._close(batch)
+            try:
+                batch.result.set_result(await self.fetch(batch.mms_ids))
+            except BaseException as e:
+                batch.result.set_exception(e)
+
+        # Shielded so that one cancelled caller does not cancel the batch for the others
+        return select_records(await asyncio.shield(batch.result), mms_ids)
+
+
+class SharedRecords:
+    """
+    Shares the bib records retrieved for the sub-queries of one request, so
+    that an MMS ID in more than one sub-query is only retrieved once. The
+    first sub-query to need an MMS ID retrieves it, along with its other new
+    MMS IDs, and the others wait for that lookup.
+    """
+    def __init__(self, fetch) -> None:
+        self.fetch = fetch
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def submit(self, mms_ids):
+        mms_ids = set(mms_ids)
+        with self._lock:
+            new_ids = mms_ids - self._lookups.keys()
+            new_lookup = Future()
+            for mms_id in new_ids:
+                self._lookups[mms_id] = new_lookup
+            lookups = {self._lookups[mms_id] for mms_id in mms_ids}
+
+        if new_ids:
+            try:
+                new_lookup.set_result(self.fetch(new_ids))
+            except BaseException as e:
+                new_lookup.set_exception(e)
+
+        return merge_records([select_records(lookup.result(), mms_ids) for lookup in lookups])
+
+
+class AsyncSharedRecords(SharedRecords):
+    """
+    asyncio counterpart of :class:`SharedRecords`, where fetch is a coroutine
+    function
+    """
+    async def submit(self, mms_ids):
+        mms_ids = set(mms_ids)
+        new_ids = mms_ids - self._lookups.keys()
+        new_lookup = asyncio.get_running_loop().create_future()
+        for mms_id in new_ids:
+            self._lookups[mms_id] = new_lookup
+        lookups = {self._lookups[mms_id] for mms_id in mms_ids}
+
+        if new_ids:
+            try:
+                new_lookup.set_result(await self.fetch(new_ids))
+            except BaseException as e:
+                new_lookup.set_exception(e)
+
+        record_lists = []
+        for lookup in lookups:
+            record_lists.append(select_records(await asyncio.shield(lookup), mms_ids))
+        return merge_records(record_lists)
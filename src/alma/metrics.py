@@ -0,0 +1,73 @@
+from core.metrics import Counter, Gauge, Histogram, render
+
+# Recorded as requests are processed; shared by every app in the process
+REQUEST_SECONDS = Histogram('alma_service_request_seconds', 'Time taken to answer a request, by route', ['route'])
+REQUESTS_IN_FLIGHT = Gauge('alma_service_requests_in_flight', 'Requests being answered')
+REQUEST_ERRORS = Counter('alma_service_request_errors_total', 'Error responses, by route and status',
+                         ['route', 'status'])
+UPSTREAM_SECONDS = Histogram('alma_upstream_request_seconds', 'Time taken by Alma API calls, by kind of lookup',
+                             ['kind'])
+UPSTREAM_ERRORS = Counter('alma_upstream_errors_total', 'Failed Alma API calls, by kind of lookup and status',
+                          ['kind', 'status'])
+PARSE_SECONDS = Histogram('alma_parse_seconds', 'Time taken to parse Alma API responses, by kind of response',
+                          ['kind'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+BATCH_SIZE = Histogram('alma_bibs_batch_size', 'MMS IDs in each batched Retrieve Bibs lookup',
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+BATCH_CALLERS = Histogram('alma_bibs_batch_requests', 'Requests answered by each batched Retrieve Bibs lookup',
+                          buckets=(1, 2, 3, 5, 10, 20, 50))
+
+METRICS = [REQUEST_SECONDS, REQUESTS_IN_FLIGHT, REQUEST_ERRORS, UPSTREAM_SECONDS, UPSTREAM_ERRORS, PARSE_SECONDS,
+           BATCH_SIZE, BATCH_CALLERS]
+
+
+def stats_metrics(stats):
+    """
+    Returns metrics for the counters kept by the processor and its gateway,
+    as reported by :meth:`alma.processor.AlmaProcessor.stats`
+    """
+    cache_hits = Counter('alma_cache_hits_total', 'Cache hits, by cache', ['cache'])
+    cache_misses = Counter('alma_cache_misses_total', 'Cache misses, by cache', ['cache'])
+    cache_entries = Gauge('alma_cache_entries', 'Entries in the cache, by cache', ['cache'])
+    for cache in ['cache', 'results', 'not_found']:
+        if stats.get(cache) is not None:
+            cache_hits.inc(cache, amount=stats[cache]['hits'])
+            cache_misses.inc(cache, amount=stats[cache]['misses'])
+            cache_entries.set(stats[cache]['entries'], cache)
+    if stats.get('results') is not None:
+        cache_hits.inc('stale_results', amount=stats['results']['stale_hits'])
+    metrics = [cache_hits, cache_misses, cache_entries]
+
+    if 'single_flight' in stats:
+        coalesced = Counter('alma_coalesced_calls_total', 'Alma API calls answered by an identical call in flight')
+        coalesced.inc(amount=stats['single_flight']['coalesced'])
+        metrics.append(coalesced)
+
+    http = stats.get('http')
+    if http is not None:
+        breaker = http['circuit_breaker']
+        state = Gauge('alma_circuit_breaker_state', 'Current state of the Alma API circuit breaker', ['state'])
+        transitions = Counter('alma_circuit_breaker_transitions_total',
+                              'Alma API circuit breaker state changes, by new state', ['state'])
+        for name, count in breaker['transitions'].items():
+            state.set(int(name == breaker['state']), name)
+            transitions.inc(name, amount=count)
+        rejected = Counter('alma_upstream_rejected_total', 'Alma API calls not made, by reason', ['reason'])
+        rejected.inc('circuit_breaker', amount=breaker['rejected'])
+        rejected.inc('concurrency', amount=http['concurrency']['rejected'])
+        limit = Gauge('alma_upstream_concurrency_limit', 'Current limit on concurrent Alma API calls')
+        limit.set(http['concurrency']['limit'])
+        in_flight = Gauge('alma_upstream_requests_in_flight', 'Alma API calls in flight')
+        in_flight.set(http['concurrency']['in_flight'])
+        metrics += [state, transitions, rejected, limit, in_flight]
+
+    rate_limit = stats.get('rate_limit')
+    if rate_limit is not None and rate_limit['remaining_today'] is not None:
+        remaining = Gauge('alma_rate_limit_remaining_today', 'Alma API calls left in the daily budget')
+        remaining.set(rate_limit['remaining_today'])
+        metrics.append(remaining)
+
+    return metrics
+
+
+def render_metrics(stats):
+    return render(METRICS + stats_metrics(stats))
@@ -0,0 +1,258 @@
+from collections import namedtuple
+from io import BytesIO
+
+from bs4 import BeautifulSoup
+from core.logging import create_logger
+from lxml import etree
+
+logger = create_logger(__name__)
+
+# A <bib> from a Retrieve Bibs response, reduced to the fields used by
+# AlmaProcessor. Each AVA datafield is a dict of subfield code to text, keeping
+# the first subfield for each code.
+BibRecord = namedtuple('BibRecord', ['mms_id', 'holdings_url', 'title', 'avas'])
+
+# An <item> from a Retrieve Items response. top_textbook is True when the
+# holding's temporary location, or failing that the item's location, is the
+# Top Textbook (TPTXB) collection. count is the "Item in place" base status.
+ItemRecord = namedtuple('ItemRecord', ['barcode', 'top_textbook', 'reshelving', 'count'])
+
+
+class BibRecords(list):
+    """
+    The bib records of Retrieve Bibs responses, with the MMS IDs of every <bib>
+    the responses held, including those left out for lacking a field, so that
+    these are not taken for MMS IDs that Alma did not return
+    """
+    def __init__(self, records=(), returned=None) -> None:
+        super().__init__(records)
+        self.returned = set(returned) if returned is not None else {record.mms_id for record in self}
+
+
+def returned_mms_ids(records):
+    """
+    Returns the MMS IDs of every <bib> returned for the records
+    """
+    return records.returned if isinstance(records, BibRecords) else {record.mms_id for record in records}
+
+
+def select_records(records, mms_ids):
+    """
+    Returns the records, and returned MMS IDs, of the given MMS IDs
+    """
+    return BibRecords([record for record in records if record.mms_id in mms_ids],
+                      returned_mms_ids(records) & set(mms_ids))
+
+
+def merge_records(record_lists):
+    """
+    Returns the records of each list, in order, and all their returned MMS IDs
+    """
+    return BibRecords([record for records in record_lists for record in records],
+                      set().union(*(returned_mms_ids(records) for records in record_lists)))
+
+
+def soup_bibs(content, returned=None):
+    """
+    Extracts the bib records by building a BeautifulSoup tree of the whole
+    response. The MMS ID of every <bib> is added to returned, if given, even
+    when the bib is left out for lacking another field.
+    """
+    soup = BeautifulSoup(content, features='xml')
+
+    for bib in soup.find_all('bib'):
+        mms_id = bib.find('mms_id')
+        if returned is not None and mms_id is not None:
+            returned.add(mms_id.text)
+        try:
+            avas = bib.find_all('datafield', attrs={'tag': 'AVA'})
+            holdings_url = bib.find('holdings')['link']
+            title = bib.find('title').text
+            mms_id = bib.find('mms_id').text
+        except (AttributeError, KeyError, TypeError):
+            logger.warning('No AVA found for content ')
+            continue
+
+        subfields = []
+        for ava in avas:
+            codes = {}
+            for subfield in ava.find_all('subfield'):
+                codes.setdefault(subfield.get('code'), subfield.text)
+            subfields.append(codes)
+
+        yield BibRecord(mms_id, holdings_url, title, subfields)
+
+
+def _first(element, tag):
+    return next(element.iter(tag), None)
+
+
+def lxml_bibs(content, returned=None):
+    """
+    Extracts the bib records with lxml's iterparse, walking each <bib> once
+    and clearing it as soon as it has been read, so that the whole response
+    is never held as a tree. Same as :func:`soup_bibs` for returned.
+    """
+    if isinstance(content, str):
+        content = content.encode('UTF-8')
+
+    for _, bib in etree.iterparse(BytesIO(content), events=('end',), tag='bib', recover=True):
+        record = _bib_record(bib, returned)
+        if record is not None:
+            yield record
+        _free(bib)
+
+
+def _bib_record(bib, returned=None):
+    """
+    Returns the record of a parsed <bib> element, or None if it lacks a field,
+    adding its MMS ID to returned, if given, either way
+    """
+    holdings = _first(bib, 'holdings')
+    title = _first(bib, 'title')
+    mms_id = _first(bib, 'mms_id')
+
+    if returned is not None and mms_id is not None:
+        returned.add(mms_id.text or '')
+
+    if holdings is None or holdings.get('link') is None or title is None or mms_id is None:
+        logger.warning('No AVA found for content ')
+        return None
+
+    subfields = []
+    for datafield in bib.iter('datafield'):
+        if datafield.get('tag') != 'AVA':
+            continue
+        codes = {}
+        for subfield in datafield.iter('subfield'):
+            codes.setdefault(subfield.get('code'), subfield.text or '')
+        subfields.append(codes)
+
+    return BibRecord(mms_id.text or '', holdings.get('link'), title.text or '', subfields)
+
+
+def _free(element):
+    # Free the element and any earlier siblings kept alive by the root
+    element.clear(keep_tail=True)
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+class BibsPullParser:
+    """
+    Incremental counterpart of :func:`lxml_bibs`, fed a Retrieve Bibs response
+    in chunks as it is received, e.g. by :meth:`core.gateway.HttpGateway.get_parsed`.
+    Each <bib> is turned into a record as soon as its end tag has been fed, and
+    :meth:`close` returns the :class:`BibRecords`.
+    """
+    def __init__(self) -> None:
+        self.records = []
+        self.returned = set()
+        self._parser = etree.XMLPullParser(events=('end',), tag='bib', recover=True)
+
+    def feed(self, data):
+        self._parser.feed(data)
+        self._read_events()
+
+    def close(self):
+        self._parser.close()
+        self._read_events()
+        return BibRecords(self.records, self.returned)
+
+    def _read_events(self):
+        for _, bib in self._parser.read_events():
+            record = _bib_record(bib, self.returned)
+            if record is not None:
+                self.records.append(record)
+            _free(bib)
+
+
+def soup_items(content):
+    """
+    Extracts the item records by building a BeautifulSoup tree of the whole
+    response
+    """
+    soup = BeautifulSoup(content, features='xml')
+
+    for item in soup.find_all('item'):
+        holding_data = item.find('holding_data')
+        item_data = item.find('item_data')
+        logger.debug(item_data)
+
+        barcode = item_data.find('barcode') if item_data is not None else None
+        if barcode is None:
+            logger.warning('No barcode found for item')
+            continue
+
+        locations = []
+        if holding_data is not None:
+            locations = holding_data.find_all('temp_location', attrs={'desc': 'Top Textbook'})
+        if len(locations) == 0:
+            locations = item_data.find_all('location', attrs={'desc': 'Top Textbook'})
+        top_textbook = any(location.text == 'TPTXB' for location in locations)
+
+        reshelving = False
+        count = 0
+        awaiting_reshelving = item_data.find('awaiting_reshelving')
+        if awaiting_reshelving is not None:
+            reshelving = awaiting_reshelving.text
+            item_in_place = item_data.find('base_status', attrs={'desc': 'Item in place'})
+            if item_in_place is not None:
+                count = int(item_in_place.text)
+
+        yield ItemRecord(barcode.text, top_textbook, reshelving, count)
+
+
+def lxml_items(content):
+    """
+    Extracts the item records with lxml's iterparse. Each <item> is read in a
+    single pass over its elements and cleared afterwards, so memory use does
+    not grow with the number of items.
+    """
+    if isinstance(content, str):
+        content = content.encode('UTF-8')
+
+    for _, item in etree.iterparse(BytesIO(content), events=('end',), tag='item', recover=True):
+        barcode = None
+        temp_locations = []
+        locations = []
+        reshelving = None
+        item_in_place = None
+
+        for section in item:
+            if section.tag == 'holding_data':
+                temp_locations += [element.text or '' for element in section.iter('temp_location')
+                                   if element.get('desc') == 'Top Textbook']
+            elif section.tag == 'item_data':
+                for element in section.iter():
+                    if element.tag == 'barcode' and barcode is None:
+                        barcode = element.text or ''
+                    elif element.tag == 'location' and element.get('desc') == 'Top Textbook':
+                        locations.append(element.text or '')
+                    elif element.tag == 'awaiting_reshelving' and reshelving is None:
+                        reshelving = element.text or ''
+                    elif element.tag == 'base_status' and element.get('desc') == 'Item in place' \
+                            and item_in_place is None:
+                        item_in_place = element.text or ''
+
+        if barcode is None:
+            logger.warning('No barcode found for item')
+        else:
+            top_textbook = 'TPTXB' in (temp_locations or locations)
+            count = 0
+            if reshelving is not None and item_in_place is not None:
+                count = int(item_in_place)
+            yield ItemRecord(barcode, top_textbook, reshelving if reshelving is not None else False, count)
+
+        _free(item)
+
+
+BIB_PARSERS = {
+    'soup': soup_bibs,
+    'lxml': lxml_bibs,
+}
+
+ITEM_PARSERS = {
+    'soup': soup_items,
+    'lxml': lxml_items,
+}
@@ -0,0 +1,98 @@
+import threading
+from time import monotonic, time
+
+from core.logging import create_logger
+from werkzeug.exceptions import HTTPException
+
+logger = create_logger(__name__)
+
+
+class Prefetcher:
+    """
+    Periodically retrieves a known list of MMS IDs (the Top Textbooks
+    catalogue) from Alma in a background thread and keeps their parsed
+    results in the warm store of an :class:`alma.processor.AlmaProcessor`,
+    so that requests for them are answered from memory.
+    """
+    DEFAULT_INTERVAL = 300
+    DEFAULT_CHUNK_SIZE = 100
+
+    def __init__(self, processor, config) -> None:
+        self.processor = processor
+        self.mms_ids = self.load_mms_ids(config)
+        self.interval = config.get('interval', self.DEFAULT_INTERVAL)
+        self.chunk_size = int(config.get('chunk_size', self.DEFAULT_CHUNK_SIZE))
+        self.options = (config.get('limit_collection', 'TPTXB'), False, False)
+        self.refreshes = 0
+        self.failures = 0
+        self.last_refresh = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='alma-prefetch', daemon=True)
+
+    @staticmethod
+    def load_mms_ids(config):
+        """
+        Returns the MMS IDs listed in the configuration and/or in the file
+        it names, which has one MMS ID per line
+        """
+        mms_ids = list(config.get('mms_ids') or [])
+        if config.get('mms_ids_file'):
+            with open(config['mms_ids_file']) as fh:
+                mms_ids += [line.strip() for line in fh if line.strip() and not line.startswith('#')]
+        return sorted(set(mms_ids))
+
+    def start(self):
+        logger.info(f'Prefetching {len(self.mms_ids)} MMS IDs every {self.interval} seconds')
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self.is_running():
+            self._thread.join(timeout)
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+    def refresh(self):
+        """
+        Retrieves every MMS ID in chunks and replaces their warm results.
+        A chunk that fails, for any reason, keeps its previous results until
+        they expire, and is tried again on the next refresh.
+        """
+        start = monotonic()
+        for i in range(0, len(self.mms_ids), self.chunk_size):
+            if self._stop.is_set():
+                return
+
+            chunk = self.mms_ids[i:i + self.chunk_size]
+            try:
+                query_content = self.processor.queryServer(chunk)
+                bibs_data = self.processor.parse_bibs_by_id(query_content, *self.options)
+            except HTTPException as e:
+                self.failures += 1
+                logger.warning(f'Failed to prefetch {len(chunk)} MMS IDs: {e.description}')
+                continue
+            except Exception:
+                # Any other error must not end the thread and let the warm store expire
+                self.failures += 1
+                logger.exception(f'Failed to prefetch {len(chunk)} MMS IDs')
+                continue
+
+            self.processor.warm_bibs(chunk, bibs_data, self.options)
+
+        self.refreshes += 1
+        self.last_refresh = time()
+        logger.info(f'Prefetched {len(self.mms_ids)} MMS IDs in {monotonic() - start:.2f} seconds')
+
+    def stats(self):
+        return {
+            'mms_ids': len(self.mms_ids),
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'last_refresh': self.last_refresh,
+        }
@@ -1,21 +1,164 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
 from os import environ
+from time import monotonic
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
 from bs4 import BeautifulSoup
+from core.cache import TTLCache
 from core.gateway import HttpGateway
 from core.logging import create_logger
+from core.ratelimit import RateLimiter
+from core.singleflight import SingleFlight
+from core.tracing import current_span, propagate, span, traced
 from flask import abort
 from datetime import datetime
 from jsonschema import ValidationError, validate
+from lxml import etree
+from werkzeug.exceptions import HTTPException
+
+from alma.batching import BibsBatcher, SharedRecords
+from alma.metrics import PARSE_SECONDS, UPSTREAM_ERRORS, UPSTREAM_SECONDS
+from alma.parsers import BIB_PARSERS, ITEM_PARSERS, BibRecords, BibsPullParser, merge_records, returned_mms_ids
 
 logger = create_logger(__name__)
 
 
+# The most MMS IDs listed in a response header, so that a large request
+# cannot make the headers too large for proxies and clients (often 8 KB)
+MAX_HEADER_MMS_IDS = 100
+
+
+def missing_headers(not_found, unavailable):
+    """
+    Returns the response headers reporting the requested MMS IDs that Alma
+    did not return, and those that could not be answered because Alma failed.
+    Only the first MAX_HEADER_MMS_IDS of each are listed, with the total in an
+    X-Not-Found-Count or X-Unavailable-Count header when some are left out.
+    """
+    headers = {}
+    for name, mms_ids in (('X-Not-Found', not_found), ('X-Unavailable', unavailable)):
+        if not mms_ids:
+            continue
+        headers[name] = ','.join(mms_ids[:MAX_HEADER_MMS_IDS])
+        if len(mms_ids) > MAX_HEADER_MMS_IDS:
+            headers[f'{name}-Count'] = str(len(mms_ids))
+    return headers
+
+
+class BibsResult(dict):
+    """
+    The keyed entries of a bibs request, along with the requested MMS IDs
+    that Alma did not return, and those that Alma failed to return with no
+    last known result to answer instead
+    """
+    def __init__(self, entries, not_found=(), unavailable=()) -> None:
+        super().__init__(entries)
+        self.not_found = sorted(not_found)
+        self.unavailable = sorted(unavailable)
+
+    def headers(self):
+        return missing_headers(self.not_found, self.unavailable)
+
+
+class BibsStream:
+    """
+    Generates the keyed entries of a bibs request, with the requested MMS IDs
+    that Alma did not return, or that are unavailable, known up front
+    """
+    def __init__(self, entries, not_found=(), unavailable=()) -> None:
+        self.entries = entries
+        self.not_found = sorted(not_found)
+        self.unavailable = sorted(unavailable)
+
+    def __iter__(self):
+        return self.entries
+
+    def headers(self):
+        return missing_headers(self.not_found, self.unavailable)
+
+
 class AlmaProcessor:
     TEXTBOOKS_SCHEMA = {'type': 'array', 'items': {'type': 'string'}}
-    HOLDINGS_SCHEMA = {'type': 'object', 'items': {'type': 'string'}}
+    # The key of the holdings response that reports the pairs that failed in
+    # the parallel mode, which is therefore not accepted as an MMS ID
+    HOLDINGS_ERRORS = 'errors'
+    HOLDINGS_SCHEMA = {'type': 'object', 'items': {'type': 'string'}, 'propertyNames': {'not': {'const': 'errors'}}}
+    BATCH_SCHEMA = {
+        'type': 'object',
+        'minProperties': 1,
+        'additionalProperties': {
+            'type': 'object',
+            'properties': {'query': {'enum': ['textbooks', 'equipment', 'holdings']}},
+            'required': ['query', 'data'],
+        },
+    }
+    # Arguments of processBibs for the bibs queries of a batch, as used by
+    # the /alma-service/textbooks and /alma-service/equipment endpoints
+    BIBS_QUERIES = {
+        'textbooks': {'limit_collection': 'TPTXB'},
+        'equipment': {'limit_collection': None, 'include_course': False, 'check_holdings': True},
+    }
+    DEFAULT_MAX_WORKERS = 8
 
     def __init__(self, server):
         self.server = server
+        self.config = getattr(server, 'config', None) or {}
+        self.max_workers = int(self.config.get('max_workers', self.DEFAULT_MAX_WORKERS))
+        self.parallel_holdings = bool(self.config.get('parallel_holdings', False))
+
+        parser = self.config.get('parser', 'soup')
+        if parser not in BIB_PARSERS:
+            raise RuntimeError(f'Unknown parser "{parser}"')
+        self.bib_parser = BIB_PARSERS[parser]
+        self.items_parser = ITEM_PARSERS[parser]
+        # Parse Retrieve Bibs responses while they are received, instead of
+        # once they have been buffered in full
+        self.stream_parsing = bool(self.config.get('stream_parsing', False))
+
+        results_config = self.config.get('result_cache') or {}
+        self.results_ttl = results_config.get('ttl', 0)
+        # Expired results are served for stale_while_revalidate seconds while
+        # they are refreshed, and for stale_if_error seconds if Alma fails
+        self.stale_while_revalidate = results_config.get('stale_while_revalidate', 0)
+        self.stale_if_error = results_config.get('stale_if_error', 0)
+        self.results = None
+        if self.results_ttl:
+            self.results = TTLCache(max_entries=results_config.get('max_entries', 4096),
+                                    stale_ttl=max(self.stale_while_revalidate, self.stale_if_error))
+        # MMS IDs that Alma did not return, which are not requested again until
+        # their entry expires
+        not_found_config = self.config.get('not_found_cache') or {}
+        self.not_found_ttl = not_found_config.get('ttl', 0)
+        self.not_found = None
+        if self.not_found_ttl:
+            self.not_found = TTLCache(max_entries=not_found_config.get('max_entries', 10000))
+
+        # Bounded pools shared by every request, so that the number of threads
+        # does not grow with the number of concurrent requests. A task never
+        # waits on its own pool: the sub-queries of a batch wait on the lookups,
+        # which wait on the fetches of the gateway, which wait on nothing.
+        self.batch_executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='alma-batch')
+        self.lookup_executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='alma-lookup')
+        self.revalidator = ThreadPoolExecutor(max_workers=1, thread_name_prefix='alma-revalidate')
+        self.revalidating = set()
+        self._revalidating_lock = threading.Lock()
+
+        # Results kept up to date by alma.prefetch.Prefetcher, used until max_age
+        prefetch_config = self.config.get('prefetch') or {}
+        self.warm = {}
+        self.warm_max_age = prefetch_config.get('max_age', 3 * prefetch_config.get('interval', 300))
+        # The alma.prefetch.Prefetcher keeping them, reported in the stats
+        self.prefetcher = None
+
+        # Concurrent requests for bibs are combined into one Alma lookup
+        self.batcher = self.create_batcher(self.config.get('batching'))
+
+    def create_batcher(self, batching_config):
+        if not batching_config:
+            return None
+        return BibsBatcher(self.retrieve_records, **batching_config)
 
     @staticmethod
     def unique_mms_ids(data):
@@ -38,57 +181,18 @@ class AlmaProcessor:
         Defaults to Top Textbooks only query (check_TT).
         """
         response_data = {}
-        soup = BeautifulSoup(content, features='xml')
-        bibs = soup.find_all('item')
+        found = False
+        with PARSE_SECONDS.time('holdings'), span('parse_holdings', bytes=len(content)):
+            for item in self.items_parser(content):
+                found = True
+                if check_TT and not item.top_textbook:
+                    continue
 
-        if len(bibs) == 0:
-            abort(502, 'No holdings data found in request')
+                response_data[item.barcode] = {'available': item.count > 0, 'count': item.count,
+                                               'reshelving': item.reshelving}
 
-        for bib in bibs:
-            try:
-                bib_data = bib.find('bib_data')
-                holding_data = bib.find('holding_data')
-                item_data = bib.find('item_data')
-                logger.debug(item_data)
-            except AttributeError:
-                abort(502, 'fields not found in bibs')
-
-            is_TT = False
-            temp_locations = None
-            if check_TT:
-                try:
-                    temp_locations = holding_data.find_all('temp_location', attrs={'desc': 'Top Textbook'})
-                except AttributeError:
-                    is_TT = False
-
-                if temp_locations is None or len(temp_locations) == 0:
-                    try:
-                        temp_locations = item_data.find_all('location', attrs={'desc': 'Top Textbook'})
-                    except AttributeError:
-                        is_TT = False
-
-                logger.debug(temp_locations)
-                for loc in temp_locations:
-                    if loc.text == 'TPTXB':
-                        is_TT = True
-
-            if (check_TT and is_TT) or not check_TT:
-                mms_id = bib_data.find('mms_id').text
-                barcode = item_data.find('barcode').text
-                item_count = 0
-                item_available = False
-                awaiting_reshelving = False
-                try:
-                    awaiting_reshelving = item_data.find('awaiting_reshelving').text
-                    item_in_place = item_data.find('base_status', attrs={'desc': 'Item in place'})
-                    item_count = int(item_in_place.text)
-                    if item_count > 0:
-                        item_available = True
-                except AttributeError:
-                    item_available = False
-
-                response_data[barcode] = {'available': item_available, 'count': item_count,
-                                          'reshelving': awaiting_reshelving}
+        if not found:
+            abort(502, 'No holdings data found in request')
 
         return response_data
 
@@ -100,30 +204,102 @@ class AlmaProcessor:
         An additional holdings check can be run if item is unavailable.
         """
         response_data = {}
-        soup = BeautifulSoup(content, features='xml')
+        for entries in self.parse_bibs_by_id(content, limit_collection, include_course, check_holdings).values():
+            response_data.update(entries)
 
-        bibs = soup.find_all('bib')
+        return response_data
 
-        for bib in bibs:
-            holdings_url = None
-            try:
-                avas = bib.find_all('datafield', attrs={'tag': 'AVA'})
-                holdings_url = bib.find('holdings')['link']
-                title = bib.find('title').text
-            except AttributeError:
-                logger.warning('No AVA found for content ')
-                # abort(502, 'fields not found in bibs')
-                continue
+    def parse_bibs_by_id(self, content, limit_collection, include_course, check_holdings):
+        """
+        Same as :meth:`parse_bibs`, but with the keyed entries grouped by the
+        MMS ID of the bib they were found in.
+        """
+        return self.bibs_from_records(self.parse_records(content), limit_collection, include_course, check_holdings)
+
+    def parse_records(self, content):
+        """
+        Returns the :class:`alma.parsers.BibRecords` in the Retrieve Bibs
+        response content
+        """
+        with PARSE_SECONDS.time('bibs'), span('parse_bibs', bytes=len(content)) as parse_span:
+            returned = set()
+            records = BibRecords(self.bib_parser(content, returned), returned)
+            parse_span.set(bibs=len(records))
+        return records
+
+    def bibs_from_records(self, records, limit_collection, include_course, check_holdings):
+        """
+        Returns the keyed entries of the bib records, grouped by MMS ID
+        """
+        bibs_data = dict(self.iter_bibs(records, limit_collection, include_course, check_holdings))
 
-            logger.debug(holdings_url)
-            holdings_info = self.getAdditional(holdings_url)
-            # logger.debug(holdings_info)
-            holdings_soup = BeautifulSoup(holdings_info, features='xml')
-            info_url = holdings_soup.find('holding')['link']
-            logger.debug(info_url)
-            info = self.getAdditional(info_url + '/items')
-            # logger.debug(info)
+        # In record order, so that the result does not depend on timing
+        return {record.mms_id: bibs_data[record.mms_id] for record in records}
 
+    def iter_bibs(self, records, limit_collection, include_course, check_holdings):
+        """
+        Generates the MMS ID and keyed entries of each bib record as soon as it
+        can be assembled: first the bibs that need no items, then each of the
+        others once the items for its due dates have been retrieved.
+        """
+        # Items are only needed for the due dates of unavailable rows, so the
+        # holdings/items lookups are started on demand and shared per request
+        items_futures = {}
+        if check_holdings:
+            for holdings_url in self.items_needed(records, limit_collection):
+                items_futures[holdings_url] = self.lookup_executor.submit(propagate(self.getItems), holdings_url)
+
+        try:
+            waiting = {}
+            for record in records:
+                if record.holdings_url in items_futures:
+                    waiting.setdefault(items_futures[record.holdings_url], []).append(record)
+            ready = [record for record in records if record.holdings_url not in items_futures]
+
+            with span('assemble_bibs'):
+                bibs_data = self.assemble_bibs(ready, items_futures, limit_collection, include_course,
+                                               check_holdings)
+            yield from bibs_data.items()
+
+            for future in as_completed(waiting):
+                with span('assemble_bibs'):
+                    bibs_data = self.assemble_bibs(waiting[future], items_futures, limit_collection, include_course,
+                                                   check_holdings)
+                yield from bibs_data.items()
+        finally:
+            # Lookups not started yet are not needed once the stream is closed
+            for future in items_futures.values():
+                future.cancel()
+
+    @classmethod
+    def items_needed(cls, records, limit_collection):
+        """
+        Returns the unique holdings links of the bibs with an unavailable row
+        """
+        return list(dict.fromkeys(record.holdings_url for record in records
+                                  if cls.has_unavailable(record.avas, limit_collection)))
+
+    @staticmethod
+    def has_unavailable(avas, limit_collection):
+        """
+        Returns True if any AVA row within the collection is unavailable,
+        i.e. the bib will need its items for a due date.
+        """
+        for ava in avas:
+            if limit_collection is not None and ava.get('j') != limit_collection:
+                continue
+            if ava.get('e') == 'unavailable':
+                return True
+        return False
+
+    def assemble_bibs(self, records, items_futures, limit_collection, include_course, check_holdings):
+        """
+        Builds the keyed entries of each parsed bib, waiting on the items of a
+        bib only when one of its rows needs a due date.
+        """
+        bibs_data = {}
+        for bib_mms_id, holdings_url, title, avas in records:
+            response_data = bibs_data.setdefault(bib_mms_id, {})
             if len(avas) == 0:
                 logger.warning('No AVA found for content ')
                 # abort(502, 'No AVA tag found in content')
@@ -131,33 +307,14 @@ class AlmaProcessor:
 
             logger.debug(avas)
             for ava in avas:
-                availability = None
-                total_items = None
-                checked_out = None
-                location_code = None
-                call_number = None
-                physical_location = None
-                mms_find = ava.find('subfield', attrs={'code': '0'})
-                if mms_find is not None:
-                    mms_id = mms_find.text
-                avail_find = ava.find('subfield', attrs={'code': 'e'})
-                if avail_find is not None:
-                    availability = avail_find.text
-                total_find = ava.find('subfield', attrs={'code': 'f'})
-                if total_find is not None:
-                    total_items = total_find.text
-                checked_find = ava.find('subfield', attrs={'code': 'g'})
-                if checked_find is not None:
-                    checked_out = checked_find.text
-                location_find = ava.find('subfield', attrs={'code': 'j'})
-                if location_find is not None:
-                    location_code = location_find.text
-                call_find = ava.find('subfield', attrs={'code': 'd'})
-                if call_find is not None:
-                    call_number = call_find.text
-                physical_find = ava.find('subfield', attrs={'code': 'b'})
-                if physical_find is not None:
-                    physical_location = physical_find.text
+                if '0' in ava:
+                    mms_id = ava['0']
+                availability = ava.get('e')
+                total_items = ava.get('f')
+                checked_out = ava.get('g')
+                location_code = ava.get('j')
+                call_number = ava.get('d')
+                physical_location = ava.get('b')
 
                 logger.debug(f'{mms_id=}')
                 logger.debug(f'{availability=}')
@@ -220,12 +377,7 @@ class AlmaProcessor:
                                                    'status': availability, 'call_number': call_number}
                         if check_holdings:
                             stored_date = None
-                            logger.debug(holdings_url)
-                            holdings_info = self.getAdditional(holdings_url)
-                            holdings_soup = BeautifulSoup(holdings_info, features='xml')
-                            info_url = holdings_soup.find('holding')['link']
-                            logger.debug(info_url)
-                            info = self.getAdditional(info_url + '/items')
+                            info = items_futures[holdings_url].result()
                             info_soup = BeautifulSoup(info, features='xml')
                             logger.debug(info_soup)
                             due_dates = info_soup.find_all('due_date')
@@ -250,35 +402,340 @@ class AlmaProcessor:
                     if course_code is not None:
                         response_data[item_key]['course'] = course_code
 
-        return response_data
+        return bibs_data
 
+    @traced('processHoldings')
     def processHoldings(self, data):
+        holdings = self.validate_holdings(data)
+        current_span().set(pairs=len(holdings))
+
+        if self.parallel_holdings:
+            return self.processHoldingsParallel(holdings)
+
+        response_data = {}
+        for mms_id, holdings_id in holdings.items():
+            holdings_raw = self.getHoldings(mms_id, holdings_id)
+            response_raw = self.parse_holdings(holdings_raw)
+            self.add_holdings(response_data, mms_id, holdings_id, response_raw)
+
+        return response_data
+
+    def validate_holdings(self, data):
+        """
+        Validates the JSON mapping of mms_id to holdings ID received from
+        Drupal, returning the unique pairs
+        """
         try:
             validate(data, self.HOLDINGS_SCHEMA)
         except ValidationError as e:
             logger.warning(str(e))
             abort(400, 'Invalid JSON')
 
-        holdings = self.unique_holdings(data)
+        return self.unique_holdings(data)
 
+    def processHoldingsParallel(self, holdings):
+        """
+        Retrieves the items of every mms + holdings ID pair in the shared lookup
+        pool and parses each response as soon as it arrives. A pair that fails is
+        reported in the errors of the response instead of failing the whole
+        request.
+        """
+        results = {}
+        futures = {self.lookup_executor.submit(propagate(self.getHoldings), mms_id, holdings_id): (mms_id, holdings_id)
+                   for mms_id, holdings_id in holdings.items()}
+        for future in as_completed(futures):
+            mms_id, holdings_id = futures[future]
+            try:
+                results[mms_id, holdings_id] = self.parse_holdings(future.result())
+            except HTTPException as e:
+                results[mms_id, holdings_id] = e
+
+        return self.combine_holdings(holdings, results)
+
+    def combine_holdings(self, holdings, results):
+        """
+        Assembles the parsed items, or the error, of each pair in request order
+        so the response does not depend on timing. The pairs that failed are
+        left out, and reported by MMS ID and holdings ID under the "errors" key.
+        """
         response_data = {}
+        errors = {}
         for mms_id, holdings_id in holdings.items():
-            holdings_raw = self.getHoldings(mms_id, holdings_id)
-            response_raw = self.parse_holdings(holdings_raw)
-            if (mms_id in response_data) and holdings_id in response_data[mms_id]:
-                current_holdings = response_data[mms_id][holdings_id]
-                updated_holdings = current_holdings | response_raw
-                response_data[mms_id][holdings_id] = updated_holdings
+            result = results[mms_id, holdings_id]
+            if isinstance(result, HTTPException):
+                errors.setdefault(mms_id, {})[holdings_id] = self.holdings_error(mms_id, holdings_id, result)
             else:
-                response_data[mms_id] = {holdings_id: response_raw}
+                self.add_holdings(response_data, mms_id, holdings_id, result)
 
+        if errors:
+            response_data[self.HOLDINGS_ERRORS] = errors
         return response_data
 
-    def processBibs(self, data, limit_collection=None, include_course=False, check_holdings=False):
+    @staticmethod
+    def holdings_error(mms_id, holdings_id, e):
+        logger.warning(f'Failed to retrieve holdings {holdings_id} of {mms_id}: {e.description}')
+        return {'status': e.code, 'message': e.description}
+
+    @staticmethod
+    def add_holdings(response_data, mms_id, holdings_id, response_raw):
+        if (mms_id in response_data) and holdings_id in response_data[mms_id]:
+            current_holdings = response_data[mms_id][holdings_id]
+            updated_holdings = current_holdings | response_raw
+            response_data[mms_id][holdings_id] = updated_holdings
+        else:
+            response_data[mms_id] = {holdings_id: response_raw}
+
+    @traced('processBatch')
+    def processBatch(self, data):
+        """
+        Runs each named sub-query of a batch concurrently, returning the result
+        or error of each under its name. The sub-queries share the bibs they
+        retrieve from Alma.
+        """
+        queries = self.validate_batch(data)
+        current_span().set(queries=len(queries))
+
+        shared = SharedRecords(self.fetch_records)
+        futures = {name: self.batch_executor.submit(propagate(self.process_query), query['query'], query['data'],
+                                                    shared)
+                   for name, query in queries.items()}
+
+        response_data = {}
+        for name, future in futures.items():
+            try:
+                response_data[name] = self.query_result(future.result())
+            except HTTPException as e:
+                response_data[name] = self.query_error(name, e)
+        return response_data
+
+    def process_query(self, query, data, shared):
+        if query == 'holdings':
+            return self.processHoldings(data)
+        return self.processBibs(data, shared=shared, **self.BIBS_QUERIES[query])
+
+    def validate_batch(self, data):
+        """
+        Validates the JSON mapping of names to sub-queries received from Drupal
+        """
+        try:
+            validate(data, self.BATCH_SCHEMA)
+        except ValidationError as e:
+            logger.warning(str(e))
+            abort(400, 'JSON received is not valid.')
+
+        return data
+
+    @staticmethod
+    def query_result(response_data):
+        result = {'data': response_data}
+        if getattr(response_data, 'not_found', None):
+            result['not_found'] = response_data.not_found
+        if getattr(response_data, 'unavailable', None):
+            result['unavailable'] = response_data.unavailable
+        return result
+
+    @staticmethod
+    def query_error(name, e):
+        logger.warning(f'Batch query {name} failed: {e.description}')
+        return {'error': {'status': e.code, 'message': e.description}}
+
+    @traced('processBibs')
+    def processBibs(self, data, limit_collection=None, include_course=False, check_holdings=False, shared=None):
         """
         Validates JSON received from Drupal.
         Queries the Alma Server if data is valid
         """
+        mms_ids = self.validate_bibs(data)
+        current_span().set(mms_ids=len(mms_ids))
+
+        options = (limit_collection, include_course, check_holdings)
+        bibs_data, misses, not_found = self.known_bibs(mms_ids, options)
+
+        unavailable = set()
+        if misses or not mms_ids:
+            try:
+                fresh_data, missing = self.retrieve_bibs(misses, options, shared)
+                not_found |= missing
+            except HTTPException as e:
+                fresh_data = self.fallback_bibs(misses, options, e)
+                unavailable = misses - fresh_data.keys()
+            bibs_data |= fresh_data
+
+        return self.combine_bibs(bibs_data, not_found, unavailable)
+
+    def known_bibs(self, mms_ids, options):
+        """
+        Returns the entries for the given MMS IDs that can be answered without
+        Alma, keyed by MMS ID, the MMS IDs to retrieve from Alma, and the MMS
+        IDs recently found missing from Alma
+        """
+        # Only the MMS IDs without cached results are requested from Alma
+        bibs_data = self.cached_bibs(mms_ids, options)
+        misses = mms_ids - bibs_data.keys()
+
+        # MMS IDs recently found missing from Alma are not requested again
+        not_found = self.known_not_found(misses)
+        misses -= not_found
+
+        # Recently expired results are answered now and refreshed in the background
+        stale_data = self.stale_bibs(misses, options, self.stale_while_revalidate)
+        if stale_data:
+            bibs_data |= stale_data
+            misses -= stale_data.keys()
+            self.revalidate(stale_data.keys(), options)
+        logger.debug(f'{len(bibs_data)} cached, {len(misses)} to retrieve')
+        current_span().set(cached=len(bibs_data))
+
+        return bibs_data, misses, not_found
+
+    @traced('streamBibs')
+    def streamBibs(self, data, limit_collection=None, include_course=False, check_holdings=False):
+        """
+        Streaming version of :meth:`processBibs`. The bibs are retrieved from
+        Alma before returning, so that failing to retrieve them is still an
+        error response, then the returned :class:`BibsStream` generates each
+        keyed entry as soon as its bib has been assembled, cached ones first.
+        """
+        mms_ids = self.validate_bibs(data)
+        current_span().set(mms_ids=len(mms_ids))
+
+        options = (limit_collection, include_course, check_holdings)
+        bibs_data, misses, not_found = self.known_bibs(mms_ids, options)
+
+        records = []
+        unavailable = set()
+        if misses or not mms_ids:
+            try:
+                records = self.fetch_records(misses)
+            except HTTPException as e:
+                fallback = self.fallback_bibs(misses, options, e)
+                bibs_data |= fallback
+                unavailable = misses - fallback.keys()
+            else:
+                missing = misses - returned_mms_ids(records)
+                self.cache_not_found(missing)
+                not_found |= missing
+
+        self.log_missing(not_found, unavailable)
+
+        return BibsStream(self.stream_entries(bibs_data, records, options), not_found, unavailable)
+
+    def stream_entries(self, bibs_data, records, options):
+        """
+        Generates the keyed entries of the already known bibs, then those of
+        the retrieved bib records, caching each bib as it is assembled
+        """
+        for mms_id in sorted(bibs_data):
+            yield from bibs_data[mms_id].items()
+
+        for mms_id, entries in self.iter_bibs(records, *options):
+            self.cache_bibs({mms_id: entries}, options)
+            yield from entries.items()
+
+    def retrieve_bibs(self, mms_ids, options, shared=None):
+        """
+        Queries Alma for the given MMS IDs and caches the parsed entries,
+        keyed by MMS ID. Returns the entries and the MMS IDs that Alma did not
+        return. With shared records, bibs already retrieved for another
+        sub-query of the same batch are reused.
+        """
+        if shared is not None and mms_ids:
+            records = shared.submit(mms_ids)
+        else:
+            records = self.fetch_records(mms_ids)
+
+        # Process the xml content
+        bibs_data = self.bibs_from_records(records, *options)
+        self.cache_bibs(bibs_data, options)
+        # Bibs that Alma returned but that lack a field are left out, not missing
+        missing = set(mms_ids) - returned_mms_ids(records)
+        self.cache_not_found(missing)
+        return bibs_data, missing
+
+    def fetch_records(self, mms_ids):
+        """
+        Returns the bib records for the given MMS IDs, retrieved along with
+        those of concurrent requests if batching is enabled
+        """
+        if self.batcher is not None and mms_ids:
+            return self.batcher.submit(mms_ids)
+        return self.retrieve_records(mms_ids)
+
+    def retrieve_records(self, mms_ids):
+        """
+        Queries Alma for the given MMS IDs and returns the parsed bib records
+        """
+        if self.stream_parsing:
+            return self.queryRecords(mms_ids)
+        return self.parse_records(self.queryServer(mms_ids))
+
+    def revalidate(self, mms_ids, options):
+        """
+        Refreshes the cached entries of the given MMS IDs in the background,
+        unless a refresh of them is already in progress
+        """
+        with self._revalidating_lock:
+            keys = {(mms_id,) + options for mms_id in mms_ids} - self.revalidating
+            self.revalidating |= keys
+        if keys:
+            self.revalidator.submit(self._revalidate, keys, options)
+
+    def _revalidate(self, keys, options):
+        try:
+            self.retrieve_bibs([key[0] for key in keys], options)
+        except HTTPException as e:
+            logger.warning(f'Failed to revalidate {len(keys)} MMS IDs: {e.description}')
+        except Exception:
+            logger.exception(f'Failed to revalidate {len(keys)} MMS IDs')
+        finally:
+            with self._revalidating_lock:
+                self.revalidating -= keys
+
+    @staticmethod
+    def is_outage(e):
+        """
+        Returns True if the error means that Alma could not answer, rather than
+        that the request itself was invalid
+        """
+        return e.code == 429 or e.code >= 500
+
+    def fallback_bibs(self, mms_ids, options, e):
+        """
+        Returns the last known results for the given MMS IDs when Alma fails,
+        re-raising the error if there are none. The MMS IDs without a last
+        known result are left out, to be reported as unavailable.
+        """
+        fallback = self.stale_bibs(mms_ids, options, self.stale_if_error) if self.is_outage(e) else {}
+        if not fallback:
+            raise e
+
+        logger.warning(f'Serving last known results for {len(fallback)} of {len(mms_ids)} MMS IDs: {e.description}')
+        return fallback
+
+    def stale_bibs(self, mms_ids, options, stale_for):
+        """
+        Returns the cached entries for the given MMS IDs that expired at most
+        stale_for seconds ago. Each entry is a copy marked as stale, with its
+        age in seconds.
+        """
+        if self.results is None or not stale_for:
+            return {}
+
+        max_age = self.results_ttl + stale_for
+
+        bibs_data = {}
+        for mms_id in mms_ids:
+            cached = self.results.get_stale((mms_id,) + options, max_age)
+            if cached is not None:
+                entries, age = cached
+                bibs_data[mms_id] = {key: entry | {'stale': True, 'age': int(age)} for key, entry in entries.items()}
+        return bibs_data
+
+    def validate_bibs(self, data):
+        """
+        Validates the JSON list of MMS IDs received from Drupal, returning the
+        unique MMS IDs
+        """
         try:
             validate(data, self.TEXTBOOKS_SCHEMA)
         except ValidationError as e:
@@ -289,26 +746,151 @@ class AlmaProcessor:
         mms_ids = self.unique_mms_ids(data)
 
         logger.debug(len(mms_ids))
+        return mms_ids
 
-        # Send request
-        query_content = self.queryServer(mms_ids)
+    @classmethod
+    def combine_bibs(cls, bibs_data, not_found=(), unavailable=()):
+        """
+        Merges the entries of each bib into the keyed response, in MMS ID order,
+        noting the requested MMS IDs that Alma did not return, and those that
+        are unavailable because Alma failed
+        """
+        alma_data = {}
+        for mms_id in sorted(bibs_data):
+            alma_data.update(bibs_data[mms_id])
 
-        # Process the xml content
-        alma_data = self.parse_bibs(query_content, limit_collection, include_course, check_holdings)
+        cls.log_missing(not_found, unavailable)
+
+        return BibsResult(alma_data, not_found, unavailable)
+
+    @staticmethod
+    def log_missing(not_found, unavailable):
+        for mms_id in sorted(not_found):
+            logger.warning(f'{mms_id} not found in Alma.')
+        if unavailable:
+            logger.warning(f'{len(unavailable)} MMS IDs unavailable: {",".join(sorted(unavailable))}')
 
-        for mms_id in alma_data:
-            if mms_id not in alma_data:
-                logger.warning(f'{mms_id} not found in Alma.')
+    def known_not_found(self, mms_ids):
+        """
+        Returns the given MMS IDs that Alma recently did not return
+        """
+        if self.not_found is None:
+            return set()
+        return {mms_id for mms_id in mms_ids if self.not_found.get(mms_id) is not None}
+
+    def cache_not_found(self, mms_ids):
+        if self.not_found is None:
+            return
+
+        for mms_id in mms_ids:
+            self.not_found.set(mms_id, True, self.not_found_ttl)
+
+    def cached_bibs(self, mms_ids, options):
+        """
+        Returns the prefetched or cached entries for the given MMS IDs, keyed
+        by MMS ID
+        """
+        now = monotonic()
+        bibs_data = {}
+        for mms_id in mms_ids:
+            warm = self.warm.get((mms_id,) + options)
+            if warm is not None and now - warm[0] <= self.warm_max_age:
+                bibs_data[mms_id] = warm[1]
+                continue
 
-        return alma_data
+            if self.results is not None:
+                entries = self.results.get((mms_id,) + options)
+                if entries is not None:
+                    bibs_data[mms_id] = entries
+        return bibs_data
 
+    def warm_bibs(self, mms_ids, bibs_data, options):
+        """
+        Replaces the warm entries of the given MMS IDs with freshly retrieved
+        ones. MMS IDs that Alma did not return are dropped from the store.
+        """
+        now = monotonic()
+        for mms_id in mms_ids:
+            if mms_id in bibs_data:
+                self.warm[(mms_id,) + options] = (now, bibs_data[mms_id])
+            else:
+                self.warm.pop((mms_id,) + options, None)
+
+    def cache_bibs(self, bibs_data, options):
+        if self.results is None:
+            return
+
+        for mms_id, entries in bibs_data.items():
+            self.results.set((mms_id,) + options, entries, self.results_ttl)
+
+    def invalidate(self, mms_ids=None):
+        """
+        Drops the prefetched and cached results, and the cached Alma responses
+        they were built from, for the given MMS IDs, or for every MMS ID if
+        none given
+        """
+        if mms_ids is None:
+            self.warm.clear()
+        else:
+            mms_ids = set(mms_ids)
+            # Copied first, as the prefetcher may be replacing entries meanwhile
+            for key in list(self.warm):
+                if key[0] in mms_ids:
+                    self.warm.pop(key, None)
+
+        if self.results is not None:
+            if mms_ids is None:
+                self.results.invalidate()
+            else:
+                self.results.invalidate_where(lambda key: key[0] in mms_ids)
+
+        if self.not_found is not None:
+            if mms_ids is None:
+                self.not_found.invalidate()
+            else:
+                self.not_found.invalidate_where(lambda key: key in mms_ids)
+
+        if self.server is not None:
+            self.server.invalidate(mms_ids)
+
+    def close(self):
+        """
+        Shuts down the thread pools of the processor and of its gateway, once
+        the server has stopped taking requests
+        """
+        for executor in (self.batch_executor, self.lookup_executor, self.revalidator):
+            executor.shutdown(cancel_futures=True)
+        if self.server is not None:
+            self.server.close()
+
+    def stats(self):
+        stats = self.server.stats() if self.server is not None else {}
+        stats['results'] = self.results.stats() if self.results is not None else None
+        stats['not_found'] = self.not_found.stats() if self.not_found is not None else None
+        stats['warm'] = {'entries': len(self.warm)}
+        stats['batching'] = self.batcher.stats() if self.batcher is not None else None
+        if self.prefetcher is not None:
+            stats['prefetch'] = self.prefetcher.stats()
+        return stats
+
+    @traced('queryServer')
     def queryServer(self, mms_ids):
         """
         Generates parameters neceessary to query Alma Server.
         Request content is xml, processed in :meth:`parse_bibs`
         """
+        current_span().set(mms_ids=len(mms_ids))
         return self.server.retrieveBibs(mms_ids)
 
+    @traced('queryRecords')
+    def queryRecords(self, mms_ids):
+        """
+        Same as :meth:`queryServer`, but returns the bib records parsed from
+        the responses as they were received
+        """
+        current_span().set(mms_ids=len(mms_ids))
+        return self.server.retrieveBibRecords(mms_ids)
+
     def getHoldings(self, mms_id, holdings_id):
         """
         Generates parameters neceessary to query Alma Server.
@@ -316,6 +898,26 @@ class AlmaProcessor:
         """
         return self.server.retrieveHoldings(mms_id, holdings_id)
 
+    @traced('getItems')
+    def getItems(self, holdings_url):
+        """
+        Follows the holdings link of a bib to the items of its first holding.
+        Used in :meth:`parse_bibs`
+        """
+        logger.debug(holdings_url)
+        holdings_info = self.getAdditional(holdings_url)
+        return self.getAdditional(self.items_url(holdings_info))
+
+    @staticmethod
+    def items_url(holdings_info):
+        """
+        Returns the items URL of the first holding in a Retrieve Holdings response
+        """
+        holdings_soup = BeautifulSoup(holdings_info, features='xml')
+        info_url = holdings_soup.find('holding')['link']
+        logger.debug(info_url)
+        return info_url + '/items'
+
     def getAdditional(self, url):
         """
         Allows for querying of alma provided URL without additional
@@ -325,6 +927,12 @@ class AlmaProcessor:
 
 
 class AlmaServerGateway:
+    # Alma's Retrieve Bibs API accepts at most 100 MMS IDs per call
+    DEFAULT_BIBS_CHUNK_SIZE = 100
+    # and its Retrieve Items API returns at most 100 items per page
+    DEFAULT_ITEMS_PAGE_SIZE = 100
+    DEFAULT_MAX_WORKERS = 8
+
     def __init__(self, config) -> None:
         if config is None:
             raise RuntimeError('Config file not provided')
@@ -334,20 +942,265 @@ class AlmaServerGateway:
 
         self.config = config
         self.api_key = environ.get('ALMA_API_KEY', '')
+        self.bibs_chunk_size = int(config.get('bibs_chunk_size', self.DEFAULT_BIBS_CHUNK_SIZE))
+        self.items_page_size = int(config.get('items_page_size', self.DEFAULT_ITEMS_PAGE_SIZE))
+        self.max_workers = int(config.get('max_workers', self.DEFAULT_MAX_WORKERS))
+        # Fetches the chunks of bibs and the pages of items for every request;
+        # its tasks only call Alma, so they never wait on the pool themselves
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='alma-fetch')
+
+        # One budget of Alma API calls for every request made by this process,
+        # charged for each attempt, retries included
+        self.rate_limiter = RateLimiter(**config['rate_limit']) if config.get('rate_limit') else None
+        self.http = HttpGateway(rate_limiter=self.rate_limiter, **config.get('http', {}))
+
+        # Identical requests made while one is already in flight share its response
+        self.single_flight = SingleFlight()
+
+        cache_config = config.get('cache') or {}
+        self.cache_ttls = cache_config.get('ttl', {})
+        # With the parsed results of the bibs cached, the responses they are
+        # built from are not, so that the age of a cached result, and of a
+        # stale one, is counted from when Alma was asked
+        if self.cache_ttls.get('bibs') and (config.get('result_cache') or {}).get('ttl'):
+            logger.warning('Retrieve Bibs responses are not cached, as result_cache is enabled')
+            self.cache_ttls = self.cache_ttls | {'bibs': 0}
+        self.cache = None
+        if any(self.cache_ttls.values()):
+            self.cache = TTLCache(max_entries=cache_config.get('max_entries', 1024),
+                                  max_bytes=cache_config.get('max_bytes'))
+
+    @staticmethod
+    def cache_key(url, params, new_parser=None):
+        """
+        Returns the URL with its query parameters merged with params, sorted,
+        and without the API key, so that it identifies the Alma resource only.
+        The results of a parser are kept apart from the raw responses, under a
+        fragment naming the parser.
+        """
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query) + [(k, str(v)) for k, v in params.items()]
+        query = sorted((k, v) for k, v in query if k != 'apikey')
+        key = f'{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path.rstrip("/")}?{urlencode(query)}'
+        return key + f'#{new_parser.__name__}' if new_parser is not None else key
+
+    def get(self, kind, url, params, new_parser=None):
+        """
+        Requests the url from the Alma API, answering from the cache when the
+        TTL configured for this kind of lookup (bibs, holdings or items) allows.
+        Concurrent identical requests are coalesced into a single call.
+        With new_parser, the response is fed to the parser it returns as it is
+        received, and the result of the parser is returned (and cached) instead.
+        """
+        key = self.cache_key(url, params, new_parser)
+        ttl = self.cache_ttl(kind)
+        if ttl:
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        def fetch():
+            try:
+                with UPSTREAM_SECONDS.time(kind):
+                    if new_parser is None:
+                        content = self.http.get(url, params)
+                        size = len(content)
+                    else:
+                        content, size = self.http.get_parsed(url, params, new_parser())
+            except HTTPException as e:
+                UPSTREAM_ERRORS.inc(kind, e.code)
+                raise
+            if ttl:
+                self.cache.set(key, content, ttl, size)
+            return content
+
+        return self.single_flight.do(key, fetch)
+
+    def cache_ttl(self, kind):
+        """
+        Returns the TTL for this kind of lookup, or None if it is not cached
+        """
+        return self.cache_ttls.get(kind) if self.cache is not None else None
+
+    def invalidate(self, mms_ids=None):
+        """
+        Drops the cached responses that mention any of the given MMS IDs,
+        either in the path or in the mms_id parameter, or every response if
+        no MMS IDs are given
+        """
+        if self.cache is None:
+            return
+
+        if mms_ids is None:
+            self.cache.invalidate()
+            return
+
+        mms_ids = set(mms_ids)
+
+        def mentions(key):
+            parts = urlsplit(key)
+            referenced = set(parts.path.split('/'))
+            for name, value in parse_qsl(parts.query):
+                if name == 'mms_id':
+                    referenced.update(value.split(','))
+            return not referenced.isdisjoint(mms_ids)
+
+        self.cache.invalidate_where(mentions)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.http.close()
+
+    def stats(self):
+        return {
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'single_flight': self.single_flight.stats(),
+            'http': self.http.stats(),
+            'rate_limit': self.rate_limiter.stats() if self.rate_limiter is not None else None,
+        }
 
     def retrieveBibs(self, mms_ids):
+        """
+        Retrieves the bibs for the given MMS IDs, split into chunks of at most
+        bibs_chunk_size IDs that are fetched in parallel. The IDs are sorted so
+        that the merged response is in a deterministic order.
+        """
+        chunks = self.bibs_chunks(mms_ids)
+
+        if len(chunks) == 1:
+            return self.retrieveBibsChunk(chunks[0])
+
+        contents = list(self.executor.map(propagate(self.retrieveBibsChunk), chunks))
+
+        return self.merge_bibs(contents)
+
+    def retrieveBibRecords(self, mms_ids):
+        """
+        Same as :meth:`retrieveBibs`, but each response is parsed into bib
+        records by a :class:`alma.parsers.BibsPullParser` as it is received.
+        Returns the records of every chunk, in chunk order.
+        """
+        chunks = self.bibs_chunks(mms_ids)
+
+        if len(chunks) == 1:
+            return self.retrieveBibRecordsChunk(chunks[0])
+
+        results = list(self.executor.map(propagate(self.retrieveBibRecordsChunk), chunks))
+
+        return merge_records(results)
+
+    def retrieveBibRecordsChunk(self, mms_ids):
+        return self.get('bibs', *self.bibs_request(mms_ids), new_parser=BibsPullParser)
+
+    def bibs_chunks(self, mms_ids):
+        mms_ids = sorted(mms_ids)
+        chunks = [mms_ids[i:i + self.bibs_chunk_size] for i in range(0, len(mms_ids), self.bibs_chunk_size)]
+        return chunks or [mms_ids]
+
+    def retrieveBibsChunk(self, mms_ids):
+        return self.get('bibs', *self.bibs_request(mms_ids))
+
+    def bibs_request(self, mms_ids):
         params = {'mms_id': ','.join(mms_ids), 'view': 'full', 'expand': 'p_avail', 'apikey': self.api_key}
 
         url = self.config['host'] + self.config['endpoint']
-        return HttpGateway.get(url, params)
+        return url, params
+
+    @classmethod
+    def merge_bibs(cls, contents):
+        """
+        Combines several Retrieve Bibs responses into a single <bibs> document
+        so that it can be processed in one pass by :meth:`AlmaProcessor.parse_bibs`
+        """
+        with span('merge_bibs', responses=len(contents)):
+            return cls.merge_records(contents, 'bib')
+
+    @classmethod
+    def merge_items(cls, contents):
+        """
+        Combines the pages of a Retrieve Items list into a single <items> document
+        """
+        with span('merge_items', responses=len(contents)):
+            return cls.merge_records(contents, 'item')
+
+    @staticmethod
+    def merge_records(contents, tag):
+        """
+        Appends the tag elements of every response to those of the first
+        """
+        parser = etree.XMLParser(recover=True)
+        try:
+            roots = [etree.fromstring(content, parser) for content in contents]
+        except etree.XMLSyntaxError:
+            abort(502, f'Unable to parse {tag}s response')
+
+        merged = roots[0]
+        for root in roots[1:]:
+            merged.extend(root.findall(tag))
+        merged.set('total_record_count', str(len(merged.findall(tag))))
+        return etree.tostring(merged, xml_declaration=True, encoding='UTF-8')
+
+    @staticmethod
+    def total_record_count(content):
+        """
+        Returns the total_record_count of a response, read from its root
+        element without parsing the rest, or None if it has none
+        """
+        if isinstance(content, str):
+            content = content.encode('UTF-8')
+        try:
+            for _, root in etree.iterparse(BytesIO(content), events=('start',), recover=True):
+                return int(root.get('total_record_count'))
+        except (etree.XMLSyntaxError, TypeError, ValueError):
+            return None
+
+    def retrieveItems(self, url, params):
+        """
+        Retrieves every page of a Retrieve Items list. The first page gives the
+        total number of items, then the remaining pages are fetched in parallel
+        and merged into it, so titles with many copies take two round trips.
+        """
+        first_page = self.get('items', url, params | self.page_params(0))
+        offsets = self.page_offsets(first_page)
+        if not offsets:
+            return first_page
+
+        def retrieve_page(offset):
+            return self.get('items', url, params | self.page_params(offset))
+
+        pages = list(self.executor.map(propagate(retrieve_page), offsets))
+
+        return self.merge_items([first_page] + pages)
+
+    def page_params(self, offset):
+        return {'limit': self.items_page_size, 'offset': offset}
+
+    def page_offsets(self, first_page):
+        """
+        Returns the offsets of the pages after the first
+        """
+        total = self.total_record_count(first_page)
+        if total is None:
+            return []
+        return list(range(self.items_page_size, total, self.items_page_size))
 
     def retrieveHoldings(self, mms_id, holdings_id):
+        return self.retrieveItems(*self.holdings_request(mms_id, holdings_id))
+
+    def holdings_request(self, mms_id, holdings_id):
         params = {'apikey': self.api_key, 'expand': 'due_date'}
 
         url = self.config['host'] + self.config['endpoint'] + mms_id + '/holdings/' + holdings_id + '/items'
-        return HttpGateway.get(url, params)
+        return url, params
 
     def retrieveAdditional(self, url):
+        kind, url, params = self.additional_request(url)
+        if kind == 'items':
+            return self.retrieveItems(url, params)
+        return self.get(kind, url, params)
+
+    def additional_request(self, url):
         params = {'apikey': self.api_key, 'expand': 'due_date'}
 
-        return HttpGateway.get(url, params)
+        kind = 'items' if url.rstrip('/').endswith('/items') else 'holdings'
+        return kind, url, params
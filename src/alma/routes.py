@@ -0,0 +1,201 @@
+from hmac import compare_digest
+from time import perf_counter
+from typing import Any, Callable, NamedTuple, Optional
+
+from core.logging import create_logger
+from core.metrics import CONTENT_TYPE
+from core.tracing import end_trace, new_request_id, start_trace
+from flask import abort
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from alma.metrics import REQUEST_ERRORS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, render_metrics
+from alma.processor import AlmaProcessor, BibsResult, BibsStream
+
+logger = create_logger(__name__)
+
+# Media type of the streamed responses, one JSON object per line
+NDJSON = 'application/x-ndjson'
+
+
+class Route(NamedTuple):
+    """
+    An alma-service endpoint, served by both the Flask application in
+    alma.web and the ASGI application in alma.asgi. The handlers are called
+    with the processor and the JSON data of the request; with an
+    :class:`alma.aio.AsyncAlmaProcessor`, they may return an awaitable.
+    """
+    path: str
+    methods: tuple[str, ...]
+    handler: Callable[[AlmaProcessor, Any], Any]
+    # Requests must have a JSON body
+    json_body: bool = False
+    # Used instead of handler for requests accepting NDJSON
+    stream_handler: Optional[Callable[[AlmaProcessor, Any], Any]] = None
+    # Only served to requests sending the invalidate token
+    authorized: bool = False
+
+
+class TextResponse(NamedTuple):
+    """
+    A response returned as is instead of as JSON
+    """
+    text: str
+    content_type: str
+
+
+def ping(processor, data):
+    return {'status': 'ok'}
+
+
+def stats(processor, data):
+    return processor.stats()
+
+
+def metrics(processor, data):
+    return TextResponse(render_metrics(processor.stats()), CONTENT_TYPE)
+
+
+def invalidate(processor, data):
+    logger.info(f'requestData={data!r}')
+    if data is not None:
+        # A list of MMS IDs, validated as the textbooks requests are
+        data = processor.validate_bibs(data)
+    processor.invalidate(data or None)
+    return {'status': 'ok'}
+
+
+def textbooks(processor, data):
+    return processor.processBibs(data, **AlmaProcessor.BIBS_QUERIES['textbooks'])
+
+
+def stream_textbooks(processor, data):
+    return processor.streamBibs(data, **AlmaProcessor.BIBS_QUERIES['textbooks'])
+
+
+def equipment(processor, data):
+    return processor.processBibs(data, **AlmaProcessor.BIBS_QUERIES['equipment'])
+
+
+def stream_equipment(processor, data):
+    return processor.streamBibs(data, **AlmaProcessor.BIBS_QUERIES['equipment'])
+
+
+def holdings(processor, data):
+    return processor.processHoldings(data)
+
+
+def batch(processor, data):
+    return processor.processBatch(data)
+
+
+ROUTES = [
+    Route('/', ('GET',), ping),
+    Route('/alma-service/ping', ('GET',), ping),
+    Route('/alma-service/stats', ('GET',), stats),
+    Route('/alma-service/metrics', ('GET',), metrics),
+    Route('/alma-service/invalidate', ('POST',), invalidate, authorized=True),
+    Route('/alma-service/textbooks', ('GET', 'POST'), textbooks, json_body=True, stream_handler=stream_textbooks),
+    Route('/alma-service/holdings', ('GET', 'POST'), holdings, json_body=True),
+    Route('/alma-service/equipment', ('GET', 'POST'), equipment, json_body=True, stream_handler=stream_equipment),
+    Route('/alma-service/batch', ('POST',), batch, json_body=True),
+]
+
+
+def is_authorized(authorization: Optional[str], token: str) -> bool:
+    """
+    Returns True if the value of an Authorization header is the bearer token
+    """
+    scheme, _, credentials = (authorization or '').partition(' ')
+    return scheme.lower() == 'bearer' and compare_digest(credentials.strip().encode(), token.encode())
+
+
+def authorize(route: Route, authorization: Optional[str], token: Optional[str]):
+    """
+    Aborts a request to a route that requires the invalidate token if the
+    request does not send it, or with a 404 if no token is configured, as
+    flushing the caches spends the Alma API budget they protect
+    """
+    if not route.authorized:
+        return
+    if not token:
+        abort(404)
+    if not is_authorized(authorization, token):
+        abort(403, 'Not authorized to invalidate the caches')
+
+
+def request_data(route: Route, is_json: bool, get_json: Callable[[bool], Any]):
+    """
+    Returns the JSON data of a request to the route, aborting if the route
+    requires a JSON body and the request does not have one. get_json returns
+    the parsed body, and with silent, None instead of failing if it is not
+    valid JSON.
+    """
+    if not route.json_body:
+        return get_json(True)
+
+    if not is_json:
+        abort(400, 'Request was not JSON')
+
+    requestData = get_json(False)
+    logger.info(f'{requestData=}')
+    return requestData
+
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    """
+    Returns True if the value of an Accept header prefers NDJSON to JSON
+    """
+    return parse_accept_header(accept, MIMEAccept).best_match(['application/json', NDJSON]) == NDJSON
+
+
+def result_headers(result) -> dict[str, str]:
+    """
+    Returns the response headers reporting on the result of a handler
+    """
+    return result.headers() if isinstance(result, (BibsResult, BibsStream)) else {}
+
+
+def stream_error(e) -> dict:
+    """
+    Returns the last line of a streamed response that failed once started
+    """
+    logger.warning(e.description)
+    return {'error': {'status': e.code, 'message': e.description}}
+
+
+class RequestMonitor:
+    """
+    Records the latency and errors of a request in the request metrics, and
+    gives it an ID, taken from its X-Request-ID header if it has one, with a
+    trace of the request if tracing is enabled
+    """
+    def __init__(self, route: str, method: str, request_id: Optional[str], tracing_enabled: bool) -> None:
+        self.start_time = perf_counter()
+        self.route = route
+        REQUESTS_IN_FLIGHT.inc()
+        self.request_id = new_request_id(request_id)
+        self.trace, self.trace_tokens = start_trace(self.request_id, tracing_enabled, route=route, method=method)
+
+    def headers(self, status: int, server_timing: bool) -> dict[str, str]:
+        """
+        Returns the headers to add to the response with the given status
+        """
+        headers = {'X-Request-ID': self.request_id}
+        if self.trace is not None:
+            self.trace.root.set(status=status)
+            if server_timing:
+                headers['Server-Timing'] = self.trace.server_timing()
+        return headers
+
+    def record(self, status: int):
+        REQUEST_SECONDS.observe(perf_counter() - self.start_time, self.route)
+        if status >= 400:
+            REQUEST_ERRORS.inc(self.route, status)
+        REQUESTS_IN_FLIGHT.dec()
+
+    def end(self):
+        """
+        Ends the trace of the request, once its response has been sent
+        """
+        end_trace(self.trace, self.trace_tokens)
@@ -1,4 +1,6 @@
 
+import signal
+import sys
 from os import environ
 
 import click
@@ -27,17 +29,79 @@ logger = create_logger(__name__)
 @click.version_option(__version__, '--version', '-V')
 @click.help_option('--help', '-h')
 def run(listen, alma_config_file):
-    load_dotenv()
-    if 'ALMA_API_KEY' not in environ:
-        raise RuntimeError('ALMA_API_KEY not set in environment')
+    check_environment()
 
     server_identity = f'alma-service/{__version__}'
+    prefetcher = None
+    processor = None
     try:
+        flask_app = app(config=alma_config_file)
+        prefetcher = flask_app.extensions.get('alma_prefetcher')
+        processor = flask_app.extensions.get('alma_processor')
+        if prefetcher is not None:
+            # Turn "docker stop" into a normal exit so the prefetcher is stopped
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            prefetcher.start()
         serve(
-            app=app(config=alma_config_file),
+            app=flask_app,
             listen=listen,
             ident=server_identity,
         )
     except (OSError, RuntimeError) as e:
         logger.error(f'Exiting: {e}')
         raise SystemExit(1) from e
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop(timeout=10)
+        if processor is not None:
+            processor.close()
+
+
+@click.command()
+@click.option(
+    '--listen',
+    default='0.0.0.0:5000',
+    help='Address and port to listen on. Default is "0.0.0.0:5000".',
+    metavar='[ADDRESS]:PORT',
+)
+@click.option(
+    '--alma_config', 'alma_config_file',
+    type=click.File(),
+    help='Configuration file for the Alma API.',
+)
+@click.version_option(__version__, '--version', '-V')
+@click.help_option('--help', '-h')
+def run_asgi(listen, alma_config_file):
+    """
+    Serves the ASGI application with uvicorn. Requires the optional "asgi"
+    dependencies.
+    """
+    check_environment()
+
+    try:
+        import uvicorn
+        from alma.asgi import app as asgi_app
+    except ImportError as e:
+        logger.error(f'Exiting: {e}, install alma-service[asgi]')
+        raise SystemExit(1) from e
+
+    host, _, port = listen.rpartition(':')
+    server_identity = f'alma-service/{__version__}'
+    try:
+        uvicorn.run(
+            asgi_app(config=alma_config_file),
+            host=host or '0.0.0.0',
+            port=int(port),
+            server_header=False,
+            headers=[('server', server_identity)],
+            log_config=None,
+        )
+    except (OSError, RuntimeError) as e:
+        logger.error(f'Exiting: {e}')
+        raise SystemExit(1) from e
+
+
+def check_environment():
+    load_dotenv()
+    if 'ALMA_API_KEY' not in environ:
+        raise RuntimeError('ALMA_API_KEY not set in environment')
@@ -1,12 +1,17 @@
+from os import environ
 from typing import Any, Optional, TextIO
 
 from core.logging import create_logger
 from core.web_errors import blueprint
-from flask import Flask, abort, request
+from flask import Flask, Response, g, request, stream_with_context
+from werkzeug.exceptions import HTTPException
 from yaml import safe_load
 
 from alma import __version__
+from alma.prefetch import Prefetcher
 from alma.processor import AlmaServerGateway, AlmaProcessor
+from alma.routes import (NDJSON, ROUTES, RequestMonitor, TextResponse, authorize, request_data, result_headers,
+                         stream_error, wants_ndjson)
 
 logger = create_logger(__name__)
 
@@ -35,46 +40,83 @@ def _create_app(server: Optional[AlmaServerGateway] = None) -> Flask:
     _app.register_blueprint(blueprint)
     logger.info(f'Starting alma-service/{__version__}')
 
-    @_app.route('/')
-    def root():
-        return {'status': 'ok'}
-
-    @_app.route('/alma-service/ping')
-    def ping():
-        return {'status': 'ok'}
-
-    @_app.route('/alma-service/textbooks', methods=['GET', 'POST'])  # type: ignore
-    def bibs():
-        if not request.is_json:
-            abort(400, 'Request was not JSON')
-
-        requestData = request.get_json()
-        logger.info(f'{requestData=}')
-        processor = AlmaProcessor(server)
-        responseData = processor.processBibs(requestData, 'TPTXB')
-        return responseData
-
-    @_app.route('/alma-service/holdings', methods=['GET', 'POST'])  # type: ignore
-    def holdings():
-        if not request.is_json:
-            abort(400, 'Request was not JSON')
-
-        requestData = request.get_json()
-        logger.info(f'{requestData=}')
-        processor = AlmaProcessor(server)
-        responseData = processor.processHoldings(requestData)
-        return responseData
-
-    @_app.route('/alma-service/equipment', methods=['GET', 'POST'])  # type: ignore
-    def equipment():
-        if not request.is_json:
-            abort(400, 'Request was not JSON')
-
-        requestData = request.get_json()
-        logger.info(f'{requestData=}')
-        processor = AlmaProcessor(server)
-        responseData = processor.processBibs(requestData, limit_collection=None,
-                                             include_course=False, check_holdings=True)
-        return responseData
+    # The processor is shared by all requests so that its caches outlive them
+    processor = AlmaProcessor(server)
+
+    # Started and stopped by alma.server.run, alongside the waitress server
+    prefetcher = None
+    if processor.config.get('prefetch'):
+        prefetcher = Prefetcher(processor, processor.config['prefetch'])
+        processor.prefetcher = prefetcher
+    _app.extensions['alma_prefetcher'] = prefetcher
+    # Closed by alma.server.run once waitress has stopped
+    _app.extensions['alma_processor'] = processor
+
+    # Every request gets an ID, added to its log messages; with tracing
+    # enabled, the spans of the request are logged as well
+    tracing_config = processor.config.get('tracing') or {}
+    tracing_enabled = bool(tracing_config.get('enabled', False))
+    server_timing = bool(tracing_config.get('server_timing', False))
+
+    # Sent by the requests allowed to invalidate the caches
+    invalidate_token = environ.get('INVALIDATE_TOKEN')
+
+    @_app.before_request
+    def start_request():
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.monitor = RequestMonitor(route, request.method, request.headers.get('X-Request-ID'), tracing_enabled)
+
+    @_app.after_request
+    def record_request(response):
+        if 'monitor' in g:
+            g.monitor.record(response.status_code)
+            response.headers.update(g.monitor.headers(response.status_code, server_timing))
+        return response
+
+    @_app.teardown_request
+    def end_request(exc):
+        # The trace of a streamed response is ended by its generator instead
+        if 'monitor' in g and not g.get('streaming', False):
+            g.monitor.end()
+
+    def ndjson_response(stream):
+        """
+        Returns a response writing each keyed entry of the stream as a line of
+        JSON as soon as it is generated. An error once the response has started
+        is written as a last line with an "error" key.
+        """
+        # Teardown runs before the response is streamed, as well as after
+        g.streaming = True
+        monitor = g.get('monitor')
+
+        def generate():
+            try:
+                for key, entry in stream:
+                    yield _app.json.dumps({key: entry}, separators=(',', ':')) + '\n'
+            except HTTPException as e:
+                yield _app.json.dumps(stream_error(e), separators=(',', ':')) + '\n'
+            finally:
+                if monitor is not None:
+                    monitor.end()
+
+        return Response(stream_with_context(generate()), content_type=NDJSON, headers=result_headers(stream))
+
+    def view(route):
+        def handle():
+            authorize(route, request.headers.get('Authorization'), invalidate_token)
+            requestData = request_data(route, request.is_json, lambda silent: request.get_json(silent=silent))
+
+            if route.stream_handler is not None and wants_ndjson(request.headers.get('Accept')):
+                return ndjson_response(route.stream_handler(processor, requestData))
+
+            responseData = route.handler(processor, requestData)
+            if isinstance(responseData, TextResponse):
+                return Response(responseData.text, content_type=responseData.content_type)
+            return responseData, result_headers(responseData)
+
+        return handle
+
+    for route in ROUTES:
+        _app.add_url_rule(route.path, endpoint=route.path, view_func=view(route), methods=route.methods)
 
     return _app
@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a per-entry time to live.
+
+    The cache is bounded by a maximum number of entries and, optionally, by a
+    byte budget for the sizes given to :meth:`set`. The least recently used
+    entries are evicted first when either bound is exceeded.
+
+    With a stale_ttl, expired entries are kept for that much longer so that
+    they can still be read with :meth:`get_stale`, e.g. as a fallback when
+    their source is unavailable.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, stale_ttl=0) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value for the key, or None if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, value, _, _ = entry
+            now = monotonic()
+            if expires <= now:
+                if expires + self.stale_ttl <= now:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key, max_age):
+        """
+        Returns the cached value for the key and its age in seconds, whether or
+        not it has expired, or None if it is missing or older than max_age
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value, _, stored = entry
+            now = monotonic()
+            if expires + self.stale_ttl <= now:
+                self._remove(key)
+                return None
+
+            age = now - stored
+            if age > max_age:
+                return None
+
+            self.stale_hits += 1
+            return value, age
+
+    def set(self, key, value, ttl, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            now = monotonic()
+            self._entries[key] = (now + ttl, value, size, now)
+            self.size_bytes += size
+
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self.size_bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Removes the entry for the key, or every entry if no key is given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self.size_bytes = 0
+            elif key in self._entries:
+                self._remove(key)
+
+    def invalidate_where(self, predicate):
+        """
+        Removes every entry whose key matches the predicate
+        """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions,
+        }
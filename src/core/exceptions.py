@@ -29,6 +29,15 @@ class BadGatewayError(Exception):
         abort(502, message)
 
 
+class ServiceUnavailableError(Exception):
+    """
+    Raised when this application declines to call the server because it is
+    failing or overloaded
+    """
+    def __init__(self, message) -> None:
+        abort(503, message)
+
+
 class GatewayTimeoutError(Exception):
     """
     When this application's request to the server times outs
@@ -1,15 +1,308 @@
-from time import perf_counter
+import asyncio
+import threading
+from collections import deque
+from time import monotonic, perf_counter, sleep
 
 import requests
 from bs4 import BeautifulSoup
 from flask import abort
+from requests.adapters import HTTPAdapter
 
+from core.exceptions import BadGatewayError, GatewayTimeoutError, ServiceUnavailableError
 from core.logging import create_logger
+from core.tracing import current_span, traced
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 logger = create_logger(__name__)
 
 
+class CircuitBreaker:
+    """
+    Stops calls to a failing server. The breaker is closed while the share of
+    failed or slow calls within the last window seconds stays below
+    failure_rate. Once it is exceeded, over at least min_calls calls, the
+    breaker opens and calls fail immediately for open_seconds. It then
+    becomes half-open and lets a single trial call through, closing again if
+    that call succeeds and reopening if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate=0.5, min_calls=10, window=30, open_seconds=30, slow_call=None) -> None:
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.slow_call = slow_call
+        self.state = self.CLOSED
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self.rejected = 0
+        self._calls = deque()
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises ServiceUnavailableError if the call is not allowed through.
+        Returns True if the call is the trial call of the half-open breaker,
+        to be passed on to :meth:`record` or :meth:`cancel`.
+        """
+        with self._lock:
+            if self.state == self.OPEN and monotonic() - self._opened_at >= self.open_seconds:
+                self._transition(self.HALF_OPEN)
+
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+            self.rejected += 1
+        raise ServiceUnavailableError('The Alma API is unavailable, try again later')
+
+    def record(self, failed, elapsed, trial=False):
+        """
+        Records the outcome of a call allowed through by :meth:`before_call`.
+        Only the trial call decides whether a half-open breaker closes; calls
+        let through before the breaker opened are not counted once it has.
+        """
+        failed = failed or (self.slow_call is not None and elapsed > self.slow_call)
+        now = monotonic()
+        with self._lock:
+            if trial:
+                self._trial_in_flight = False
+                self._transition(self.OPEN if failed else self.CLOSED)
+                return
+            if self.state != self.CLOSED:
+                return
+
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+
+            if len(self._calls) >= self.min_calls:
+                failures = sum(1 for _, call_failed in self._calls if call_failed)
+                if failures / len(self._calls) >= self.failure_rate:
+                    self._transition(self.OPEN)
+
+    def cancel(self, trial=False):
+        """
+        Records that a call allowed through by :meth:`before_call` was not made
+        """
+        if trial:
+            with self._lock:
+                self._trial_in_flight = False
+
+    def _transition(self, state):
+        logger.warning(f'Alma API circuit breaker changed from {self.state} to {state}')
+        self.state = state
+        self.transitions[state] += 1
+        self._calls.clear()
+        if state == self.OPEN:
+            self._opened_at = monotonic()
+
+    def stats(self):
+        return {'state': self.state, 'transitions': dict(self.transitions), 'rejected': self.rejected}
+
+
+class ConcurrencyLimiter:
+    """
+    Adaptive (AIMD) limit on the number of concurrent calls to a server. The
+    limit grows by one for every limit successful calls, and is multiplied by
+    decrease when a call fails or takes longer than slow_call seconds, so that
+    it settles near the concurrency the server can sustain. Callers over the
+    limit wait for up to queue_timeout seconds before failing.
+    """
+    def __init__(self, initial=10, min_limit=1, max_limit=10, decrease=0.5, slow_call=None,
+                 queue_timeout=10) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.slow_call = slow_call
+        self.queue_timeout = queue_timeout
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Waits for a free slot, raising ServiceUnavailableError if none frees
+        up within queue_timeout seconds
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), self.queue_timeout):
+                self.rejected += 1
+                raise ServiceUnavailableError('Too many requests waiting for the Alma API')
+            self.in_flight += 1
+
+    def release(self, failed, elapsed):
+        with self._condition:
+            self.in_flight -= 1
+            old_limit = int(self.limit)
+            if failed or (self.slow_call is not None and elapsed > self.slow_call):
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            if int(self.limit) != old_limit:
+                logger.info(f'Alma API concurrency limit changed from {old_limit} to {int(self.limit)}')
+            self._condition.notify_all()
+
+    def cancel(self):
+        """
+        Frees the slot of a call that was not made, leaving the limit as is
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        return {'limit': int(self.limit), 'in_flight': self.in_flight, 'rejected': self.rejected}
+
+
+class AsyncConcurrencyLimiter(ConcurrencyLimiter):
+    """
+    asyncio counterpart of :class:`ConcurrencyLimiter`, for callers on one
+    event loop. Callers over the limit wait, in order, for a slot to be handed
+    to them when a call is released, rather than blocking the event loop.
+    """
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._waiters = deque()
+
+    async def acquire(self):
+        """
+        Waits for a free slot, raising ServiceUnavailableError if none frees
+        up within queue_timeout seconds
+        """
+        if not self._waiters and self.try_acquire():
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # Shielded so that the slot of a waiter that was just handed one is not lost
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as e:
+            if waiter.done():
+                # Handed a slot just as it gave up, which is passed on
+                self.in_flight -= 1
+                self._wake()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise ServiceUnavailableError('Too many requests waiting for the Alma API')
+            raise
+
+    def release(self, failed, elapsed):
+        super().release(failed, elapsed)
+        self._wake()
+
+    def cancel(self):
+        super().cancel()
+        self._wake()
+
+    def _wake(self):
+        """
+        Hands the free slots to the callers that have waited longest
+        """
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            self.in_flight += 1
+            waiter.set_result(None)
+
+
 class HttpGateway:
+    """
+    Makes GET requests through a keep-alive connection pool shared by all
+    threads. Each thread gets its own requests.Session, but every session is
+    mounted on the same HTTPAdapter, so connections are reused across threads.
+
+    Every attempt at a request goes through a :class:`CircuitBreaker` and a
+    :class:`ConcurrencyLimiter`, configured by the circuit_breaker and
+    concurrency dicts of keyword arguments, then takes a token from the
+    rate_limiter, if given, so that calls that fail fast cost no budget.
+    Responses with a RETRY_STATUSES status are retried up to retries times,
+    after the time given by their Retry-After header or an exponential
+    backoff, so that each retry counts against the rate limit and the breaker
+    like any call. The backoff is capped at max_backoff seconds (by default,
+    read_timeout), and a response asking for a longer Retry-After is returned
+    at once rather than holding the request thread.
+    """
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_CONNECT_TIMEOUT = 5
+    DEFAULT_READ_TIMEOUT = 30
+    DEFAULT_RETRIES = 2
+    DEFAULT_BACKOFF_FACTOR = 0.5
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    STREAM_CHUNK_SIZE = 65536
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, max_backoff=None, circuit_breaker=None, concurrency=None,
+                 rate_limiter=None) -> None:
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff if max_backoff is not None else read_timeout
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = CircuitBreaker(**(circuit_breaker or {}))
+        self.limiter = ConcurrencyLimiter(**({'initial': pool_size, 'max_limit': pool_size} | (concurrency or {})))
+        # Retried by _get instead, so that every attempt is accounted for
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
+
+    def close(self):
+        self.adapter.close()
+
+    def stats(self):
+        return {'circuit_breaker': self.circuit_breaker.stats(), 'concurrency': self.limiter.stats()}
+
+    def retry_delay(self, r, attempt):
+        """
+        Returns the seconds to wait before retrying the response to the given
+        attempt (counting from 0), or None if its Retry-After is longer than
+        max_backoff and it should not be retried
+        """
+        retry_after = r.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return int(retry_after) if int(retry_after) <= self.max_backoff else None
+        return min(self.backoff_factor * (2 ** attempt), self.max_backoff)
+
+    @staticmethod
+    def is_failure(status_code):
+        """
+        Returns True if the status means that the server is failing or
+        overloaded, as opposed to rejecting the request itself
+        """
+        return status_code in HttpGateway.RETRY_STATUSES
+
     @staticmethod
     def _parse_error(content):
         if content == '':
@@ -41,14 +334,99 @@ class HttpGateway:
             extra={'http_status_code': response.status_code, 'request_response_time_in_secs': request_response_time}
         )
 
-    @staticmethod
-    def get(url, params):
+    @traced('alma_get')
+    def get(self, url, params):
+        return self._get(url, params)
+
+    @traced('alma_get')
+    def get_parsed(self, url, params, parser):
+        """
+        Same as :meth:`get`, but the body of a successful response is fed to
+        the parser in chunks as it is received, instead of being buffered.
+        Returns the result of parser.close() and the number of bytes received.
+        """
+        return self._get(url, params, parser)
+
+    def _get(self, url, params, parser=None):
         logger.debug(f'{url=}, {params=}')
+        current_span().set(url=url)
+
+        for attempt in range(self.retries + 1):
+            r, parsed, request_response_time = self._call(url, params, parser)
+            if r.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                break
+            delay = self.retry_delay(r, attempt)
+            if delay is None:
+                break
+            HttpGateway.log_response('warning', url, r, request_response_time)
+            sleep(delay)
+
+        if parsed is not None:
+            HttpGateway.log_response('info', url, r, request_response_time)
+            return parsed
+
+        return HttpGateway.handle_response(url, r, r.reason, request_response_time)
+
+    def _call(self, url, params, parser):
+        """
+        Makes one attempt at the request. Returns the response, the result of
+        the parser and bytes received if the response was fed to it, and the
+        time taken.
+        """
+        trial = self.circuit_breaker.before_call()
+        try:
+            self.limiter.acquire()
+        except BaseException:
+            self.circuit_breaker.cancel(trial)
+            raise
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+        except BaseException:
+            self.limiter.cancel()
+            self.circuit_breaker.cancel(trial)
+            raise
 
         request_start_time = perf_counter()
-        r = requests.get(url, params=params)
-        request_response_time = (perf_counter() - request_start_time)
+        failed = True
+        r = None
+        parsed = None
+        try:
+            r = self.session.get(url, params=params, timeout=self.timeout, stream=parser is not None)
+            if parser is not None and r.status_code < 400:
+                received = 0
+                for chunk in r.iter_content(self.STREAM_CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(chunk)
+                parsed = (parser.close(), received)
+            else:
+                received = len(r.content)
+            current_span().set(status=r.status_code, bytes=received)
+            failed = self.is_failure(r.status_code)
+        except requests.exceptions.Timeout as e:
+            logger.warning(f"Timed out requesting '{url}': {e}")
+            raise GatewayTimeoutError('Timed out waiting for the Alma API')
+        except requests.exceptions.ConnectionError as e:
+            logger.warning(f"Failed to connect to '{url}': {e}")
+            raise BadGatewayError('Unable to connect to the Alma API')
+        except requests.exceptions.ChunkedEncodingError as e:
+            logger.warning(f"Failed to read the response from '{url}': {e}")
+            raise BadGatewayError('Incomplete response from the Alma API')
+        finally:
+            if r is not None:
+                r.close()
+            request_response_time = (perf_counter() - request_start_time)
+            self.limiter.release(failed, request_response_time)
+            self.circuit_breaker.record(failed, request_response_time, trial)
+
+        return r, parsed, request_response_time
 
+    @staticmethod
+    def handle_response(url, r, reason, request_response_time):
+        """
+        Logs the response and returns its content, or aborts with the status
+        received from the Alma API
+        """
         if r.status_code == 400:
             HttpGateway.log_response('warning', url, r, request_response_time)
             error_content = r.content.decode('UTF-8') if r.content else ''
@@ -59,9 +437,136 @@ class HttpGateway:
             HttpGateway.log_response('warning', url, r, request_response_time)
             abort(r.status_code, 'Received 500 from the Alma API')
 
-        if not r.ok:
+        if r.status_code >= 400:
             HttpGateway.log_response('warning', url, r, request_response_time)
-            abort(r.status_code, r.reason)
+            abort(r.status_code, reason)
 
         HttpGateway.log_response('info', url, r, request_response_time)
         return r.content
+
+
+class AsyncHttpGateway:
+    """
+    asyncio counterpart of :class:`HttpGateway`, backed by an httpx.AsyncClient
+    connection pool. Responses are handled exactly as in HttpGateway, and
+    429/5xx responses are retried with the same exponential backoff.
+
+    Requires the optional "asgi" dependencies.
+    """
+    def __init__(self, pool_size=HttpGateway.DEFAULT_POOL_SIZE, connect_timeout=HttpGateway.DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=HttpGateway.DEFAULT_READ_TIMEOUT, retries=HttpGateway.DEFAULT_RETRIES,
+                 backoff_factor=HttpGateway.DEFAULT_BACKOFF_FACTOR, max_backoff=None, circuit_breaker=None,
+                 concurrency=None, rate_limiter=None, transport=None) -> None:
+        if httpx is None:
+            raise RuntimeError('httpx is required for the async gateway, install alma-service[asgi]')
+
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = CircuitBreaker(**(circuit_breaker or {}))
+        self.limiter = AsyncConcurrencyLimiter(**({'initial': pool_size, 'max_limit': pool_size}
+                                                  | (concurrency or {})))
+
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff if max_backoff is not None else read_timeout
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=transport,
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self):
+        return {'circuit_breaker': self.circuit_breaker.stats(), 'concurrency': self.limiter.stats()}
+
+    @traced('alma_get')
+    async def get(self, url, params):
+        return await self._get(url, params)
+
+    @traced('alma_get')
+    async def get_parsed(self, url, params, parser):
+        """
+        Same as :meth:`HttpGateway.get_parsed`
+        """
+        return await self._get(url, params, parser)
+
+    retry_delay = HttpGateway.retry_delay
+
+    async def _get(self, url, params, parser=None):
+        logger.debug(f'{url=}, {params=}')
+        current_span().set(url=url)
+
+        for attempt in range(self.retries + 1):
+            r, parsed, request_response_time = await self._call(url, params, parser)
+            if r.status_code not in HttpGateway.RETRY_STATUSES or attempt == self.retries:
+                break
+            delay = self.retry_delay(r, attempt)
+            if delay is None:
+                break
+            HttpGateway.log_response('warning', url, r, request_response_time)
+            await asyncio.sleep(delay)
+
+        if parsed is not None:
+            HttpGateway.log_response('info', url, r, request_response_time)
+            return parsed
+
+        return HttpGateway.handle_response(url, r, r.reason_phrase, request_response_time)
+
+    async def _call(self, url, params, parser):
+        """
+        Same as :meth:`HttpGateway._call`
+        """
+        trial = self.circuit_breaker.before_call()
+        try:
+            await self.limiter.acquire()
+        except BaseException:
+            self.circuit_breaker.cancel(trial)
+            raise
+        try:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+        except BaseException:
+            self.limiter.cancel()
+            self.circuit_breaker.cancel(trial)
+            raise
+
+        request_start_time = perf_counter()
+        failed = True
+        r = None
+        parsed = None
+        try:
+            request = self.client.build_request('GET', url, params=params)
+            try:
+                r = await self.client.send(request, stream=parser is not None)
+            except httpx.TimeoutException as e:
+                logger.warning(f"Timed out requesting '{url}': {e}")
+                raise GatewayTimeoutError('Timed out waiting for the Alma API')
+            except httpx.TransportError as e:
+                logger.warning(f"Failed to connect to '{url}': {e}")
+                raise BadGatewayError('Unable to connect to the Alma API')
+
+            if parser is not None and r.status_code < 400:
+                received = 0
+                async for chunk in r.aiter_bytes(HttpGateway.STREAM_CHUNK_SIZE):
+                    received += len(chunk)
+                    parser.feed(chunk)
+                parsed = (parser.close(), received)
+            else:
+                received = len(await r.aread())
+            current_span().set(status=r.status_code, bytes=received)
+            failed = HttpGateway.is_failure(r.status_code)
+        except httpx.TimeoutException as e:
+            logger.warning(f"Timed out reading the response from '{url}': {e}")
+            raise GatewayTimeoutError('Timed out waiting for the Alma API')
+        except httpx.TransportError as e:
+            logger.warning(f"Failed to read the response from '{url}': {e}")
+            raise BadGatewayError('Incomplete response from the Alma API')
+        finally:
+            if r is not None:
+                await r.aclose()
+            request_response_time = (perf_counter() - request_start_time)
+            self.limiter.release(failed, request_response_time)
+            self.circuit_breaker.record(failed, request_response_time, trial)
+
+        return r, parsed, request_response_time
@@ -1,5 +1,6 @@
 import logging
 import sys
+from contextvars import ContextVar
 from datetime import datetime
 from os import environ
 from typing import Any, Dict
@@ -71,6 +72,24 @@ class RedactingFilter(logging.Filter):
         return msg
 
 
+# ID of the request being handled, set by core.tracing.start_trace
+request_id = ContextVar('request_id', default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Logging Filter implementation that adds the ID of the request being
+    handled, if any, to the record as "request_id"
+    """
+    def filter(self, record):
+        current_request_id = request_id.get()
+        if current_request_id is not None:
+            record.request_id = current_request_id
+        return True
+
+
+request_id_filter = RequestIdFilter()
+
 # Determine if DEBUG logging should be enabled
 debug = environ.get("FLASK_DEBUG", default=False)
 
@@ -102,6 +121,7 @@ def create_logger(name):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
     logHandler = logging.StreamHandler()
+    logHandler.addFilter(request_id_filter)
 
     if log_redacting_filter:
         logHandler.addFilter(log_redacting_filter)
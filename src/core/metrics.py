@@ -0,0 +1,126 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics, which are kept per tuple of label values, in
+    the order of labelnames
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        Returns the metric in the Prometheus text exposition format
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines += self._render_value(labels, value)
+        return '\n'.join(lines) + '\n'
+
+    def _render_value(self, labels, value):
+        return [f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """
+    Counts observations into buckets with the given upper bounds. Only the
+    count of the bucket an observation falls into is incremented; the
+    cumulative counts are computed when the histogram is rendered.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # One count per bucket, one for +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labels)
+
+    def _render_value(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, [("le", _number(bound))])} '
+                         f'{cumulative}')
+        lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(counts[-1])}')
+        lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+def render(metrics):
+    """
+    Returns the given metrics in the Prometheus text exposition format
+    """
+    return ''.join(metric.render() for metric in metrics)
@@ -0,0 +1,152 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from time import monotonic, sleep
+
+from core.exceptions import TooManyRequestsError
+from core.logging import create_logger
+
+logger = create_logger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket limiting calls to per_second on average, with bursts of up
+    to burst calls, and to per_day calls per UTC day. A caller over the
+    per-second budget waits for a token for up to max_wait seconds; a caller
+    that would wait longer, or that is over the daily budget, gets a
+    TooManyRequestsError.
+
+    With a state_file, the remaining daily budget is saved to it at most every
+    save_interval seconds and at exit, and restored from it on startup.
+    """
+    def __init__(self, per_second=None, burst=None, per_day=None, max_wait=5, state_file=None,
+                 save_interval=10) -> None:
+        self.per_second = per_second
+        self.burst = burst or per_second or 1
+        self.per_day = per_day
+        self.max_wait = max_wait
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self.tokens = float(self.burst)
+        self.day = self.today()
+        self.remaining_today = per_day
+        self.waited = 0
+        self.rejected = 0
+        self._refilled = monotonic()
+        self._saved = monotonic()
+        self._lock = threading.Lock()
+
+        if state_file is not None:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def today():
+        return datetime.now(timezone.utc).date().isoformat()
+
+    def load(self):
+        try:
+            with open(self.state_file) as fh:
+                state = json.load(fh)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f'Unable to read rate limit state from {self.state_file}: {e}')
+            return
+
+        if self.per_day is not None and state.get('day') == self.day:
+            self.remaining_today = max(0, min(self.per_day, int(state.get('remaining', self.per_day))))
+            logger.info(f'{self.remaining_today} Alma API calls remaining today')
+
+    def save(self):
+        with self._lock:
+            state = {'day': self.day, 'remaining': self.remaining_today}
+            self._saved = monotonic()
+
+        # Written to a temporary file first so that a crash never leaves a partial file
+        temp_file = f'{self.state_file}.tmp'
+        try:
+            with open(temp_file, 'w') as fh:
+                json.dump(state, fh)
+            os.replace(temp_file, self.state_file)
+        except OSError as e:
+            logger.warning(f'Unable to save rate limit state to {self.state_file}: {e}')
+
+    def _take(self):
+        """
+        Takes a token if one is available, returning 0, or else returns the
+        number of seconds until one will be
+        """
+        with self._lock:
+            if self.per_day is not None:
+                today = self.today()
+                if today != self.day:
+                    self.day = today
+                    self.remaining_today = self.per_day
+                if self.remaining_today <= 0:
+                    self.rejected += 1
+                    raise TooManyRequestsError('Daily Alma API call budget exhausted')
+
+            if self.per_second is not None:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.per_second)
+                self._refilled = now
+                if self.tokens < 1:
+                    return (1 - self.tokens) / self.per_second
+                self.tokens -= 1
+
+            if self.per_day is not None:
+                self.remaining_today -= 1
+            save = self.state_file is not None and monotonic() - self._saved >= self.save_interval
+
+        if save:
+            self.save()
+        return 0
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+        raise TooManyRequestsError('Alma API call rate budget exceeded')
+
+    def acquire(self):
+        """
+        Waits until the call is within budget
+        """
+        deadline = monotonic() + self.max_wait
+        waited = False
+        while (wait := self._take()) > 0:
+            if monotonic() + wait > deadline:
+                self._reject()
+            waited = True
+            sleep(wait)
+        if waited:
+            with self._lock:
+                self.waited += 1
+
+    async def acquire_async(self):
+        """
+        asyncio counterpart of :meth:`acquire`
+        """
+        deadline = monotonic() + self.max_wait
+        waited = False
+        while (wait := self._take()) > 0:
+            if monotonic() + wait > deadline:
+                self._reject()
+            waited = True
+            await asyncio.sleep(wait)
+        if waited:
+            with self._lock:
+                self.waited += 1
+
+    def stats(self):
+        return {
+            'per_second': self.per_second,
+            'per_day': self.per_day,
+            'remaining_today': self.remaining_today,
+            'waited': self.waited,
+            'rejected': self.rejected,
+        }
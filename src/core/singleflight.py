@@ -0,0 +1,69 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls made with the same key, so that only the first
+    caller runs the function and every caller that arrives while it is in
+    flight receives its result (or its exception).
+    """
+    def __init__(self) -> None:
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of :class:`SingleFlight`, for calls made on one event
+    loop
+    """
+    def __init__(self) -> None:
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def do(self, key, fn):
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            # Shield the shared call so that one cancelled caller does not cancel it for the others
+            return await asyncio.shield(task)
+
+        self.calls += 1
+        task = self._in_flight[key] = asyncio.ensure_future(fn())
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
@@ -0,0 +1,188 @@
+import functools
+import inspect
+import itertools
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from time import perf_counter
+from uuid import uuid4
+
+from core.logging import create_logger, request_id
+
+logger = create_logger(__name__)
+
+_trace = ContextVar('trace', default=None)
+_span = ContextVar('span', default=None)
+
+
+class Span:
+    """
+    A timed operation within a trace, with attributes describing it
+    """
+    __slots__ = ('name', 'span_id', 'parent_id', 'attributes', 'start', 'duration')
+
+    def __init__(self, name, span_id, parent_id, attributes) -> None:
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class _NoSpan:
+    """
+    Stands in for a span when no trace is in progress
+    """
+    def set(self, **attributes):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """
+    The spans of a single request, identified by its request ID
+    """
+    def __init__(self, request_id, name, attributes) -> None:
+        self.request_id = request_id
+        self.spans = []
+        self._span_ids = itertools.count(1)
+        self.root = self.new_span(name, None, attributes)
+
+    def new_span(self, name, parent, attributes):
+        return Span(name, next(self._span_ids), parent.span_id if parent is not None else None, attributes)
+
+    def finish(self, span):
+        span.duration = perf_counter() - span.start
+        self.spans.append(span)
+        logger.info(
+            f'{span.name} took {span.duration * 1000:.1f} ms',
+            extra={'span': span.name, 'span_id': span.span_id, 'parent_span_id': span.parent_id,
+                   'duration_ms': round(span.duration * 1000, 3), 'attributes': span.attributes},
+        )
+
+    def server_timing(self):
+        """
+        Returns the finished spans as the value of a Server-Timing header, with
+        the spans of the same name combined, followed by the time so far
+        """
+        totals = {}
+        for span in self.spans:
+            duration, count = totals.get(span.name, (0, 0))
+            totals[span.name] = (duration + span.duration, count + 1)
+
+        metrics = [f'{name};dur={duration * 1000:.1f}' + (f';desc="{count} calls"' if count > 1 else '')
+                   for name, (duration, count) in totals.items()]
+        metrics.append(f'total;dur={(perf_counter() - self.root.start) * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+
+def new_request_id(received=None):
+    """
+    Returns the request ID received from the client (e.g. in an X-Request-ID
+    header) if it is a plausible one, or else a new random request ID
+    """
+    if received and REQUEST_ID_PATTERN.fullmatch(received):
+        return received
+    return uuid4().hex
+
+
+def start_trace(current_request_id, enabled=True, name='request', **attributes):
+    """
+    Sets the ID of the current request and, if enabled, starts a trace of it
+    with a root span of the given name. Returns the trace, or None if not
+    enabled, and the tokens to pass to :func:`end_trace`.
+    """
+    trace = Trace(current_request_id, name, attributes) if enabled else None
+    tokens = (request_id.set(current_request_id), _trace.set(trace),
+              _span.set(trace.root if trace is not None else None))
+    return trace, tokens
+
+
+def end_trace(trace, tokens):
+    """
+    Finishes the root span of the trace, if any, and restores the context as
+    it was before :func:`start_trace`
+    """
+    request_id_token, trace_token, span_token = tokens
+    _span.reset(span_token)
+    _trace.reset(trace_token)
+    if trace is not None:
+        trace.finish(trace.root)
+    request_id.reset(request_id_token)
+
+
+def current_span():
+    """
+    Returns the innermost span in progress, or a span that ignores its
+    attributes if there is no trace in progress
+    """
+    span = _span.get()
+    return span if span is not None else NO_SPAN
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the enclosed block as a span, nested in the current span, if a trace
+    is in progress
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield NO_SPAN
+        return
+
+    new_span = trace.new_span(name, _span.get(), attributes)
+    token = _span.set(new_span)
+    try:
+        yield new_span
+    finally:
+        _span.reset(token)
+        trace.finish(new_span)
+
+
+def traced(name):
+    """
+    Decorator timing each call of the function, or coroutine function, as a
+    span of the given name
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def propagate(fn):
+    """
+    Returns a function that calls fn within the current trace and request ID,
+    for functions run in another thread, e.g. by a ThreadPoolExecutor
+    """
+    if _trace.get() is None and request_id.get() is None:
+        return fn
+
+    context = copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so each call gets a copy
+        return context.copy().run(fn, *args, **kwargs)
+    return wrapper
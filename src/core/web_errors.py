@@ -1,4 +1,5 @@
 from flask import Blueprint, jsonify
+from werkzeug.exceptions import HTTPException
 
 from core.logging import create_logger
 
@@ -6,56 +7,33 @@ logger = create_logger(__name__)
 
 blueprint = Blueprint('error_handlers', __name__)
 
-
-@blueprint.app_errorhandler(400)
-def _bad_request(e):
-    logger.warning(e.description)
-
-    response = jsonify({'status': 400, 'error': 'Bad Request', 'message': e.description})
-    response.status_code = 400
-    return response
-
-
-@blueprint.app_errorhandler(404)
-def _not_found(e):
-    logger.warning(e.description)
-
-    response = jsonify({'status': 404, 'error': 'Not Found', 'message': e.description})
-    response.status_code = 404
-    return response
-
-
-@blueprint.app_errorhandler(429)
-def _too_many_requests(e):
+# The errors answered with a JSON body, and the name given to each
+ERROR_NAMES = {
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+    504: 'Gateway Timed Out',
+}
+
+
+def error_body(e: HTTPException):
+    """
+    Returns the JSON body of the response to an error in ERROR_NAMES
+    """
     logger.warning(e.description)
 
-    response = jsonify({'status': 429, 'error': 'Too Many Requests', 'message': e.description})
-    response.status_code = 429
-    return response
-
+    return {'status': e.code, 'error': ERROR_NAMES[e.code], 'message': e.description}
 
-@blueprint.app_errorhandler(500)
-def _internal_server_error(e):
-    logger.warning(e.description)
 
-    response = jsonify({'status': 500, 'error': 'Internal Server Error', 'message': e.description})
-    response.status_code = 500
+def _error_response(e: HTTPException):
+    response = jsonify(error_body(e))
+    response.status_code = e.code
     return response
 
 
-@blueprint.app_errorhandler(502)
-def _bad_gateway(e):
-    logger.warning(e.description)
-
-    response = jsonify({'status': 502, 'error': 'Bad Gateway', 'message': e.description})
-    response.status_code = 502
-    return response
-
-
-@blueprint.app_errorhandler(504)
-def _gateway_timed_out(e):
-    logger.warning(e.description)
-
-    response = jsonify({'status': 504, 'error': 'Gateway Timed Out', 'message': e.description})
-    response.status_code = 504
-    return response
+for code in ERROR_NAMES:
+    blueprint.app_errorhandler(code)(_error_response)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+from alma.aio import AsyncAlmaServerGateway
+from alma.asgi import _create_app as _create_asgi_app
+from alma.processor import AlmaServerGateway
+from alma.web import _create_app
+
+
+def resource_file_as_string(filepath):
+    with open(os.path.normpath(filepath), 'r') as resource_file:
+        return resource_file.read()
+
+
+ALMA_RESPONSES = {
+    '/test_endpoint': 'tests/resources/retrieve_bibs_200_response_available.xml',
+    '/almaws/v1/bibs/990008536900108238/holdings': 'tests/resources/retrieve_holdings_200_response.xml',
+    '/almaws/v1/bibs/990008536900108238/holdings/2287297550008238/items':
+        'tests/resources/retrieve_items_200_response.xml',
+    '/test_endpoint990008536900108238/holdings/2287297550008238/items':
+        'tests/resources/retrieve_items_200_response.xml',
+}
+
+MOCK_CONFIG = {'host': 'http://example.com', 'endpoint': '/test_endpoint'}
+
+
+def mock_alma(request):
+    if request.url.path not in ALMA_RESPONSES:
+        return httpx.Response(404, text='Not Found')
+    return httpx.Response(200, text=resource_file_as_string(ALMA_RESPONSES[request.url.path]))
+
+
+def asgi_post(path, data, content_type='application/json', handler=mock_alma, config=MOCK_CONFIG, headers=None,
+              method='POST'):
+    async def post():
+        server = AsyncAlmaServerGateway(config, transport=httpx.MockTransport(handler))
+        transport = httpx.ASGITransport(app=_create_asgi_app(server))
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+            response = await client.request(method, path, content=data,
+                                            headers={'Content-Type': content_type} | (headers or {}))
+        await server.aclose()
+        return response
+
+    return asyncio.run(post())
+
+
+@pytest.mark.parametrize('path,data', [
+    ('/alma-service/textbooks', '["990008536900108238"]'),
+    ('/alma-service/equipment', '["990008536900108238"]'),
+    ('/alma-service/holdings', '{"990008536900108238": "2287297550008238"}'),
+    ('/alma-service/batch', '{"equipment": {"query": "equipment", "data": ["990008536900108238"]}, '
+                            '"holdings": {"query": "holdings", "data": {"990008536900108238": "2287297550008238"}}, '
+                            '"invalid": {"query": "holdings", "data": []}}'),
+])
+def test_asgi_responses_match_flask(requests_mock, path, data):
+    for alma_path, filepath in ALMA_RESPONSES.items():
+        host = 'http://example.com' if alma_path.startswith('/test_endpoint') else \
+            'https://api-na.hosted.exlibrisgroup.com'
+        requests_mock.get(host + alma_path, text=resource_file_as_string(filepath))
+    flask_response = _create_app(AlmaServerGateway(MOCK_CONFIG)).test_client().post(
+        path, data=data, content_type='application/json')
+
+    asgi_response = asgi_post(path, data)
+
+    assert asgi_response.status_code == flask_response.status_code == 200
+    assert asgi_response.content == flask_response.data
+
+
+@pytest.mark.parametrize('path', ['/alma-service/textbooks', '/alma-service/equipment'])
+def test_ndjson_streams_the_entries_of_the_json_response(requests_mock, path):
+    for alma_path, filepath in ALMA_RESPONSES.items():
+        host = 'http://example.com' if alma_path.startswith('/test_endpoint') else \
+            'https://api-na.hosted.exlibrisgroup.com'
+        requests_mock.get(host + alma_path, text=resource_file_as_string(filepath))
+    client = _create_app(AlmaServerGateway(MOCK_CONFIG)).test_client()
+    data = '["990008536900108238", "1"]'
+    json_response = client.post(path, data=data, content_type='application/json')
+    flask_response = client.post(path, data=data, content_type='application/json',
+                                 headers={'Accept': 'application/x-ndjson'})
+
+    asgi_response = asgi_post(path, data, headers={'Accept': 'application/x-ndjson'})
+
+    assert flask_response.status_code == asgi_response.status_code == 200
+    assert flask_response.content_type == asgi_response.headers['content-type'] == 'application/x-ndjson'
+    assert flask_response.headers['X-Not-Found'] == asgi_response.headers['x-not-found'] == '1'
+    lines = [json.loads(line) for line in flask_response.text.splitlines()]
+    assert all(len(line) == 1 for line in lines)
+    assert {key: entry for line in lines for key, entry in line.items()} == json_response.json
+    assert asgi_response.content == flask_response.data
+
+
+def test_asgi_returns_400_when_data_is_not_json():
+    response = asgi_post('/alma-service/textbooks', '["990008536900108238"]', content_type='text/plain')
+    assert response.status_code == 400
+    assert response.json()['message'] == 'Request was not JSON'
+
+
+def test_asgi_returns_alma_errors():
+    response = asgi_post('/alma-service/textbooks', '["990008536900108238"]',
+                         handler=lambda request: httpx.Response(502, text='Bad Gateway'),
+                         config=MOCK_CONFIG | {'http': {'retries': 0}})
+    assert response.status_code == 502
+    assert response.json() == {'status': 502, 'error': 'Bad Gateway', 'message': 'Bad Gateway'}
+
+
+def test_asgi_returns_404_not_found_when_endpoint_does_not_exist():
+    response = asgi_post('/does-not-exist', '[]')
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('method,path,data,headers', [
+    ('POST', '/does-not-exist', '[]', {}),
+    ('DELETE', '/alma-service/textbooks', '[]', {}),
+    ('POST', '/alma-service/textbooks', '["990008536900108238"', {}),
+    ('POST', '/alma-service/textbooks', '{}', {}),
+    ('POST', '/alma-service/invalidate', '[]', {}),
+    ('POST', '/alma-service/invalidate', '[]', {'Authorization': 'Bearer wrong'}),
+    ('POST', '/alma-service/invalidate', '{}', {'Authorization': 'Bearer secret'}),
+    ('POST', '/alma-service/invalidate', '[[1]]', {'Authorization': 'Bearer secret'}),
+    ('HEAD', '/alma-service/ping', '', {}),
+    ('OPTIONS', '/alma-service/batch', '', {}),
+])
+def test_asgi_errors_match_flask(monkeypatch, method, path, data, headers):
+    monkeypatch.setenv('INVALIDATE_TOKEN', 'secret')
+    flask_response = _create_app(AlmaServerGateway(MOCK_CONFIG)).test_client().open(
+        path, method=method, data=data, content_type='application/json', headers=headers)
+
+    asgi_response = asgi_post(path, data, headers=headers, method=method)
+
+    assert asgi_response.status_code == flask_response.status_code
+    assert asgi_response.headers['content-type'] == flask_response.content_type
+    assert set(asgi_response.headers.get('allow', '').split(', ')) == \
+        set(flask_response.headers.get('Allow', '').split(', '))
+    assert asgi_response.content == flask_response.data
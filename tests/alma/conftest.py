@@ -0,0 +1,31 @@
+import pytest
+
+
+def _bibs_response(*mms_ids):
+    bibs = ''.join(f"""
+      <bib>
+        <mms_id>{mms_id}</mms_id>
+        <title>Title {mms_id}</title>
+        <holdings link="http://example.com/test_endpoint{mms_id}/holdings"/>
+        <record>
+          <datafield ind1=" " ind2=" " tag="AVA">
+            <subfield code="0">{mms_id}</subfield>
+            <subfield code="b">CPMCK</subfield>
+            <subfield code="d">CLAS170/{mms_id}</subfield>
+            <subfield code="e">available</subfield>
+            <subfield code="f">2</subfield>
+            <subfield code="g">1</subfield>
+            <subfield code="j">TPTXB</subfield>
+          </datafield>
+        </record>
+      </bib>""" for mms_id in mms_ids)
+    return f'<?xml version="1.0" encoding="UTF-8"?><bibs total_record_count="{len(mms_ids)}">{bibs}</bibs>'
+
+
+@pytest.fixture
+def bibs_response():
+    """
+    Returns a function building a Retrieve Bibs response with one available
+    Top Textbooks AVA field for each of the given MMS IDs
+    """
+    return _bibs_response
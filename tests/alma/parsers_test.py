@@ -0,0 +1,64 @@
+import os
+
+from alma.parsers import BibsPullParser, ItemRecord, lxml_bibs, lxml_items, soup_bibs, soup_items
+
+
+def resource_file_as_bytes(filepath):
+    with open(os.path.normpath(filepath), 'rb') as resource_file:
+        return resource_file.read()
+
+
+def test_lxml_bibs_matches_soup_bibs():
+    content = resource_file_as_bytes('tests/resources/retrieve_bibs_200_response_available.xml')
+
+    records = list(lxml_bibs(content))
+
+    assert records == list(soup_bibs(content))
+    assert len(records) == 1
+    assert records[0].mms_id == '990008536900108238'
+    assert records[0].title == 'The Iliad of Homer /'
+    assert [ava['j'] for ava in records[0].avas] == ['TPTXB', 'STACK', 'STACK']
+
+
+def test_bibs_without_holdings_are_skipped():
+    content = b"""<bibs>
+      <bib><mms_id>1</mms_id><title>No holdings</title></bib>
+      <bib><mms_id>2</mms_id><title>Holdings</title><holdings link="http://example.com/2/holdings"/></bib>
+    </bibs>"""
+
+    for parse in [lxml_bibs, soup_bibs]:
+        returned = set()
+        assert [record.mms_id for record in parse(content, returned)] == ['2']
+        # Returned by Alma all the same
+        assert returned == {'1', '2'}
+
+    parser = BibsPullParser()
+    parser.feed(content)
+    records = parser.close()
+    assert [record.mms_id for record in records] == ['2']
+    assert records.returned == {'1', '2'}
+
+
+def test_lxml_items_matches_soup_items():
+    content = resource_file_as_bytes('tests/resources/retrieve_items_200_response.xml')
+
+    records = list(lxml_items(content))
+
+    assert records == list(soup_items(content))
+    assert records == [ItemRecord('31430060284513', True, 'false', 1), ItemRecord('31430060284521', False, 'false', 0)]
+
+
+def test_item_location_is_used_when_holding_has_no_top_textbook_temp_location():
+    content = b"""<items>
+      <item>
+        <holding_data><temp_location desc="Reserves">RESRV</temp_location></holding_data>
+        <item_data>
+          <barcode>1</barcode>
+          <base_status desc="Item in place">1</base_status>
+          <location desc="Top Textbook">TPTXB</location>
+        </item_data>
+      </item>
+    </items>"""
+
+    assert list(lxml_items(content)) == [ItemRecord('1', True, False, 0)]
+    assert list(soup_items(content)) == list(lxml_items(content))
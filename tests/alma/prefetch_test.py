@@ -0,0 +1,83 @@
+import time
+
+from alma.prefetch import Prefetcher
+from alma.processor import AlmaProcessor, AlmaServerGateway
+
+
+def test_prefetched_mms_ids_are_answered_from_memory(requests_mock, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1,2', text=bibs_response('1', '2'))
+    requests_mock.get('http://example.com/test_endpoint?mms_id=3', text=bibs_response('3'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'prefetch': {'mms_ids': ['2', '1'], 'interval': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+    prefetcher = Prefetcher(processor, mock_config['prefetch'])
+
+    prefetcher.refresh()
+    assert requests_mock.call_count == 1
+    assert prefetcher.stats()['refreshes'] == 1
+
+    assert list(processor.processBibs(['1', '2'], 'TPTXB')) == ['1--CPMCK', '2--CPMCK']
+    assert requests_mock.call_count == 1
+
+    assert list(processor.processBibs(['1', '3'], 'TPTXB')) == ['1--CPMCK', '3--CPMCK']
+    assert requests_mock.request_history[-1].qs['mms_id'] == ['3']
+
+    # Invalidated MMS IDs are retrieved from Alma again
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1', text=bibs_response('1'))
+    processor.invalidate(['1'])
+    assert list(processor.processBibs(['1', '2'], 'TPTXB')) == ['1--CPMCK', '2--CPMCK']
+    assert requests_mock.call_count == 3
+    assert requests_mock.request_history[-1].qs['mms_id'] == ['1']
+
+    processor.invalidate()
+    assert processor.stats()['warm'] == {'entries': 0}
+
+
+def test_prefetcher_thread_stops(requests_mock, tmp_path, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint', text=bibs_response('1'))
+    mms_ids_file = tmp_path / 'mms_ids.txt'
+    mms_ids_file.write_text('# Top Textbooks\n1\n\n')
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'prefetch': {'mms_ids_file': str(mms_ids_file), 'interval': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+    prefetcher = Prefetcher(processor, mock_config['prefetch'])
+
+    assert prefetcher.mms_ids == ['1']
+    prefetcher.start()
+    prefetcher.stop(timeout=5)
+
+    assert not prefetcher.is_running()
+
+
+def test_prefetcher_thread_survives_unexpected_errors(requests_mock, bibs_response, monkeypatch):
+    requests_mock.get('http://example.com/test_endpoint', text=bibs_response('1'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'prefetch': {'mms_ids': ['1'], 'interval': 0.01}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+    prefetcher = Prefetcher(processor, mock_config['prefetch'])
+
+    parse_bibs_by_id = processor.parse_bibs_by_id
+    calls = []
+
+    def fail_once(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise ValueError('Malformed AVA field')
+        return parse_bibs_by_id(*args)
+
+    monkeypatch.setattr(processor, 'parse_bibs_by_id', fail_once)
+    prefetcher.start()
+    try:
+        deadline = time.monotonic() + 5
+        while prefetcher.stats()['refreshes'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert prefetcher.is_running()
+    finally:
+        prefetcher.stop(timeout=5)
+
+    assert prefetcher.stats()['failures'] == 1
+    assert prefetcher.stats()['refreshes'] >= 2
+    assert list(processor.processBibs(['1'], 'TPTXB')) == ['1--CPMCK']
@@ -1,6 +1,13 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-from alma.processor import AlmaServerGateway, AlmaProcessor
+import pytest
+from core.gateway import HttpGateway
+from alma.processor import MAX_HEADER_MMS_IDS, AlmaServerGateway, AlmaProcessor, BibsResult
+from werkzeug.exceptions import HTTPException
 
 
 def resource_file_as_string(filepath):
@@ -23,10 +30,372 @@ def test_retrieve_bibs_item_available(requests_mock):
     processor = AlmaProcessor(AlmaServerGateway(mock_config))
 
     mock_request = ["990008536900108238"]
-    expected_result = {'990008536900108238--CPMCK': {'location': 'CPMCK', 'count': '1', 'status': 'available',
+    expected_result = {'990008536900108238--CPMCK': {'location': 'CPMCK', 'total': '1', 'checked_out': '0',
+                                                     'count': 1, 'status': 'available',
                                                      'call_number': 'CLAS170/Iliad of Homer',
                                                      'title': 'The Iliad of Homer /', 'mms_id': '990008536900108238'}}
 
     processed_result = processor.processBibs(mock_request, 'TPTXB')
 
     assert processed_result == expected_result
+    assert requests_mock.call_count == 1
+
+
+def mock_alma_responses(requests_mock):
+    holdings_url = 'https://api-na.hosted.exlibrisgroup.com/almaws/v1/bibs/990008536900108238/holdings'
+    requests_mock.get('http://example.com/test_endpoint', status_code=200,
+                      text=resource_file_as_string('tests/resources/retrieve_bibs_200_response_available.xml'))
+    requests_mock.get(holdings_url, status_code=200,
+                      text=resource_file_as_string('tests/resources/retrieve_holdings_200_response.xml'))
+    requests_mock.get(holdings_url + '/2287297550008238/items', status_code=200,
+                      text=resource_file_as_string('tests/resources/retrieve_items_200_response.xml'))
+
+
+def test_equipment_fan_out_matches_serial_processing(requests_mock):
+    mock_alma_responses(requests_mock)
+
+    serial_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'max_workers': 1}
+    concurrent_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'max_workers': 8}
+
+    serial_result = AlmaProcessor(AlmaServerGateway(serial_config)).processBibs(
+        ["990008536900108238"], limit_collection='STACK', check_holdings=True)
+    concurrent_result = AlmaProcessor(AlmaServerGateway(concurrent_config)).processBibs(
+        ["990008536900108238"], limit_collection='STACK', check_holdings=True)
+
+    assert concurrent_result == serial_result
+    assert list(concurrent_result) == ['990008536900108238--CPSG', '990008536900108238--CPMCK']
+    assert concurrent_result['990008536900108238--CPMCK']['due_date'] == datetime.fromisoformat('2024-02-20T04:59:00Z')
+
+
+def test_retrieve_bibs_is_chunked_and_merged(requests_mock, bibs_response):
+    for mms_id in ['1', '2', '3']:
+        requests_mock.get(f'http://example.com/test_endpoint?mms_id={mms_id}', text=bibs_response(mms_id))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'bibs_chunk_size': 1}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    processed_result = processor.processBibs(['3', '1', '2'], 'TPTXB')
+
+    assert list(processed_result) == ['1--CPMCK', '2--CPMCK', '3--CPMCK']
+    assert processed_result['2--CPMCK']['count'] == 1
+    assert requests_mock.call_count == 3
+    assert sorted(r.qs['mms_id'][0] for r in requests_mock.request_history) == ['1', '2', '3']
+
+
+def test_gateway_caches_responses_without_api_key(requests_mock, monkeypatch, bibs_response):
+    monkeypatch.setenv('ALMA_API_KEY', 'secret')
+    requests_mock.get('http://example.com/test_endpoint', text=bibs_response('1'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'cache': {'ttl': {'bibs': 60}}}
+    gateway = AlmaServerGateway(mock_config)
+    processor = AlmaProcessor(gateway)
+
+    first_result = processor.processBibs(['1'], 'TPTXB')
+    second_result = processor.processBibs(['1'], 'TPTXB')
+
+    assert first_result == second_result
+    assert requests_mock.call_count == 1
+    assert gateway.stats()['cache']['hits'] == 1
+    assert AlmaServerGateway.cache_key('HTTP://Example.com/bibs/', {'apikey': 'secret', 'view': 'full'}) == \
+        'http://example.com/bibs?view=full'
+
+
+def test_overlapping_requests_only_retrieve_uncached_mms_ids(requests_mock, bibs_response):
+    for mms_ids in [['1', '2'], ['3']]:
+        requests_mock.get(f'http://example.com/test_endpoint?mms_id={",".join(mms_ids)}',
+                          text=bibs_response(*mms_ids))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'result_cache': {'ttl': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    first_result = processor.processBibs(['1', '2'], 'TPTXB')
+    second_result = processor.processBibs(['2', '3', '1'], 'TPTXB')
+
+    assert list(first_result) == ['1--CPMCK', '2--CPMCK']
+    assert list(second_result) == ['1--CPMCK', '2--CPMCK', '3--CPMCK']
+    assert [r.qs['mms_id'][0] for r in requests_mock.request_history] == ['1,2', '3']
+
+    processor.invalidate(['2'])
+    requests_mock.get('http://example.com/test_endpoint?mms_id=2', text=bibs_response('2'))
+    processor.processBibs(['1', '2'], 'TPTXB')
+
+    assert requests_mock.request_history[-1].qs['mms_id'] == ['2']
+
+
+def test_mms_ids_not_found_are_reported_and_not_requested_again(requests_mock, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1,9', text=bibs_response('1'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'not_found_cache': {'ttl': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    first_result = processor.processBibs(['9', '1'], 'TPTXB')
+    second_result = processor.processBibs(['9'], 'TPTXB')
+
+    assert list(first_result) == ['1--CPMCK']
+    assert first_result.not_found == ['9']
+    assert first_result.headers() == {'X-Not-Found': '9'}
+    assert second_result == {}
+    assert second_result.not_found == ['9']
+    assert requests_mock.call_count == 1
+    assert processor.stats()['not_found']['hits'] == 1
+
+    processor.invalidate(['9'])
+    requests_mock.get('http://example.com/test_endpoint?mms_id=9', text=bibs_response('9'))
+
+    assert list(processor.processBibs(['9'], 'TPTXB')) == ['9--CPMCK']
+
+
+@pytest.mark.parametrize('config', [{'parser': 'soup'}, {'parser': 'lxml'}, {'stream_parsing': True},
+                                    {'batching': {'window': 0}}])
+def test_bibs_returned_without_holdings_are_not_reported_as_not_found(requests_mock, config, bibs_response):
+    response = bibs_response('1', '2').replace('<holdings link="http://example.com/test_endpoint2/holdings"/>', '')
+    requests_mock.get('http://example.com/test_endpoint', text=response)
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'not_found_cache': {'ttl': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config | config))
+
+    result = processor.processBibs(['9', '2', '1'], 'TPTXB')
+    stream = processor.streamBibs(['9', '2', '1'], 'TPTXB')
+
+    assert list(result) == ['1--CPMCK']
+    assert result.not_found == stream.not_found == ['9']
+    assert processor.known_not_found({'1', '2', '9'}) == {'9'}
+
+
+def test_missing_headers_are_capped():
+    result = BibsResult({}, [str(n) for n in range(MAX_HEADER_MMS_IDS + 1)], ['a'])
+
+    assert result.headers() == {
+        'X-Not-Found': ','.join(sorted(str(n) for n in range(MAX_HEADER_MMS_IDS + 1))[:MAX_HEADER_MMS_IDS]),
+        'X-Not-Found-Count': str(MAX_HEADER_MMS_IDS + 1),
+        'X-Unavailable': 'a',
+    }
+
+
+def test_concurrent_requests_are_batched(requests_mock, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint',
+                      text=lambda request, context: bibs_response(*request.qs['mms_id'][0].split(',')))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'batching': {'window': 0.5, 'max_batch_size': 4}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    requests = [(['1', '2'], 'TPTXB'), (['2', '3'], None), (['4'], 'TPTXB'), (['5'], 'TPTXB')]
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        futures = []
+        for mms_ids, limit_collection in requests:
+            futures.append(executor.submit(processor.processBibs, mms_ids, limit_collection))
+            time.sleep(0.05)
+        results = [future.result() for future in futures]
+
+    assert [list(result) for result in results] == [['1--CPMCK', '2--CPMCK'], ['2--CPMCK', '3--CPMCK'],
+                                                    ['4--CPMCK'], ['5--CPMCK']]
+    # The fifth MMS ID does not fit in the first batch, so starts a second one
+    assert [r.qs['mms_id'][0] for r in requests_mock.request_history] == ['1,2,3,4', '5']
+    assert processor.stats()['batching']['batches'] == 2
+
+
+def test_expired_results_are_served_while_revalidated(requests_mock, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1', text=bibs_response('1'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'result_cache': {'ttl': 0.01, 'stale_while_revalidate': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    processor.processBibs(['1'], 'TPTXB')
+    time.sleep(0.02)
+    stale_result = processor.processBibs(['1'], 'TPTXB')
+    processor.revalidator.submit(lambda: None).result()
+
+    assert stale_result['1--CPMCK']['stale'] is True
+    assert stale_result['1--CPMCK']['count'] == 1
+    assert requests_mock.call_count == 2
+    assert processor.revalidating == set()
+
+
+def test_bibs_are_not_cached_in_both_layers(requests_mock, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1', text=bibs_response('1'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'cache': {'ttl': {'bibs': 60, 'items': 30}},
+                   'result_cache': {'ttl': 0.01, 'stale_while_revalidate': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    processor.processBibs(['1'], 'TPTXB')
+    for _ in range(2):
+        time.sleep(0.02)
+        stale_result = processor.processBibs(['1'], 'TPTXB')
+        processor.revalidator.submit(lambda: None).result()
+
+    # Each revalidation asks Alma, so a result is never older than it says
+    assert requests_mock.call_count == 3
+    assert stale_result['1--CPMCK']['age'] == 0
+    assert processor.server.cache_ttl('bibs') == 0
+    assert processor.server.cache_ttl('items') == 30
+
+
+def test_last_known_results_are_served_when_alma_fails(requests_mock, bibs_response):
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1', text=bibs_response('1'))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'http': {'retries': 0},
+                   'result_cache': {'ttl': 0.01, 'stale_if_error': 60}}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    fresh_result = processor.processBibs(['1'], 'TPTXB')
+    time.sleep(0.02)
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1', status_code=503)
+    stale_result = processor.processBibs(['1'], 'TPTXB')
+
+    assert 'stale' not in fresh_result['1--CPMCK']
+    assert stale_result['1--CPMCK'] == fresh_result['1--CPMCK'] | {'stale': True, 'age': 0}
+
+    # MMS IDs without a previous result are reported as unavailable
+    requests_mock.get('http://example.com/test_endpoint?mms_id=1,2', status_code=503)
+    partial_result = processor.processBibs(['1', '2'], 'TPTXB')
+    assert list(partial_result) == ['1--CPMCK']
+    assert partial_result['1--CPMCK']['stale'] is True
+    assert partial_result.not_found == []
+    assert partial_result.unavailable == ['2']
+    assert partial_result.headers() == {'X-Unavailable': '2'}
+
+    partial_stream = processor.streamBibs(['1', '2'], 'TPTXB')
+    assert [key for key, entry in partial_stream] == ['1--CPMCK']
+    assert partial_stream.headers() == {'X-Unavailable': '2'}
+
+    # Without any previous result the error is still raised
+    requests_mock.get('http://example.com/test_endpoint?mms_id=2', status_code=503)
+    with pytest.raises(HTTPException) as e:
+        processor.processBibs(['2'], 'TPTXB')
+    assert e.value.code == 503
+
+
+def items_page(offset, limit, total):
+    items = ''.join(f"""
+      <item>
+        <holding_data><temp_location desc="Top Textbook">TPTXB</temp_location></holding_data>
+        <item_data>
+          <barcode>{n}</barcode>
+          <base_status desc="Item in place">1</base_status>
+          <awaiting_reshelving>false</awaiting_reshelving>
+        </item_data>
+      </item>""" for n in range(offset, min(offset + limit, total)))
+    return f'<?xml version="1.0" encoding="UTF-8"?><items total_record_count="{total}">{items}</items>'
+
+
+def test_items_are_retrieved_in_pages(requests_mock):
+    def page(request, context):
+        return items_page(int(request.qs['offset'][0]), int(request.qs['limit'][0]), 250)
+
+    requests_mock.get('http://example.com/test_endpoint1/holdings/2/items', text=page)
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'items_page_size': 100}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    result = processor.processHoldings({'1': '2'})
+
+    assert list(result['1']['2']) == [str(n) for n in range(250)]
+    assert sorted(r.qs['offset'][0] for r in requests_mock.request_history) == ['0', '100', '200']
+
+
+def test_nested_fan_out_runs_on_bounded_pools_shared_by_requests(requests_mock):
+    mock_alma_responses(requests_mock)
+    threads = set()
+
+    def page(request, context):
+        threads.add(threading.current_thread().name)
+        return items_page(int(request.qs['offset'][0]), int(request.qs['limit'][0]), 250)
+
+    requests_mock.get('http://example.com/test_endpoint1/holdings/2/items', text=page)
+
+    # With one thread per pool, a task waiting on its own pool would deadlock
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'max_workers': 1,
+                   'items_page_size': 100, 'parallel_holdings': True}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+    batch = {
+        'equipment': {'query': 'equipment', 'data': ['990008536900108238']},
+        'holdings': {'query': 'holdings', 'data': {'1': '2'}},
+    }
+
+    for _ in range(3):
+        result = processor.processBatch(batch)
+        assert set(result['equipment']['data']) == {'990008536900108238--CPSG', '990008536900108238--CPMCK'}
+        assert len(result['holdings']['data']['1']['2']) == 250
+
+    # The first page is fetched by the lookup, the others by the gateway
+    assert threads == {'alma-lookup_0', 'alma-fetch_0'}
+
+    processor.close()
+    with pytest.raises(RuntimeError):
+        processor.processBatch(batch)
+
+
+def test_stream_parsing_produces_identical_results(requests_mock, monkeypatch, bibs_response):
+    monkeypatch.setattr(HttpGateway, 'STREAM_CHUNK_SIZE', 64)
+    for mms_ids in [['1', '2'], ['3']]:
+        requests_mock.get(f'http://example.com/test_endpoint?mms_id={",".join(mms_ids)}',
+                          text=bibs_response(*mms_ids))
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'bibs_chunk_size': 2,
+                   'cache': {'ttl': {'bibs': 60}}}
+    buffered_result = AlmaProcessor(AlmaServerGateway(mock_config)).processBibs(['1', '2', '3'], 'TPTXB')
+    gateway = AlmaServerGateway(mock_config | {'stream_parsing': True})
+    processor = AlmaProcessor(gateway)
+
+    assert processor.processBibs(['1', '2', '3'], 'TPTXB') == buffered_result
+    assert processor.processBibs(['1', '2', '3'], 'TPTXB') == buffered_result
+    assert requests_mock.call_count == 4
+    assert gateway.stats()['cache']['hits'] == 2
+
+
+def test_lxml_parser_produces_identical_results(requests_mock):
+    mock_alma_responses(requests_mock)
+
+    results = []
+    for parser in ['soup', 'lxml']:
+        mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'parser': parser}
+        processor = AlmaProcessor(AlmaServerGateway(mock_config))
+        results.append([
+            processor.processBibs(["990008536900108238"], 'TPTXB'),
+            processor.processBibs(["990008536900108238"], include_course=True),
+            processor.processBibs(["990008536900108238"], limit_collection='STACK', check_holdings=True),
+        ])
+
+    assert results[0] == results[1]
+
+
+def test_parse_holdings_keeps_top_textbook_items_only():
+    content = resource_file_as_string('tests/resources/retrieve_items_200_response.xml')
+
+    for parser in ['soup', 'lxml']:
+        processor = AlmaProcessor(AlmaServerGateway({'host': '', 'endpoint': '', 'parser': parser}))
+        assert processor.parse_holdings(content) == {
+            '31430060284513': {'available': True, 'count': 1, 'reshelving': 'false'}
+        }
+        assert list(processor.parse_holdings(content, check_TT=False)) == ['31430060284513', '31430060284521']
+
+
+def test_parallel_holdings_reports_failures_per_pair(requests_mock):
+    items_url = 'http://example.com/test_endpoint{}/holdings/{}/items'
+    requests_mock.get(items_url.format('1', '11'),
+                      text=resource_file_as_string('tests/resources/retrieve_items_200_response.xml'))
+    requests_mock.get(items_url.format('2', '22'), text='<items total_record_count="0"/>')
+    requests_mock.get(items_url.format('3', '33'), text='Bad Gateway', status_code=502)
+
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'parallel_holdings': True}
+    processor = AlmaProcessor(AlmaServerGateway(mock_config))
+
+    processed_result = processor.processHoldings({'1': '11', '2': '22', '3': '33'})
+
+    assert list(processed_result) == ['1', 'errors']
+    assert processed_result['1'] == {'11': {'31430060284513': {'available': True, 'count': 1, 'reshelving': 'false'}}}
+    assert processed_result['errors']['2'] == {'22': {'status': 502, 'message': 'No holdings data found in request'}}
+    assert processed_result['errors']['3']['33']['status'] == 502
+
+    # The same for a single pair
+    processed_result = processor.processHoldings({'3': '33'})
+    assert list(processed_result) == ['errors']
+    assert processed_result['errors']['3']['33']['status'] == 502
+
+    with pytest.raises(HTTPException) as e:
+        processor.processHoldings({'errors': '11'})
+    assert e.value.code == 400
@@ -1,4 +1,5 @@
 import json
+import os
 
 import pytest
 from core.exceptions import BadGatewayError, GatewayTimeoutError, TooManyRequestsError
@@ -6,6 +7,11 @@ from alma.processor import AlmaServerGateway
 from alma.web import _create_app
 
 
+def resource_file_as_string(filepath):
+    with open(os.path.normpath(filepath), 'r') as resource_file:
+        return resource_file.read()
+
+
 @pytest.fixture
 def app():
     app = _create_app(server=None)
@@ -29,13 +35,14 @@ def test_returns_404_not_found_when_endpoint_does_not_exist(client):
 
 
 def test_returns_400_bad_request_when_data_is_not_json(client):
-    response = client.post('/api/textbooks', data='{"invalid data": "invalid"}', content_type='text/plain')
+    response = client.post('/alma-service/textbooks', data='{"invalid data": "invalid"}', content_type='text/plain')
     assert response.status_code == 400
     assert 'Request was not JSON' == json.loads(response.text)['message']
 
 
 def test_returns_400_bad_request_when_data_is_invalid(client):
-    response = client.post('/api/textbooks', data='{"invalid data": "invalid"}', content_type='application/json')
+    response = client.post('/alma-service/textbooks', data='{"invalid data": "invalid"}',
+                           content_type='application/json')
     assert response.status_code == 400
     assert 'JSON received is not valid.' == json.loads(response.text)['message']
 
@@ -56,7 +63,7 @@ def test_server_returns_429_too_many_requests_error():
     testGateway = MockAlmaServerGateway(lambda: raise_(TooManyRequestsError('Too Many Requests')))
     app = _create_app(testGateway)
     client = app.test_client()
-    response = client.post('/api/textbooks', data='[]', content_type='application/json')
+    response = client.post('/alma-service/textbooks', data='[]', content_type='application/json')
     assert response.status_code == 429
 
 
@@ -64,7 +71,7 @@ def test_server_returns_502_bad_gateway_error():
     testGateway = MockAlmaServerGateway(lambda: raise_(BadGatewayError('Bad Gateway')))
     app = _create_app(testGateway)
     client = app.test_client()
-    response = client.post('/api/textbooks', data='[]', content_type='application/json')
+    response = client.post('/alma-service/textbooks', data='[]', content_type='application/json')
     assert response.status_code == 502
 
 
@@ -72,5 +79,146 @@ def test_server_returns_504_gateway_timeout_error():
     testGateway = MockAlmaServerGateway(lambda: raise_(GatewayTimeoutError('Gateway Timed Out')))
     app = _create_app(testGateway)
     client = app.test_client()
-    response = client.post('/api/textbooks', data='[]', content_type='application/json')
+    response = client.post('/alma-service/textbooks', data='[]', content_type='application/json')
     assert response.status_code == 504
+
+
+def mock_alma_responses(requests_mock):
+    holdings_url = 'https://api-na.hosted.exlibrisgroup.com/almaws/v1/bibs/990008536900108238/holdings'
+    requests_mock.get('http://example.com/test_endpoint', status_code=200,
+                      text=resource_file_as_string('tests/resources/retrieve_bibs_200_response_available.xml'))
+    requests_mock.get(holdings_url, status_code=200,
+                      text=resource_file_as_string('tests/resources/retrieve_holdings_200_response.xml'))
+    requests_mock.get(holdings_url + '/2287297550008238/items', status_code=200,
+                      text=resource_file_as_string('tests/resources/retrieve_items_200_response.xml'))
+    requests_mock.get('http://example.com/test_endpoint990008536900108238/holdings/2287297550008238/items',
+                      status_code=200, text=resource_file_as_string('tests/resources/retrieve_items_200_response.xml'))
+
+
+@pytest.fixture
+def alma_client():
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint'}
+    return _create_app(AlmaServerGateway(mock_config)).test_client()
+
+
+def test_textbooks_makes_single_alma_call(alma_client, requests_mock):
+    mock_alma_responses(requests_mock)
+    response = alma_client.post('/alma-service/textbooks', data='["990008536900108238"]',
+                                content_type='application/json')
+    assert response.status_code == 200
+    assert list(response.json) == ['990008536900108238--CPMCK']
+    assert requests_mock.call_count == 1
+
+
+def test_equipment_fetches_holdings_and_items_once(alma_client, requests_mock):
+    mock_alma_responses(requests_mock)
+    response = alma_client.post('/alma-service/equipment', data='["990008536900108238"]',
+                                content_type='application/json')
+    assert response.status_code == 200
+    assert [r.path for r in requests_mock.request_history] == [
+        '/test_endpoint',
+        '/almaws/v1/bibs/990008536900108238/holdings',
+        '/almaws/v1/bibs/990008536900108238/holdings/2287297550008238/items',
+    ]
+
+
+def test_holdings_makes_one_alma_call_per_pair(alma_client, requests_mock):
+    mock_alma_responses(requests_mock)
+    response = alma_client.post('/alma-service/holdings', data='{"990008536900108238": "2287297550008238"}',
+                                content_type='application/json')
+    assert response.status_code == 200
+    assert list(response.json['990008536900108238']['2287297550008238']) == ['31430060284513']
+    assert requests_mock.call_count == 1
+
+
+def test_batch_shares_alma_calls_and_reports_errors_per_query(alma_client, requests_mock):
+    mock_alma_responses(requests_mock)
+    textbooks = alma_client.post('/alma-service/textbooks', data='["990008536900108238"]',
+                                 content_type='application/json').json
+    equipment = alma_client.post('/alma-service/equipment', data='["990008536900108238"]',
+                                 content_type='application/json').json
+    requests_mock.reset_mock()
+
+    response = alma_client.post('/alma-service/batch', content_type='application/json', data=json.dumps({
+        'textbooks': {'query': 'textbooks', 'data': ['990008536900108238']},
+        'equipment': {'query': 'equipment', 'data': ['990008536900108238']},
+        'holdings': {'query': 'holdings', 'data': {'990008536900108238': '2287297550008238'}},
+        'invalid': {'query': 'textbooks', 'data': {'990008536900108238': '2287297550008238'}},
+    }))
+
+    assert response.status_code == 200
+    assert response.json['textbooks'] == {'data': textbooks}
+    assert response.json['equipment'] == {'data': equipment}
+    assert list(response.json['holdings']['data']['990008536900108238']) == ['2287297550008238']
+    assert response.json['invalid'] == {'error': {'status': 400, 'message': 'JSON received is not valid.'}}
+    assert [r.path for r in requests_mock.request_history].count('/test_endpoint') == 1
+
+
+def test_invalidate_drops_cached_results(requests_mock, monkeypatch):
+    monkeypatch.setenv('INVALIDATE_TOKEN', 'secret')
+    mock_alma_responses(requests_mock)
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint', 'result_cache': {'ttl': 60}}
+    client = _create_app(AlmaServerGateway(mock_config)).test_client()
+
+    for _ in range(2):
+        client.post('/alma-service/textbooks', data='["990008536900108238"]', content_type='application/json')
+    assert requests_mock.call_count == 1
+
+    response = client.post('/alma-service/invalidate', data='["990008536900108238"]', content_type='application/json',
+                           headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+
+    client.post('/alma-service/textbooks', data='["990008536900108238"]', content_type='application/json')
+    assert requests_mock.call_count == 2
+
+
+def test_invalidate_requires_the_token(monkeypatch):
+    assert _create_app(server=None).test_client().post('/alma-service/invalidate').status_code == 404
+
+    monkeypatch.setenv('INVALIDATE_TOKEN', 'secret')
+    client = _create_app(server=None).test_client()
+    response = client.post('/alma-service/invalidate', headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 403
+    assert response.json == {'status': 403, 'error': 'Forbidden', 'message': 'Not authorized to invalidate the caches'}
+    assert client.post('/alma-service/invalidate').status_code == 403
+
+
+@pytest.mark.parametrize('data', ['{}', '[[1]]', '[{}]', '"990008536900108238"'])
+def test_invalidate_rejects_bodies_that_are_not_a_list_of_mms_ids(monkeypatch, data):
+    monkeypatch.setenv('INVALIDATE_TOKEN', 'secret')
+    client = _create_app(server=None).test_client()
+
+    response = client.post('/alma-service/invalidate', data=data, content_type='application/json',
+                           headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 400
+    assert response.json['message'] == 'JSON received is not valid.'
+
+
+def test_metrics_reports_latency_by_route_and_lookup(alma_client, requests_mock):
+    mock_alma_responses(requests_mock)
+    alma_client.post('/alma-service/textbooks', data='["990008536900108238"]', content_type='application/json')
+    alma_client.post('/alma-service/textbooks', data='{}', content_type='application/json')
+
+    response = alma_client.get('/alma-service/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    assert 'alma_service_request_seconds_count{route="/alma-service/textbooks"}' in response.text
+    assert 'alma_service_request_errors_total{route="/alma-service/textbooks",status="400"}' in response.text
+    assert 'alma_upstream_request_seconds_bucket{kind="bibs",le="+Inf"}' in response.text
+    assert 'alma_parse_seconds_count{kind="bibs"}' in response.text
+    assert 'alma_circuit_breaker_state{state="closed"} 1' in response.text
+
+
+def test_equipment_is_traced(requests_mock):
+    mock_alma_responses(requests_mock)
+    mock_config = {'host': 'http://example.com', 'endpoint': '/test_endpoint',
+                   'tracing': {'enabled': True, 'server_timing': True}}
+    client = _create_app(AlmaServerGateway(mock_config)).test_client()
+
+    response = client.post('/alma-service/equipment', data='["990008536900108238"]',
+                           content_type='application/json', headers={'X-Request-ID': 'test-request'})
+    assert response.status_code == 200
+    assert response.headers['X-Request-ID'] == 'test-request'
+    timings = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+    assert {'processBibs', 'queryServer', 'alma_get', 'parse_bibs', 'getItems', 'assemble_bibs', 'total'} \
+        <= set(timings)
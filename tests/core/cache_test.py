@@ -0,0 +1,69 @@
+from core.cache import TTLCache
+
+
+def test_get_returns_cached_value_and_counts_hits():
+    cache = TTLCache()
+    cache.set('key', b'value', ttl=60)
+
+    assert cache.get('key') == b'value'
+    assert cache.get('missing') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_expired_entries_are_misses():
+    cache = TTLCache()
+    cache.set('key', b'value', ttl=0)
+
+    assert cache.get('key') is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_entries=2)
+    cache.set('a', 1, ttl=60)
+    cache.set('b', 2, ttl=60)
+    cache.get('a')
+    cache.set('c', 3, ttl=60)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_byte_budget_is_enforced():
+    cache = TTLCache(max_bytes=10)
+    cache.set('a', b'12345', ttl=60, size=5)
+    cache.set('b', b'12345', ttl=60, size=5)
+    cache.set('c', b'123', ttl=60, size=3)
+    cache.set('too-big', b'12345678901', ttl=60, size=11)
+
+    assert cache.get('a') is None
+    assert cache.get('too-big') is None
+    assert cache.stats()['bytes'] == 8
+
+
+def test_invalidate():
+    cache = TTLCache()
+    cache.set('a', 1, ttl=60)
+    cache.set('b', 2, ttl=60)
+
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_expired_entries_are_kept_for_stale_reads():
+    cache = TTLCache(stale_ttl=60)
+    cache.set('key', b'value', ttl=0)
+
+    assert cache.get('key') is None
+    value, age = cache.get_stale('key', max_age=60)
+    assert value == b'value'
+    assert age < 1
+    assert cache.get_stale('key', max_age=-1) is None
+    assert cache.stats()['stale_hits'] == 1
@@ -1,11 +1,18 @@
+import asyncio
+import threading
+
+import httpx
 import pytest
-from core.gateway import HttpGateway
-from werkzeug.exceptions import BadGateway, BadRequest, GatewayTimeout, InternalServerError, NotFound, TooManyRequests
+import requests
+from core.gateway import AsyncConcurrencyLimiter, AsyncHttpGateway, CircuitBreaker, ConcurrencyLimiter, HttpGateway
+from core.ratelimit import RateLimiter
+from werkzeug.exceptions import (BadGateway, BadRequest, GatewayTimeout, InternalServerError, NotFound,
+                                 HTTPException, ServiceUnavailable, TooManyRequests)
 
 
 def test_200_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='Application OK', status_code=200)
-    response = HttpGateway.get('http://example.com', {})
+    response = HttpGateway().get('http://example.com', {})
     assert 'Application OK' == response.decode('UTF-8')
     assert 'Received 200' in caplog.text
 
@@ -13,7 +20,7 @@ def test_200_response_from_server(requests_mock, caplog):
 def test_400_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='Bad Request', status_code=400)
     with pytest.raises(BadRequest):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 400' in caplog.text
     assert 'Failed to find errors in content' in caplog.text
@@ -23,7 +30,7 @@ def test_400_xml_no_content_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='', status_code=400)
 
     with pytest.raises(BadRequest):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 400' in caplog.text
     assert 'Failed to retrieve xml from Alma API' in caplog.text
@@ -45,7 +52,7 @@ def test_400_xml_no_error_code_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text=xml_error_response_no_error_code, status_code=400)
 
     with pytest.raises(BadRequest):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 400' in caplog.text
     assert 'Failed to retrieve error code and/or message in content' in caplog.text
@@ -67,7 +74,7 @@ def test_400_xml_no_error_message_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text=xml_error_response_no_error_code, status_code=400)
 
     with pytest.raises(BadRequest):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 400' in caplog.text
     assert 'Failed to retrieve error code and/or message in content' in caplog.text
@@ -90,7 +97,7 @@ def test_400_xml_error_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text=xml_error_response, status_code=400)
 
     with pytest.raises(BadRequest):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 400' in caplog.text
     assert 'Alma API error 402204: Input parameters mmsId adsf is not numeric.' in caplog.text
@@ -99,7 +106,7 @@ def test_400_xml_error_response_from_server(requests_mock, caplog):
 def test_404_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='Not Found', status_code=404)
     with pytest.raises(NotFound):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 404' in caplog.text
 
@@ -107,7 +114,7 @@ def test_404_response_from_server(requests_mock, caplog):
 def test_429_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='Too Many Requests', status_code=429)
     with pytest.raises(TooManyRequests):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 429' in caplog.text
 
@@ -115,7 +122,7 @@ def test_429_response_from_server(requests_mock, caplog):
 def test_500_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='', status_code=500)
     with pytest.raises(InternalServerError):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 500' in caplog.text
 
@@ -123,7 +130,7 @@ def test_500_response_from_server(requests_mock, caplog):
 def test_502_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='Bad Gateway', status_code=502)
     with pytest.raises(BadGateway):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 502' in caplog.text
 
@@ -131,6 +138,286 @@ def test_502_response_from_server(requests_mock, caplog):
 def test_504_response_from_server(requests_mock, caplog):
     requests_mock.get('http://example.com', text='Gateway Timeout', status_code=504)
     with pytest.raises(GatewayTimeout):
-        HttpGateway.get('http://example.com', {})
+        HttpGateway().get('http://example.com', {})
 
     assert 'Received 504' in caplog.text
+
+
+def test_timeout_returns_gateway_timeout(requests_mock, caplog):
+    requests_mock.get('http://example.com', exc=requests.exceptions.ReadTimeout)
+    with pytest.raises(GatewayTimeout):
+        HttpGateway(read_timeout=0.1).get('http://example.com', {})
+
+    assert "Timed out requesting 'http://example.com'" in caplog.text
+
+
+def test_connection_error_returns_bad_gateway(requests_mock, caplog):
+    requests_mock.get('http://example.com', exc=requests.exceptions.ConnectionError)
+    with pytest.raises(BadGateway):
+        HttpGateway().get('http://example.com', {})
+
+    assert "Failed to connect to 'http://example.com'" in caplog.text
+
+
+def test_sessions_share_connection_pool():
+    gateway = HttpGateway(pool_size=4, connect_timeout=1, read_timeout=2, retries=3)
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(gateway.session))
+    thread.start()
+    thread.join()
+
+    assert sessions[0] is not gateway.session
+    assert sessions[0].get_adapter('https://example.com') is gateway.session.get_adapter('https://example.com')
+    # Retried by the gateway itself, not the adapter
+    assert gateway.adapter.max_retries.total == 0
+    assert gateway.retries == 3
+    assert gateway.timeout == (1, 2)
+
+
+def test_async_gateway_retries_and_returns_content():
+    responses = iter([httpx.Response(503, text='Service Unavailable'), httpx.Response(200, text='Application OK')])
+    gateway = AsyncHttpGateway(retries=1, backoff_factor=0,
+                               transport=httpx.MockTransport(lambda request: next(responses)))
+
+    assert asyncio.run(gateway.get('http://example.com', {})) == b'Application OK'
+
+
+def test_every_retry_is_charged_to_the_rate_limiter_and_breaker(requests_mock):
+    requests_mock.get('http://example.com', [{'text': 'Service Unavailable', 'status_code': 503},
+                                             {'text': 'Too Many Requests', 'status_code': 429,
+                                              'headers': {'Retry-After': '0'}},
+                                             {'text': 'Application OK', 'status_code': 200}])
+    rate_limiter = RateLimiter(per_day=10)
+    gateway = HttpGateway(retries=2, backoff_factor=0, rate_limiter=rate_limiter)
+
+    assert gateway.get('http://example.com', {}) == b'Application OK'
+    assert requests_mock.call_count == 3
+    assert rate_limiter.stats()['remaining_today'] == 7
+    assert len(gateway.circuit_breaker._calls) == 3
+
+
+def test_responses_asking_to_retry_after_too_long_are_returned_at_once(requests_mock, monkeypatch):
+    requests_mock.get('http://example.com', text='Too Many Requests', status_code=429,
+                      headers={'Retry-After': '3600'})
+    monkeypatch.setattr('core.gateway.sleep', lambda seconds: pytest.fail(f'Slept {seconds} seconds'))
+    gateway = HttpGateway(retries=2, read_timeout=30)
+
+    with pytest.raises(TooManyRequests):
+        gateway.get('http://example.com', {})
+    assert requests_mock.call_count == 1
+
+
+def test_backoff_is_capped(requests_mock, monkeypatch):
+    requests_mock.get('http://example.com', [{'text': 'Service Unavailable', 'status_code': 503},
+                                             {'text': 'Application OK', 'status_code': 200}])
+    delays = []
+    monkeypatch.setattr('core.gateway.sleep', delays.append)
+
+    assert HttpGateway(retries=1, backoff_factor=60, max_backoff=2).get('http://example.com', {}) == b'Application OK'
+    assert delays == [2]
+
+
+def test_async_gateway_returns_long_retry_after_at_once():
+    sent = []
+
+    def respond(request):
+        sent.append(request)
+        return httpx.Response(503, text='Service Unavailable', headers={'Retry-After': '3600'})
+
+    gateway = AsyncHttpGateway(retries=2, max_backoff=5, transport=httpx.MockTransport(respond))
+    with pytest.raises(ServiceUnavailable):
+        asyncio.run(gateway.get('http://example.com', {}))
+    assert len(sent) == 1
+
+
+def test_retries_stop_when_the_rate_limit_is_exhausted(requests_mock):
+    requests_mock.get('http://example.com', text='Service Unavailable', status_code=503)
+    gateway = HttpGateway(retries=2, backoff_factor=0, rate_limiter=RateLimiter(per_day=2))
+
+    with pytest.raises(TooManyRequests):
+        gateway.get('http://example.com', {})
+    assert requests_mock.call_count == 2
+
+
+def test_calls_rejected_by_the_breaker_cost_no_rate_limit_budget(requests_mock):
+    requests_mock.get('http://example.com', text='Service Unavailable', status_code=503)
+    rate_limiter = RateLimiter(per_day=10)
+    gateway = HttpGateway(retries=0, circuit_breaker={'min_calls': 1, 'open_seconds': 60}, rate_limiter=rate_limiter)
+
+    with pytest.raises(ServiceUnavailable):
+        gateway.get('http://example.com', {})
+    for _ in range(3):
+        with pytest.raises(ServiceUnavailable):
+            gateway.get('http://example.com', {})
+
+    assert requests_mock.call_count == 1
+    assert gateway.circuit_breaker.rejected == 3
+    assert rate_limiter.stats()['remaining_today'] == 9
+
+
+def test_calls_rejected_by_the_rate_limiter_free_their_slot(requests_mock):
+    requests_mock.get('http://example.com', text='Application OK')
+    gateway = HttpGateway(pool_size=1, rate_limiter=RateLimiter(per_day=1))
+
+    gateway.get('http://example.com', {})
+    with pytest.raises(TooManyRequests):
+        gateway.get('http://example.com', {})
+
+    assert gateway.limiter.stats()['in_flight'] == 0
+    assert gateway.circuit_breaker.state == 'closed'
+
+
+def test_async_gateway_charges_every_retry_to_the_rate_limiter():
+    responses = iter([httpx.Response(503, text='Service Unavailable'), httpx.Response(200, text='Application OK')])
+    rate_limiter = RateLimiter(per_day=10)
+    gateway = AsyncHttpGateway(retries=1, backoff_factor=0, rate_limiter=rate_limiter,
+                               transport=httpx.MockTransport(lambda request: next(responses)))
+
+    assert asyncio.run(gateway.get('http://example.com', {})) == b'Application OK'
+    assert rate_limiter.stats()['remaining_today'] == 8
+
+
+def test_async_gateway_timeout_returns_gateway_timeout():
+    def timeout(request):
+        raise httpx.ReadTimeout('timed out', request=request)
+
+    gateway = AsyncHttpGateway(transport=httpx.MockTransport(timeout))
+    with pytest.raises(GatewayTimeout):
+        asyncio.run(gateway.get('http://example.com', {}))
+
+
+class ChunkParser:
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        return b'|'.join(self.chunks)
+
+
+def test_get_parsed_feeds_the_response_in_chunks(requests_mock, monkeypatch):
+    monkeypatch.setattr(HttpGateway, 'STREAM_CHUNK_SIZE', 4)
+    requests_mock.get('http://example.com', text='Application OK', status_code=200)
+
+    assert HttpGateway().get_parsed('http://example.com', {}, ChunkParser()) == (b'Appl|icat|ion |OK', 14)
+
+
+def test_get_parsed_reports_errors_without_parsing(requests_mock, caplog):
+    requests_mock.get('http://example.com', text='', status_code=400)
+    parser = ChunkParser()
+
+    with pytest.raises(BadRequest):
+        HttpGateway().get_parsed('http://example.com', {}, parser)
+
+    assert parser.chunks == []
+    assert 'Failed to retrieve xml from Alma API' in caplog.text
+
+
+def test_async_get_parsed_feeds_the_response_after_retries():
+    responses = iter([httpx.Response(503, text='Service Unavailable'), httpx.Response(200, text='Application OK')])
+    gateway = AsyncHttpGateway(retries=1, backoff_factor=0,
+                               transport=httpx.MockTransport(lambda request: next(responses)))
+
+    assert asyncio.run(gateway.get_parsed('http://example.com', {}, ChunkParser())) == (b'Application OK', 14)
+
+
+def test_circuit_breaker_opens_and_fails_fast(requests_mock, caplog):
+    requests_mock.get('http://example.com', text='Service Unavailable', status_code=503)
+    gateway = HttpGateway(retries=0, circuit_breaker={'min_calls': 2, 'open_seconds': 60})
+
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            gateway.get('http://example.com', {})
+    with pytest.raises(ServiceUnavailable):
+        gateway.get('http://example.com', {})
+
+    assert requests_mock.call_count == 2
+    assert gateway.stats()['circuit_breaker'] == {
+        'state': 'open', 'transitions': {'closed': 0, 'open': 1, 'half_open': 0}, 'rejected': 1}
+    assert 'circuit breaker changed from closed to open' in caplog.text
+
+
+def test_half_open_circuit_breaker_closes_after_successful_trial():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    breaker.record(True, 0, breaker.before_call())
+    assert breaker.state == 'open'
+
+    trial = breaker.before_call()
+    assert trial
+    assert breaker.state == 'half_open'
+    # Only one trial call is let through
+    with pytest.raises(ServiceUnavailable):
+        breaker.before_call()
+
+    breaker.record(False, 0, trial)
+    assert breaker.state == 'closed'
+
+
+def test_calls_let_through_before_the_breaker_opened_do_not_end_the_trial():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    slow_call = breaker.before_call()
+    breaker.record(True, 0, breaker.before_call())
+    trial = breaker.before_call()
+
+    breaker.record(False, 0, slow_call)
+    assert breaker.state == 'half_open'
+    with pytest.raises(ServiceUnavailable):
+        breaker.before_call()
+
+    breaker.record(True, 0, trial)
+    assert breaker.state == 'open'
+
+
+def test_concurrency_limit_decreases_on_failure_and_grows_on_success():
+    limiter = ConcurrencyLimiter(initial=4, max_limit=8, slow_call=1)
+    limiter.acquire()
+    limiter.release(True, 0)
+    assert limiter.stats()['limit'] == 2
+
+    limiter.acquire()
+    limiter.release(False, 2)
+    assert limiter.stats()['limit'] == 1
+
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(False, 0)
+    assert limiter.stats()['limit'] == 3
+
+
+def test_concurrency_limiter_rejects_after_queue_timeout():
+    limiter = ConcurrencyLimiter(initial=1, queue_timeout=0.01)
+    limiter.acquire()
+
+    with pytest.raises(ServiceUnavailable):
+        limiter.acquire()
+    assert limiter.stats() == {'limit': 1, 'in_flight': 1, 'rejected': 1}
+
+
+def test_async_concurrency_limiter_hands_slots_to_waiters_in_order():
+    limiter = AsyncConcurrencyLimiter(initial=1, queue_timeout=0.05)
+    acquired = []
+
+    async def call(name):
+        await limiter.acquire()
+        acquired.append(name)
+
+    async def main():
+        await limiter.acquire()
+        waiters = [asyncio.ensure_future(call(name)) for name in ['a', 'b']]
+        await asyncio.sleep(0)
+        assert acquired == []
+
+        # A failed call, so that the limit stays at 1
+        limiter.release(True, 0)
+        await waiters[0]
+        assert acquired == ['a']
+        assert not waiters[1].done()
+
+        # No slot frees up for b before its queue timeout
+        with pytest.raises(ServiceUnavailable):
+            await waiters[1]
+
+    asyncio.run(main())
+    assert limiter.stats() == {'limit': 1, 'in_flight': 1, 'rejected': 1}
@@ -0,0 +1,26 @@
+from core.metrics import Counter, Histogram, render
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram('latency_seconds', 'Latency', ['route'], buckets=(0.1, 1))
+    histogram.observe(0.05, '/a')
+    histogram.observe(0.5, '/a')
+    histogram.observe(5, '/a')
+
+    assert histogram.render() == (
+        '# HELP latency_seconds Latency\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{route="/a",le="0.1"} 1\n'
+        'latency_seconds_bucket{route="/a",le="1"} 2\n'
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3\n'
+        'latency_seconds_sum{route="/a"} 5.55\n'
+        'latency_seconds_count{route="/a"} 3\n'
+    )
+
+
+def test_counter_escapes_label_values():
+    counter = Counter('errors_total', 'Errors', ['message'])
+    counter.inc('say "hi"')
+    counter.inc('say "hi"', amount=2)
+
+    assert render([counter]).splitlines()[-1] == 'errors_total{message="say \\"hi\\""} 3'
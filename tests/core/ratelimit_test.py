@@ -0,0 +1,37 @@
+import json
+
+import pytest
+from core.ratelimit import RateLimiter
+from werkzeug.exceptions import TooManyRequests
+
+
+def test_callers_over_the_per_second_budget_wait():
+    limiter = RateLimiter(per_second=100, burst=1)
+    limiter.acquire()
+    limiter.acquire()
+
+    assert limiter.stats()['waited'] == 1
+
+
+def test_callers_that_would_wait_too_long_are_rejected():
+    limiter = RateLimiter(per_second=1, burst=1, max_wait=0.1)
+    limiter.acquire()
+
+    with pytest.raises(TooManyRequests):
+        limiter.acquire()
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_daily_budget_is_persisted(tmp_path):
+    state_file = tmp_path / 'rate_limit.json'
+    limiter = RateLimiter(per_day=2, state_file=str(state_file))
+    limiter.acquire()
+    limiter.save()
+
+    assert json.loads(state_file.read_text()) == {'day': RateLimiter.today(), 'remaining': 1}
+
+    restarted = RateLimiter(per_day=2, state_file=str(state_file))
+    restarted.acquire()
+    with pytest.raises(TooManyRequests):
+        restarted.acquire()
+    assert restarted.stats()['remaining_today'] == 0
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from core.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(timeout=5)
+        return b'content'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight.do('key', fetch))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while single_flight.calls + single_flight.coalesced < 5:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [b'content'] * 5
+    assert len(calls) == 1
+    assert single_flight.stats() == {'calls': 1, 'coalesced': 4, 'in_flight': 0}
+
+
+def test_exceptions_are_shared_and_not_remembered():
+    single_flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError):
+        single_flight.do('key', fail)
+
+    assert single_flight.do('key', lambda: 'retried') == 'retried'
+
+
+def test_async_concurrent_calls_share_one_result():
+    single_flight = AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return b'content'
+
+    async def run():
+        return await asyncio.gather(*(single_flight.do('key', fetch) for _ in range(5)))
+
+    assert asyncio.run(run()) == [b'content'] * 5
+    assert len(calls) == 1
+    assert single_flight.stats() == {'calls': 1, 'coalesced': 4, 'in_flight': 0}
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from core.tracing import current_span, end_trace, new_request_id, propagate, span, start_trace, traced
+
+
+@traced('lookup')
+def lookup(n):
+    current_span().set(n=n)
+    return n
+
+
+def test_spans_are_nested_across_threads(caplog):
+    trace, tokens = start_trace('abc123')
+    with span('outer'):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert list(executor.map(propagate(lookup), [1, 2])) == [1, 2]
+    end_trace(trace, tokens)
+
+    spans = {(s.name, s.attributes.get('n')): s for s in trace.spans}
+    outer = spans['outer', None]
+    assert spans['lookup', 1].parent_id == outer.span_id
+    assert spans['lookup', 2].parent_id == outer.span_id
+    assert outer.parent_id == trace.root.span_id
+    assert spans['request', None] is trace.root
+    assert all(record.request_id == 'abc123' for record in caplog.records if record.name == 'core.tracing')
+
+
+def test_spans_are_not_recorded_without_a_trace():
+    with span('outer') as outer:
+        outer.set(ignored=True)
+        assert lookup(1) == 1
+    assert propagate(lookup) is lookup
+
+
+def test_server_timing_combines_spans_of_the_same_name():
+    trace, tokens = start_trace('abc123')
+    lookup(1)
+    lookup(2)
+    header = trace.server_timing()
+    end_trace(trace, tokens)
+
+    assert header.startswith('lookup;dur=')
+    assert ';desc="2 calls", total;dur=' in header
+
+
+def test_received_request_ids_are_only_used_if_plausible():
+    assert new_request_id('0f8e-42') == '0f8e-42'
+    assert new_request_id('bad id\n') != 'bad id\n'
+    assert len(new_request_id()) == 32